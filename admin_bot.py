@@ -2,7 +2,9 @@ from aiogram import F, Router
 from aiogram.types import Message, CallbackQuery, InlineKeyboardMarkup, InlineKeyboardButton
 from aiogram.filters import Command
 from config import config
-from database import db
+from database import adb
+from ai_service import ai_service
+from story_pool import story_pool
 
 admin_router = Router()
 
@@ -33,7 +35,17 @@ async def admin_stats(callback: CallbackQuery):
     if not is_admin(callback.from_user.id):
         return
     
-    stats = db.get_stats(7)
+    stats = await adb.get_stats(7)
+    cache = await adb.cache_stats()
+    pool = ai_service.pool_stats()
+    llm = ai_service.scheduler.stats()
+    stories = story_pool.stats()
+    upstream = ai_service.resilience_stats()
+    voices = ai_service.voice_stats()
+    cache_line = ""
+    if ai_service.cache:
+        replies = ai_service.cache.stats()
+        cache_line = f"\n💾 Кэш ответов: {replies['size']}/{replies['max_size']}, попаданий {replies['hit_rate']} ({replies['hits']}/{replies['misses']}), мимо кэша {replies['bypassed']}"
     
     text = f"""📊 *Статистика за 7 дней*
 
@@ -44,7 +56,15 @@ async def admin_stats(callback: CallbackQuery):
 🎁 Рефералов: {stats['referrals_total']} (конверсия: {stats['conversion_rate']})
 
 🌍 Языки:
-{chr(10).join([f"  {k}: {v}" for k, v in stats['languages'].items()])}"""
+{chr(10).join([f"  {k}: {v}" for k, v in stats['languages'].items()])}
+
+🗄 Кэш пользователей: {cache['size']}/{cache['max_size']}, попаданий {cache['hit_rate']} ({cache['hits']}/{cache['misses']})
+🌐 Пул Groq: запросов {pool['requests']}, в работе {pool['in_flight']}/{pool['limit_per_host']}, переиспользовано {pool['reuse_rate']}, ожиданий слота {pool['queued']} ({pool['queue_wait_ms']} мс)
+🚦 LLM: в работе {llm['active']}/{llm['max_concurrency']}, в очереди {llm['queued']}
+{chr(10).join([f"  {lane}: обслужено {l['served']}, ждут {l['queued']}, ср. ожидание {l['avg_wait_ms']} мс, отказов {l['rejected'] + l['timed_out']}" for lane, l in llm['lanes'].items()])}
+📖 Пул историй: готово {', '.join(f"{lang} {n}" for lang, n in stories['ready'].items())}, из пула {stories['hit_rate']}, сгенерировано {stories['generated']}, просрочено {stories['expired']}
+🛡 Groq: предохранитель {upstream['breaker']} (отказов {upstream['breaker_rejected']}), повторов {upstream['retries']}, таймаутов {upstream['timeouts']}, дублей {upstream['hedged']} (выиграли {upstream['hedge_won']}), p95 {upstream['p95_ms']} мс
+🎤 Голосовые: {voices['voices']} (ошибок {voices['errors']}), {voices['bytes'] // 1024} КБ, ср. загрузка {voices['avg_upload_ms']} мс, ср. Whisper {voices['avg_whisper_ms']} мс{cache_line}"""
     
     await callback.message.edit_text(text, parse_mode="Markdown")
 
@@ -68,8 +88,8 @@ async def give_premium(message: Message):
         target_id = int(parts[1])
         days = int(parts[2])
         
-        db.add_premium(target_id, days)
-        db.log_admin_action(message.from_user.id, "give_premium", target_id, f"{days} days")
+        await adb.add_premium(target_id, days)
+        await adb.log_admin_action(message.from_user.id, "give_premium", target_id, f"{days} days")
         
         await message.answer(f"✅ Выдан Premium пользователю {target_id} на {days} дней")
         
@@ -97,7 +117,7 @@ async def add_messages(message: Message):
         target_id = int(parts[1])
         count = int(parts[2])
         
-        db.add_bonus_messages(target_id, count)
+        await adb.add_bonus_messages(target_id, count)
         
         await message.answer(f"✅ Добавлено {count} бонусных сообщений пользователю {target_id}")
         
@@ -144,7 +164,7 @@ async def block_user_cmd(message: Message):
     
     try:
         target_id = int(message.text.split()[1])
-        db.block_user(target_id, True)
+        await adb.block_user(target_id, True)
         await message.answer(f"🚫 Пользователь {target_id} заблокирован")
     except:
         await message.answer("Используйте: `/block USER_ID`")
\ No newline at end of file
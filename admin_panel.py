@@ -2,6 +2,8 @@ import gradio as gr
 from database import db
 from config import config
 from datetime import datetime, timedelta
+from itertools import islice
+from utils import format_date
 
 class WebAdminPanel:
     def __init__(self):
@@ -37,11 +39,11 @@ class WebAdminPanel:
         
         - Username: @{user['username'] or 'Нет'}
         - Язык: {user['language']}
-        - Premium: {premium_status} (до {user['premium_until'] or 'Н/Д'})
+        - Premium: {premium_status} (до {format_date(user['premium_until_ts']) or 'Н/Д'})
         - Всего сообщений: {user['total_messages']}
         - Рефералов: {user['referral_count']}
         - Бонусных сообщений: {user['bonus_messages']}
-        - Последняя активность: {user['last_active'][:10] if user['last_active'] else 'Н/Д'}
+        - Последняя активность: {format_date(user['last_active_ts']) or 'Н/Д'}
         """
     
     def give_premium(self, user_id, days, password):
@@ -65,13 +67,14 @@ class WebAdminPanel:
             return f"❌ Ошибка: {e}"
     
     def get_inactive_list(self, days):
-        users = db.get_inactive_users(int(days))
+        # Первые 20 — одна страница keyset-запроса, остальные не читаются
+        users = list(islice(db.iter_inactive_users(int(days), batch_size=20), 20))
         if not users:
             return f"Нет неактивных пользователей (>{days} дней)"
         
         result = f"## 😴 Неактивные (> {days} дней)\n\n"
-        for uid, username, lang, last in users[:20]:  # Первые 20
-            result += f"- @{username or uid} ({lang}), последняя активность: {last[:10]}\n"
+        for uid, username, lang, last in users:
+            result += f"- @{username or uid} ({lang}), последняя активность: {format_date(last)}\n"
         
         return result
     
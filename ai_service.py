@@ -1,12 +1,235 @@
+import asyncio
+import heapq
+import itertools
+import json
+import re
+import time
 import aiohttp
-from typing import List, Dict
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+from typing import AsyncIterable, AsyncIterator, Awaitable, Callable, List, Dict, Optional, Tuple, Union
 from config import config
+from context_window import ContextBuilder
+from resilience import CircuitBreaker, CircuitOpen, LatencyTracker, RetryPolicy, UpstreamError, parse_retry_after
+
+class SchedulerBusy(Exception):
+    """Очередь к LLM переполнена или слот не освободился за отведённое время"""
+
+class RequestScheduler:
+    """Ограничивает число одновременных запросов к LLM; освободившийся слот получает самая приоритетная полоса"""
+    
+    # Полоса: приоритет (меньше — раньше). paid — Premium и оплаченные разовые сеансы
+    LANES = {"paid": 0, "trial": 1, "free": 2, "story": 3}
+    
+    def __init__(self, max_concurrency: int = 8, max_queue: int = 200, queue_timeout: float = 20):
+        self.max_concurrency = max_concurrency
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self._active = 0
+        self._queued = 0
+        self._waiters: List[Tuple[int, int, asyncio.Future]] = []
+        self._seq = itertools.count()
+        self._stats = {
+            lane: {"queued": 0, "max_queued": 0, "served": 0, "rejected": 0, "timed_out": 0,
+                   "wait_ms": 0.0, "max_wait_ms": 0.0}
+            for lane in self.LANES
+        }
+    
+    def _wake(self):
+        while self._waiters and self._active < self.max_concurrency:
+            _, _, future = heapq.heappop(self._waiters)
+            # Отменённые (по таймауту) ожидания просто выбрасываются
+            if not future.done():
+                self._active += 1
+                future.set_result(None)
+    
+    def _release(self):
+        self._active -= 1
+        self._wake()
+    
+    async def _acquire(self, lane: str) -> float:
+        stats = self._stats[lane]
+        if self._active < self.max_concurrency and not self._queued:
+            self._active += 1
+            return 0.0
+        # Платных не отбрасываем по длине очереди — они всё равно обслуживаются первыми
+        if lane != "paid" and self._queued >= self.max_queue:
+            stats["rejected"] += 1
+            raise SchedulerBusy(f"LLM queue is full ({self._queued})")
+        
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiters, (self.LANES[lane], next(self._seq), future))
+        self._queued += 1
+        stats["queued"] += 1
+        stats["max_queued"] = max(stats["max_queued"], stats["queued"])
+        started = time.monotonic()
+        try:
+            await asyncio.wait_for(future, self.queue_timeout)
+        except BaseException as e:
+            if future.done() and not future.cancelled():
+                # Слот выдали в момент отмены — сразу отдаём следующему
+                self._release()
+            if isinstance(e, asyncio.TimeoutError):
+                stats["timed_out"] += 1
+                raise SchedulerBusy(f"No LLM slot within {self.queue_timeout}s") from None
+            raise
+        finally:
+            self._queued -= 1
+            stats["queued"] -= 1
+        return (time.monotonic() - started) * 1000
+    
+    @asynccontextmanager
+    async def slot(self, lane: str = "free"):
+        wait_ms = await self._acquire(lane)
+        stats = self._stats[lane]
+        stats["served"] += 1
+        stats["wait_ms"] += wait_ms
+        stats["max_wait_ms"] = max(stats["max_wait_ms"], wait_ms)
+        try:
+            yield
+        finally:
+            self._release()
+    
+    def try_acquire(self) -> bool:
+        """Слот без ожидания — только если он свободен и никто не стоит в очереди; вернуть через release()"""
+        if self._active < self.max_concurrency and not self._queued:
+            self._active += 1
+            return True
+        return False
+    
+    def release(self):
+        self._release()
+    
+    def idle(self) -> bool:
+        """Нет очереди и занято меньше половины слотов — можно генерировать впрок"""
+        return not self._queued and self._active * 2 < self.max_concurrency
+    
+    def stats(self) -> Dict:
+        lanes = {}
+        for lane, stats in self._stats.items():
+            lanes[lane] = dict(stats)
+            lanes[lane]["avg_wait_ms"] = round(stats["wait_ms"] / stats["served"], 1) if stats["served"] else 0.0
+            lanes[lane]["max_wait_ms"] = round(stats["max_wait_ms"], 1)
+            del lanes[lane]["wait_ms"]
+        return {"active": self._active, "max_concurrency": self.max_concurrency, "queued": self._queued, "lanes": lanes}
+
+class ResponseCache:
+    """LRU+TTL кэш ответов на типовые первые реплики: на ключ копится несколько вариантов, выдаются по кругу"""
+    
+    # Режимы, которые не кэшируются: исповедь — личное, истории берутся из своего пула
+    BYPASS_MODES = ("confessional", "story")
+    _PUNCTUATION = re.compile(r"[^\w\s]+")
+    
+    def __init__(self, max_entries: int = 2000, ttl_seconds: float = 21600, variants: int = 3,
+                 max_turns: int = 1, max_chars: int = 120):
+        self.max_entries = max_entries
+        self.ttl = ttl_seconds
+        self.variants = variants
+        self.max_turns = max_turns
+        self.max_chars = max_chars
+        # Ключ -> {"created", "responses", "next"}; порядок — от давно использованных к свежим
+        self._entries: OrderedDict = OrderedDict()
+        self._stats = {"hits": 0, "misses": 0, "stored": 0, "bypassed": 0, "evicted": 0, "expired": 0}
+    
+    @classmethod
+    def normalize(cls, text: str) -> str:
+        # «Не могу уснуть...» и «не могу уснуть» — один ключ; эмодзи и пунктуация не различаются
+        return " ".join(cls._PUNCTUATION.sub(" ", text.lower()).split())
+    
+    def key(self, messages: List[Dict], lang: str, mode: str) -> Optional[Tuple]:
+        """Ключ для короткой истории из коротких реплик; None — запрос кэшировать нельзя"""
+        if mode in self.BYPASS_MODES or not messages or len(messages) > self.max_turns:
+            return None
+        turns = []
+        for message in messages:
+            text = self.normalize(message["content"])
+            if not text or len(text) > self.max_chars:
+                return None
+            turns.append((message["role"], text))
+        return (lang, mode, tuple(turns))
+    
+    def get(self, key: Optional[Tuple]) -> Optional[str]:
+        """Очередной вариант ответа, если их уже набрано достаточно; иначе промах — нужен новый ответ LLM"""
+        if key is None:
+            self._stats["bypassed"] += 1
+            return None
+        entry = self._entries.get(key)
+        if entry and time.monotonic() - entry["created"] >= self.ttl:
+            del self._entries[key]
+            self._stats["expired"] += 1
+            entry = None
+        if not entry or len(entry["responses"]) < self.variants:
+            self._stats["misses"] += 1
+            return None
+        self._entries.move_to_end(key)
+        response = entry["responses"][entry["next"] % len(entry["responses"])]
+        entry["next"] += 1
+        self._stats["hits"] += 1
+        return response
+    
+    def put(self, key: Optional[Tuple], response: str):
+        if key is None:
+            return
+        entry = self._entries.get(key)
+        if entry is None:
+            entry = self._entries[key] = {"created": time.monotonic(), "responses": [], "next": 0}
+        if len(entry["responses"]) < self.variants and response not in entry["responses"]:
+            entry["responses"].append(response)
+            self._stats["stored"] += 1
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self._stats["evicted"] += 1
+    
+    def stats(self) -> Dict:
+        stats = dict(self._stats)
+        lookups = stats["hits"] + stats["misses"]
+        stats["hit_rate"] = f"{(stats['hits']/lookups*100):.1f}%" if lookups else "0%"
+        stats["size"] = len(self._entries)
+        stats["max_size"] = self.max_entries
+        return stats
 
 class AIService:
     def __init__(self):
         self.api_key = config.GROQ_API_KEY
-        self.url = "https://api.groq.com/openai/v1/chat/completions"
-        self.whisper_url = "https://api.groq.com/openai/v1/audio/transcriptions"
+        self.url = f"{config.GROQ_BASE_URL}/chat/completions"
+        self.whisper_url = f"{config.GROQ_BASE_URL}/audio/transcriptions"
+        self.timeout = config.LLM_TIMEOUT_SECONDS
+        
+        # История подбирается под бюджет токенов, а не фиксированным числом реплик
+        self.context = ContextBuilder(
+            config.LLM_CONTEXT_BUDGET_TOKENS, config.LLM_MAX_TURN_TOKENS, config.LLM_HISTORY_MAX_MESSAGES
+        )
+        
+        # Повторы на 429/5xx, быстрый отказ при лежащем провайдере, дубли медленных запросов после p95
+        self.retry = RetryPolicy(config.LLM_RETRY_ATTEMPTS, config.LLM_RETRY_BASE_DELAY, config.LLM_RETRY_MAX_DELAY)
+        self.breaker = CircuitBreaker(config.LLM_BREAKER_FAILURES, config.LLM_BREAKER_RESET_SECONDS)
+        self.latency = LatencyTracker()
+        self._resilience_stats = {"retries": 0, "retry_after": 0, "timeouts": 0, "hedged": 0, "hedge_won": 0, "hedge_skipped": 0}
+        
+        # Общий лимит параллельных запросов к LLM с приоритетом платных пользователей
+        self.scheduler = RequestScheduler(
+            max_concurrency=config.LLM_MAX_CONCURRENCY,
+            max_queue=config.LLM_MAX_QUEUE,
+            queue_timeout=config.LLM_QUEUE_TIMEOUT_SECONDS
+        )
+        
+        # Кэш ответов включается явно: без него каждая реплика идёт в LLM
+        self.cache = ResponseCache(
+            max_entries=config.RESPONSE_CACHE_MAX_ENTRIES,
+            ttl_seconds=config.RESPONSE_CACHE_TTL_SECONDS,
+            variants=config.RESPONSE_CACHE_VARIANTS,
+            max_turns=config.RESPONSE_CACHE_MAX_TURNS,
+            max_chars=config.RESPONSE_CACHE_MAX_CHARS
+        ) if config.RESPONSE_CACHE_ENABLED else None
+        
+        # Одна сессия на процесс: TCP+TLS к Groq переиспользуются между ответами
+        self._session: Optional[aiohttp.ClientSession] = None
+        self._pool_stats = {
+            "requests": 0, "in_flight": 0, "connections_created": 0, "connections_reused": 0,
+            "queued": 0, "queue_wait_ms": 0.0
+        }
+        self._voice_stats = {"voices": 0, "errors": 0, "bytes": 0, "upload_ms": 0.0, "whisper_ms": 0.0}
         
         self.prompts = {
             "ru": "Ты — ночной психолог Луна. Мягкий, эмпатичный стиль. Помогай с тревогой и бессонницей. Отвечай кратко (2-4 предложения), с эмодзи.",
@@ -23,64 +246,368 @@ class AIService:
             "de": "Erzähle eine kurze Schlafgeschichte (3-5 Sätze). Ruhig, ohne Spannung, über Natur und Wärme."
         }
     
-    async def transcribe_voice(self, voice_data: bytes) -> str:
-        """Распознавание голоса через Groq Whisper (бесплатно!)"""
+    def _trace_config(self) -> aiohttp.TraceConfig:
+        stats = self._pool_stats
+        trace = aiohttp.TraceConfig()
+        
+        async def on_request_start(session, ctx, params):
+            stats["requests"] += 1
+            stats["in_flight"] += 1
+        
+        async def on_request_end(session, ctx, params):
+            stats["in_flight"] -= 1
+        
+        async def on_connection_create_end(session, ctx, params):
+            stats["connections_created"] += 1
+        
+        async def on_connection_reuseconn(session, ctx, params):
+            stats["connections_reused"] += 1
+        
+        async def on_connection_queued_start(session, ctx, params):
+            stats["queued"] += 1
+            ctx.queued_at = time.monotonic()
+        
+        async def on_connection_queued_end(session, ctx, params):
+            stats["queue_wait_ms"] += (time.monotonic() - ctx.queued_at) * 1000
+        
+        trace.on_request_start.append(on_request_start)
+        trace.on_request_end.append(on_request_end)
+        trace.on_request_exception.append(on_request_end)
+        trace.on_connection_create_end.append(on_connection_create_end)
+        trace.on_connection_reuseconn.append(on_connection_reuseconn)
+        trace.on_connection_queued_start.append(on_connection_queued_start)
+        trace.on_connection_queued_end.append(on_connection_queued_end)
+        return trace
+    
+    async def start(self):
+        """Открывает общую сессию с пулом keep-alive соединений (вызывается на старте бота)"""
+        if self._session and not self._session.closed:
+            return
+        connector = aiohttp.TCPConnector(
+            limit=config.HTTP_POOL_LIMIT,
+            limit_per_host=config.HTTP_POOL_LIMIT_PER_HOST,
+            keepalive_timeout=config.HTTP_KEEPALIVE_SECONDS,
+            ttl_dns_cache=config.HTTP_DNS_CACHE_SECONDS,
+            enable_cleanup_closed=True
+        )
+        self._session = aiohttp.ClientSession(connector=connector, trace_configs=[self._trace_config()])
+    
+    async def close(self):
+        if self._session and not self._session.closed:
+            await self._session.close()
+        self._session = None
+    
+    async def _get_session(self) -> aiohttp.ClientSession:
+        # Ленивое открытие — для вызовов вне жизненного цикла бота (скрипты, тесты)
+        if self._session is None or self._session.closed:
+            await self.start()
+        return self._session
+    
+    def pool_stats(self) -> Dict:
+        """Метрики пула для подбора лимитов: доля переиспользованных соединений и ожидание свободного слота"""
+        stats = dict(self._pool_stats)
+        connections = stats["connections_created"] + stats["connections_reused"]
+        stats["reuse_rate"] = f"{(stats['connections_reused']/connections*100):.1f}%" if connections else "0%"
+        stats["limit"] = config.HTTP_POOL_LIMIT
+        stats["limit_per_host"] = config.HTTP_POOL_LIMIT_PER_HOST
+        stats["queue_wait_ms"] = round(stats["queue_wait_ms"], 1)
+        return stats
+    
+    def whisper_language(self, lang: Optional[str]) -> Optional[str]:
+        # Код ISO-639-1 из профиля; иначе пусть Whisper определит язык сам
+        if config.VOICE_LANGUAGE_HINT and lang and len(lang) == 2 and lang.isalpha():
+            return lang.lower()
+        return None
+    
+    async def _count_chunks(self, chunks: AsyncIterable[bytes], timings: Dict) -> AsyncIterator[bytes]:
+        """Пропускает куски в загрузку как есть, считая объём и время; лишнее сверх VOICE_MAX_BYTES обрывает запрос"""
+        started = time.monotonic()
+        timings["bytes"] = 0
+        async for chunk in chunks:
+            timings["bytes"] += len(chunk)
+            if timings["bytes"] > config.VOICE_MAX_BYTES:
+                raise ValueError(f"Voice file exceeds {config.VOICE_MAX_BYTES} bytes")
+            yield chunk
+        timings["upload_ms"] = round((time.monotonic() - started) * 1000)
+        timings["uploaded_at"] = time.monotonic()
+    
+    async def transcribe_voice(self, audio: Union[bytes, AsyncIterable[bytes]], lang: Optional[str] = None,
+                               timings: Optional[Dict] = None) -> str:
+        """Распознавание голоса через Groq Whisper (бесплатно!); audio — байты или поток кусков из Telegram"""
         if not self.api_key:
             return "(голосовое сообщение)"
         
+        timings = {} if timings is None else timings
+        stats = self._voice_stats
+        stats["voices"] += 1
         try:
-            async with aiohttp.ClientSession() as session:
-                form = aiohttp.FormData()
-                form.add_field('file', voice_data, filename='voice.ogg', content_type='audio/ogg')
-                form.add_field('model', 'whisper-large-v3')
-                form.add_field('language', 'ru')  # Автоопределение или указать явно
-                
-                headers = {"Authorization": f"Bearer {self.api_key}"}
-                
-                async with session.post(self.whisper_url, headers=headers, data=form) as resp:
-                    if resp.status == 200:
-                        result = await resp.json()
-                        return result.get("text", "(не распознано)")
-                    else:
-                        error = await resp.text()
-                        print(f"Whisper error: {error}")
-                        return "(голосовое сообщение — текст недоступен)"
+            session = await self._get_session()
+            form = aiohttp.FormData()
+            if isinstance(audio, bytes):
+                form.add_field('file', audio, filename='voice.ogg', content_type='audio/ogg')
+            else:
+                # Поток уходит в multipart по мере скачивания: в памяти один кусок, а не весь файл
+                form.add_field('file', self._count_chunks(audio, timings), filename='voice.ogg', content_type='audio/ogg')
+            form.add_field('model', 'whisper-large-v3')
+            language = self.whisper_language(lang)
+            if language:
+                form.add_field('language', language)
+            
+            headers = {"Authorization": f"Bearer {self.api_key}"}
+            
+            started = time.monotonic()
+            async with session.post(self.whisper_url, headers=headers, data=form, timeout=config.VOICE_TIMEOUT_SECONDS) as resp:
+                body_at = time.monotonic()
+                if resp.status == 200:
+                    result = await resp.json()
+                    text = result.get("text", "(не распознано)")
+                else:
+                    error = await resp.text()
+                    print(f"Whisper error: {error}")
+                    stats["errors"] += 1
+                    return "(голосовое сообщение — текст недоступен)"
+            
+            # Загрузка идёт вместе со скачиванием; whisper — ожидание ответа после последнего куска
+            timings.setdefault("upload_ms", round((body_at - started) * 1000))
+            timings["whisper_ms"] = round((body_at - timings.pop("uploaded_at", started)) * 1000)
+            timings["language"] = language or "auto"
+            stats["bytes"] += timings.get("bytes", len(audio) if isinstance(audio, bytes) else 0)
+            stats["upload_ms"] += timings["upload_ms"]
+            stats["whisper_ms"] += timings["whisper_ms"]
+            return text
         except Exception as e:
             print(f"Transcription error: {e}")
+            stats["errors"] += 1
             return "(голосовое сообщение)"
     
-    async def get_response(self, messages: List[Dict], lang: str = "en", mode: str = "normal") -> str:
-        if not self.api_key:
-            return self._fallback_response(lang)
-            
-        headers = {"Authorization": f"Bearer {self.api_key}", "Content-Type": "application/json"}
+    def voice_stats(self) -> Dict:
+        stats = dict(self._voice_stats)
+        done = stats["voices"] - stats["errors"]
+        stats["avg_upload_ms"] = round(stats.pop("upload_ms") / done) if done else 0
+        stats["avg_whisper_ms"] = round(stats.pop("whisper_ms") / done) if done else 0
+        return stats
+    
+    def _payload(self, messages: List[Dict], lang: str, mode: str) -> Dict:
         system = self.prompts.get(lang, self.prompts["default"])
         
         if mode == "confessional":
             system += " Сейчас режим исповеди. Будь особенно бережным и тактичным."
         
-        payload = {
+        return {
             "model": "llama-3.1-8b-instant",
-            "messages": [{"role": "system", "content": system}] + messages[-10:],
+            "messages": self.context.build({"role": "system", "content": system}, messages),
             "temperature": 0.7,
             "max_tokens": 250
         }
+    
+    def _headers(self) -> Dict:
+        return {"Authorization": f"Bearer {self.api_key}", "Content-Type": "application/json"}
+    
+    async def _with_retries(self, attempt: Callable[[], Awaitable]):
+        """Повторяет попытку на 429/5xx и обрыве соединения; пока предохранитель открыт — CircuitOpen без запроса"""
+        stats = self._resilience_stats
+        if not self.breaker.allow():
+            raise CircuitOpen("LLM upstream is unhealthy")
+        for n in itertools.count():
+            retry_after = None
+            try:
+                result = await attempt()
+            except asyncio.TimeoutError:
+                # Медленный провайдер: повтор только удвоит ожидание, от хвостов спасают дубли
+                stats["timeouts"] += 1
+                self.breaker.record_failure()
+                raise
+            except UpstreamError as e:
+                if not e.retryable:
+                    # Провайдер жив, ошибка в самом запросе
+                    self.breaker.record_success()
+                    raise
+                self.breaker.record_failure()
+                error, retry_after = e, e.retry_after
+            except aiohttp.ClientConnectionError as e:
+                self.breaker.record_failure()
+                error = e
+            else:
+                self.breaker.record_success()
+                return result
+            
+            delay = self.retry.delay(n, retry_after)
+            if delay is None or self.breaker.state == "open":
+                raise error
+            stats["retries"] += 1
+            if retry_after is not None:
+                stats["retry_after"] += 1
+            await asyncio.sleep(delay)
+    
+    async def _attempt(self, session: aiohttp.ClientSession, payload: Dict) -> Dict:
+        started = time.monotonic()
+        async with session.post(self.url, headers=self._headers(), json=payload, timeout=self.timeout) as resp:
+            if resp.status != 200:
+                raise UpstreamError(resp.status, parse_retry_after(resp.headers.get("Retry-After")), await resp.text())
+            result = await resp.json()
+        self.latency.add(time.monotonic() - started)
+        return result
+    
+    async def _hedged(self, session: aiohttp.ClientSession, payload: Dict) -> Dict:
+        """Если ответа нет дольше p95 и есть свободный слот, параллельно уходит такой же запрос; берём первый успешный"""
+        delay = self.latency.percentile(0.95) if config.LLM_HEDGE_ENABLED else None
+        if delay is None:
+            return await self._attempt(session, payload)
         
+        tasks = [asyncio.create_task(self._attempt(session, payload))]
         try:
-            async with aiohttp.ClientSession() as session:
-                async with session.post(self.url, headers=headers, json=payload, timeout=30) as resp:
-                    if resp.status == 200:
-                        result = await resp.json()
-                        return result["choices"][0]["message"]["content"]
-                    else:
-                        return self._fallback_response(lang)
+            done, _ = await asyncio.wait(tasks, timeout=max(delay, config.LLM_HEDGE_MIN_DELAY))
+            if not done:
+                # Дубль занимает собственный слот планировщика; свободного нет — не дублируем,
+                # иначе одновременных запросов стало бы больше LLM_MAX_CONCURRENCY
+                if self.scheduler.try_acquire():
+                    hedge = asyncio.create_task(self._attempt(session, payload))
+                    # Колбэк срабатывает и при отмене задачи до старта, так что слот не теряется
+                    hedge.add_done_callback(lambda _: self.scheduler.release())
+                    tasks.append(hedge)
+                    self._resilience_stats["hedged"] += 1
+                else:
+                    self._resilience_stats["hedge_skipped"] += 1
+            pending, error = set(tasks), None
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        if task is not tasks[0]:
+                            self._resilience_stats["hedge_won"] += 1
+                        return task.result()
+                    error = task.exception()
+            raise error
+        finally:
+            # Проигравший запрос больше не нужен — отменяем, чтобы освободить соединение
+            for task in tasks:
+                task.cancel()
+    
+    async def _open_stream(self, session: aiohttp.ClientSession, payload: Dict) -> aiohttp.ClientResponse:
+        resp = await session.post(self.url, headers=self._headers(), json=payload, timeout=self.timeout)
+        if resp.status != 200:
+            try:
+                body = await resp.text()
+            finally:
+                resp.release()
+            raise UpstreamError(resp.status, parse_retry_after(resp.headers.get("Retry-After")), body)
+        return resp
+    
+    async def _complete(self, messages: List[Dict], lang: str, mode: str, lane: str) -> Optional[str]:
+        """Ответ целиком или None, если LLM недоступна, перегружена или ответила ошибкой"""
+        if not self.api_key:
+            return None
+        
+        payload = self._payload(messages, lang, mode)
+        
+        try:
+            session = await self._get_session()
+            async with self.scheduler.slot(lane):
+                result = await self._with_retries(lambda: self._hedged(session, payload))
+            return result["choices"][0]["message"]["content"]
+        except (SchedulerBusy, CircuitOpen):
+            # Перегрузка или лежащий провайдер: отвечаем сразу, а не добавляем запрос в лавину 429
+            return None
         except Exception as e:
             print(f"AI error: {e}")
+            return None
+    
+    def resilience_stats(self) -> Dict:
+        stats = dict(self._resilience_stats)
+        stats["breaker"] = self.breaker.state
+        stats["breaker_rejected"] = self.breaker.rejected
+        stats.update(self.latency.stats())
+        return stats
+    
+    def _cache_key(self, messages: List[Dict], lang: str, mode: str) -> Optional[Tuple]:
+        return self.cache.key(messages, lang, mode) if self.cache else None
+    
+    async def get_response(self, messages: List[Dict], lang: str = "en", mode: str = "normal", lane: str = "free") -> str:
+        key = self._cache_key(messages, lang, mode)
+        cached = self.cache.get(key) if self.cache else None
+        if cached:
+            return cached
+        response = await self._complete(messages, lang, mode, lane)
+        if response is None:
             return self._fallback_response(lang)
+        if self.cache:
+            self.cache.put(key, response)
+        return response
+    
+    async def stream_response(self, messages: List[Dict], lang: str = "en", mode: str = "normal",
+                              lane: str = "free") -> AsyncIterator[str]:
+        """Ответ по частям из SSE-потока chat completions; если не пришло ни одного фрагмента — запасной ответ"""
+        key = self._cache_key(messages, lang, mode)
+        cached = self.cache.get(key) if self.cache else None
+        if cached:
+            yield cached
+            return
+        
+        if not self.api_key:
+            yield self._fallback_response(lang)
+            return
+        
+        # Поток читает отдельная задача: слот планировщика освобождается на [DONE],
+        # а не когда потребитель допишет ответ с паузами между edit_text
+        payload = dict(self._payload(messages, lang, mode), stream=True)
+        queue: asyncio.Queue = asyncio.Queue()
+        reader = asyncio.create_task(self._read_stream(payload, lane, key, queue))
+        produced = False
+        try:
+            while True:
+                delta = await queue.get()
+                if delta is None:
+                    break
+                produced = True
+                yield delta
+        finally:
+            # Потребитель бросил поток на середине — незачем держать слот и соединение
+            reader.cancel()
+        if not produced:
+            yield self._fallback_response(lang)
+    
+    async def _read_stream(self, payload: Dict, lane: str, key: Optional[Tuple], queue: asyncio.Queue):
+        """Фрагменты SSE-потока в очередь; None в очереди — поток закончился (или не начался)"""
+        produced = []
+        try:
+            session = await self._get_session()
+            async with self.scheduler.slot(lane):
+                # Повторяется только открытие потока: после первого фрагмента пользователь уже видит текст
+                resp = await self._with_retries(lambda: self._open_stream(session, payload))
+                async with resp:
+                    # Строки вида `data: {...}`, поток завершается `data: [DONE]`
+                    async for line in resp.content:
+                        line = line.strip()
+                        if not line.startswith(b"data:"):
+                            continue
+                        data = line[5:].strip()
+                        if data == b"[DONE]":
+                            # Поток дошёл до конца — ответ полный, его можно класть в кэш
+                            if produced and self.cache:
+                                self.cache.put(key, "".join(produced))
+                            break
+                        delta = json.loads(data)["choices"][0].get("delta", {}).get("content")
+                        if delta:
+                            produced.append(delta)
+                            queue.put_nowait(delta)
+        except (SchedulerBusy, CircuitOpen):
+            pass
+        except Exception as e:
+            print(f"AI stream error: {e}")
+        finally:
+            queue.put_nowait(None)
+    
+    async def stream_sleep_story(self, lang: str = "en") -> AsyncIterator[str]:
+        prompt = self.story_prompts.get(lang, self.story_prompts["en"])
+        async for chunk in self.stream_response([{"role": "user", "content": prompt}], lang, "story", lane="story"):
+            yield chunk
     
-    async def generate_sleep_story(self, lang: str = "en") -> str:
+    async def generate_sleep_story(self, lang: str = "en", fallback: bool = True) -> Optional[str]:
+        """История на языке пользователя; с fallback=False при ошибке возвращает None (для пула историй)"""
         prompt = self.story_prompts.get(lang, self.story_prompts["en"])
-        return await self.get_response([{"role": "user", "content": prompt}], lang, "story")
+        # Истории — самая низкая полоса: ждут, пока отвечают на сообщения
+        story = await self._complete([{"role": "user", "content": prompt}], lang, "story", lane="story")
+        return story or (self._fallback_response(lang) if fallback else None)
     
     def _fallback_response(self, lang: str) -> str:
         fallbacks = {
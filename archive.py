@@ -0,0 +1,159 @@
+import heapq
+import os
+import re
+import sqlite3
+import time
+from datetime import datetime, timedelta
+from typing import Dict, Iterator, List, Optional, Tuple
+
+from config import config
+from migrations import shard_paths
+
+class Archiver:
+    """Переносит старые conversations/analytics_events в помесячные архивные БД (archive/YYYY_MM[.shardN].db)"""
+
+    TABLES = ("conversations", "analytics_events")
+    _ARCHIVE_FILE = re.compile(r"^(\d{4}_\d{2})(?:\.shard\d+)?\.db$")
+
+    def __init__(self, db_path: str = "night_whisper.db", archive_dir: str = "archive",
+                 horizon_days: int = 90, batch_size: int = 5000, shards: int = 1):
+        self.db_path = db_path
+        self.shard_paths = shard_paths(db_path, shards)
+        self.archive_dir = archive_dir
+        self.horizon_days = horizon_days
+        self.batch_size = batch_size
+
+    def archive_path(self, month: str, shard: int = 0) -> str:
+        # id уникальны только внутри шарда — у каждого шарда свой архивный файл
+        name = f"{month}.db" if shard == 0 else f"{month}.shard{shard}.db"
+        return os.path.join(self.archive_dir, name)
+
+    def archive_months(self) -> List[str]:
+        """Месяцы, для которых есть архивные файлы, от старых к новым"""
+        if not os.path.isdir(self.archive_dir):
+            return []
+        months = {match.group(1) for match in map(self._ARCHIVE_FILE.match, os.listdir(self.archive_dir)) if match}
+        return sorted(months)
+
+    def _cutoff(self) -> str:
+        # Формат CURRENT_TIMESTAMP (UTC) — так же, как хранится timestamp
+        return time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime(time.time() - self.horizon_days * 86400))
+
+    @staticmethod
+    def _month_bounds(month: str) -> Tuple[str, str]:
+        start = datetime.strptime(month, "%Y_%m")
+        end = (start + timedelta(days=32)).replace(day=1)
+        return start.strftime("%Y-%m-%d"), end.strftime("%Y-%m-%d")
+
+    def run(self) -> Dict[str, int]:
+        """Один проход архивации. Дневные предагрегаты не трогаем — статистика остаётся полной."""
+        os.makedirs(self.archive_dir, exist_ok=True)
+        cutoff = self._cutoff()
+        moved = {table: 0 for table in self.TABLES}
+
+        for shard, path in enumerate(self.shard_paths):
+            conn = sqlite3.connect(path, isolation_level=None, timeout=30)
+            try:
+                for table in self.TABLES:
+                    months = [row[0] for row in conn.execute(
+                        f"SELECT DISTINCT strftime('%Y_%m', timestamp) FROM {table} WHERE timestamp < ?", (cutoff,)
+                    ) if row[0]]
+                    for month in months:
+                        moved[table] += self._archive_month(conn, table, month, cutoff, shard)
+            finally:
+                conn.close()
+        return moved
+
+    def _archive_month(self, conn: sqlite3.Connection, table: str, month: str, cutoff: str, shard: int = 0) -> int:
+        start, end = self._month_bounds(month)
+        end = min(end, cutoff)
+        moved = 0
+
+        conn.execute("ATTACH DATABASE ? AS arc", (self.archive_path(month, shard),))
+        try:
+            conn.execute(f"CREATE TABLE IF NOT EXISTS arc.{table} AS SELECT * FROM main.{table} WHERE 0")
+            conn.execute(f"CREATE UNIQUE INDEX IF NOT EXISTS arc.idx_{table}_id ON {table}(id)")
+            conn.execute(f"CREATE INDEX IF NOT EXISTS arc.idx_{table}_time ON {table}(timestamp)")
+            conn.execute(f"CREATE INDEX IF NOT EXISTS arc.idx_{table}_user ON {table}(user_id)")
+
+            # Короткие транзакции пачками, чтобы не держать блокировку записи у бота
+            while True:
+                conn.execute("BEGIN IMMEDIATE")
+                try:
+                    ids = [row[0] for row in conn.execute(
+                        f"SELECT id FROM main.{table} WHERE timestamp >= ? AND timestamp < ? ORDER BY timestamp LIMIT ?",
+                        (start, end, self.batch_size)
+                    )]
+                    if ids:
+                        placeholders = ",".join("?" * len(ids))
+                        conn.execute(
+                            f"INSERT OR IGNORE INTO arc.{table} SELECT * FROM main.{table} WHERE id IN ({placeholders})", ids
+                        )
+                        conn.execute(f"DELETE FROM main.{table} WHERE id IN ({placeholders})", ids)
+                    conn.execute("COMMIT")
+                except Exception:
+                    conn.execute("ROLLBACK")
+                    raise
+                moved += len(ids)
+                if len(ids) < self.batch_size:
+                    break
+        finally:
+            conn.execute("DETACH DATABASE arc")
+        return moved
+
+    def iter_rows(self, table: str, since: Optional[str] = None, until: Optional[str] = None,
+                  user_id: Optional[int] = None, include_archive: bool = True) -> Iterator[sqlite3.Row]:
+        """Строки таблицы за период по возрастанию времени: в каждом шарде сначала архивы, затем основная БД"""
+        if table not in self.TABLES:
+            raise ValueError(f"Unknown archived table: {table}")
+
+        where, params = ["1 = 1"], []
+        if since:
+            where.append("timestamp >= ?")
+            params.append(since)
+        if until:
+            where.append("timestamp < ?")
+            params.append(until)
+        if user_id is not None:
+            where.append("user_id = ?")
+            params.append(user_id)
+        query = f"SELECT * FROM {table} WHERE {' AND '.join(where)} ORDER BY timestamp, id"
+
+        months = []
+        if include_archive:
+            for month in self.archive_months():
+                start, end = self._month_bounds(month)
+                if not ((until and start >= until) or (since and end <= since)):
+                    months.append(month)
+
+        # Строки пользователя лежат только в его шарде (user_id % числа шардов, как в Database.shard_for)
+        shard_ids = [user_id % len(self.shard_paths)] if user_id is not None else range(len(self.shard_paths))
+        shards = []
+        for shard in shard_ids:
+            path = self.shard_paths[shard]
+            sources = [f"file:{self.archive_path(month, shard)}?mode=ro" for month in months
+                       if os.path.exists(self.archive_path(month, shard))]
+            sources.append(f"file:{path}?mode=ro")
+            shards.append(self._iter_sources(sources, table, query, params))
+        if len(shards) == 1:
+            yield from shards[0]
+        else:
+            yield from heapq.merge(*shards, key=lambda row: (row["timestamp"], row["id"]))
+
+    @staticmethod
+    def _iter_sources(sources: List[str], table: str, query: str, params: List) -> Iterator[sqlite3.Row]:
+        for source in sources:
+            conn = sqlite3.connect(source, uri=True)
+            conn.row_factory = sqlite3.Row
+            try:
+                exists = conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", (table,)).fetchone()
+                if exists:
+                    yield from conn.execute(query, params)
+            finally:
+                conn.close()
+
+archiver = Archiver(config.DB_PATH, config.ARCHIVE_DIR, config.ARCHIVE_AFTER_DAYS, config.ARCHIVE_BATCH_SIZE,
+                    config.DB_SHARDS)
+
+if __name__ == "__main__":
+    print(f"Archived: {archiver.run()}")
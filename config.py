@@ -9,9 +9,92 @@ load_dotenv()
 class Config:
     BOT_TOKEN: str = os.getenv("BOT_TOKEN", "")
     GROQ_API_KEY: str = os.getenv("GROQ_API_KEY", "")
+    # Базовый URL OpenAI-совместимого API; для проверок можно направить на локальную заглушку
+    GROQ_BASE_URL: str = os.getenv("GROQ_BASE_URL", "https://api.groq.com/openai/v1")
     ADMIN_ID: int = int(os.getenv("ADMIN_ID", "0"))
     ADMIN_SECRET: str = os.getenv("ADMIN_SECRET", "admin123")
     WEB_ADMIN_PORT: int = int(os.getenv("WEB_ADMIN_PORT", "7860"))
+    # Языки, которые можно выбрать в боте (/start и настройки)
+    LANGUAGES: tuple = ("ru", "en")
+    
+    # База данных: sqlite или memory (хранилище в памяти процесса, для замеров)
+    STORAGE_BACKEND: str = os.getenv("STORAGE_BACKEND", "sqlite")
+    DB_PATH: str = os.getenv("DB_PATH", "night_whisper.db")
+    # Число файлов-шардов для пользовательских таблиц; менять только на пустой базе (перебалансировки нет)
+    DB_SHARDS: int = int(os.getenv("DB_SHARDS", "1"))
+    DB_CACHE_SIZE_KB: int = int(os.getenv("DB_CACHE_SIZE_KB", "16384"))
+    DB_MMAP_SIZE_MB: int = int(os.getenv("DB_MMAP_SIZE_MB", "128"))
+    DB_CACHED_STATEMENTS: int = int(os.getenv("DB_CACHED_STATEMENTS", "256"))
+    DB_BUSY_TIMEOUT_MS: int = int(os.getenv("DB_BUSY_TIMEOUT_MS", "5000"))
+    DB_READER_THREADS: int = int(os.getenv("DB_READER_THREADS", "4"))
+    USER_CACHE_SIZE: int = int(os.getenv("USER_CACHE_SIZE", "10000"))
+    USER_CACHE_TTL_SECONDS: int = int(os.getenv("USER_CACHE_TTL_SECONDS", "300"))
+    # Как часто подхватывать изменения users из других процессов (админ-панель): кэш и блок-лист отстают не больше
+    USER_CHANGES_SYNC_SECONDS: float = float(os.getenv("USER_CHANGES_SYNC_SECONDS", "2"))
+    WRITE_BEHIND_INTERVAL_MS: int = int(os.getenv("WRITE_BEHIND_INTERVAL_MS", "200"))
+    WRITE_BEHIND_MAX_BATCH: int = int(os.getenv("WRITE_BEHIND_MAX_BATCH", "500"))
+    WRITE_BEHIND_MAX_PENDING: int = int(os.getenv("WRITE_BEHIND_MAX_PENDING", "10000"))
+    
+    # Архив старых диалогов и событий
+    ARCHIVE_DIR: str = os.getenv("ARCHIVE_DIR", "archive")
+    ARCHIVE_AFTER_DAYS: int = int(os.getenv("ARCHIVE_AFTER_DAYS", "90"))
+    ARCHIVE_INTERVAL_HOURS: int = int(os.getenv("ARCHIVE_INTERVAL_HOURS", "24"))
+    ARCHIVE_BATCH_SIZE: int = int(os.getenv("ARCHIVE_BATCH_SIZE", "5000"))
+    EXPORT_BATCH_SIZE: int = int(os.getenv("EXPORT_BATCH_SIZE", "2000"))
+    
+    # HTTP-пул к Groq: одна сессия на процесс, keep-alive соединения
+    HTTP_POOL_LIMIT: int = int(os.getenv("HTTP_POOL_LIMIT", "100"))
+    HTTP_POOL_LIMIT_PER_HOST: int = int(os.getenv("HTTP_POOL_LIMIT_PER_HOST", "32"))
+    HTTP_KEEPALIVE_SECONDS: float = float(os.getenv("HTTP_KEEPALIVE_SECONDS", "60"))
+    HTTP_DNS_CACHE_SECONDS: int = int(os.getenv("HTTP_DNS_CACHE_SECONDS", "300"))
+    
+    # Планировщик запросов к LLM: общий лимит параллельности и очередь по приоритетам
+    LLM_MAX_CONCURRENCY: int = int(os.getenv("LLM_MAX_CONCURRENCY", "8"))
+    LLM_MAX_QUEUE: int = int(os.getenv("LLM_MAX_QUEUE", "200"))
+    LLM_QUEUE_TIMEOUT_SECONDS: float = float(os.getenv("LLM_QUEUE_TIMEOUT_SECONDS", "20"))
+    
+    # Окно истории для LLM: бюджет входных токенов (с системным промптом), потолок одной реплики, реплик в сессии
+    LLM_CONTEXT_BUDGET_TOKENS: int = int(os.getenv("LLM_CONTEXT_BUDGET_TOKENS", "1500"))
+    LLM_MAX_TURN_TOKENS: int = int(os.getenv("LLM_MAX_TURN_TOKENS", "400"))
+    LLM_HISTORY_MAX_MESSAGES: int = int(os.getenv("LLM_HISTORY_MAX_MESSAGES", "20"))
+    
+    # Устойчивость запросов к LLM: таймаут попытки, повторы на 429/5xx, предохранитель, дублирующие запросы
+    LLM_TIMEOUT_SECONDS: float = float(os.getenv("LLM_TIMEOUT_SECONDS", "20"))
+    LLM_RETRY_ATTEMPTS: int = int(os.getenv("LLM_RETRY_ATTEMPTS", "3"))
+    LLM_RETRY_BASE_DELAY: float = float(os.getenv("LLM_RETRY_BASE_DELAY", "0.5"))
+    LLM_RETRY_MAX_DELAY: float = float(os.getenv("LLM_RETRY_MAX_DELAY", "8"))
+    LLM_BREAKER_FAILURES: int = int(os.getenv("LLM_BREAKER_FAILURES", "5"))
+    LLM_BREAKER_RESET_SECONDS: float = float(os.getenv("LLM_BREAKER_RESET_SECONDS", "30"))
+    LLM_HEDGE_ENABLED: bool = os.getenv("LLM_HEDGE_ENABLED", "0") == "1"
+    LLM_HEDGE_MIN_DELAY: float = float(os.getenv("LLM_HEDGE_MIN_DELAY", "1.0"))
+    
+    # Потоковые ответы: текст появляется по мере генерации, правки сообщения не чаще интервала
+    STREAM_RESPONSES: bool = os.getenv("STREAM_RESPONSES", "1") == "1"
+    STREAM_EDIT_INTERVAL_SECONDS: float = float(os.getenv("STREAM_EDIT_INTERVAL_SECONDS", "1.0"))
+    
+    # Кэш ответов на типовые первые сообщения (выключен по умолчанию); режим исповеди не кэшируется никогда
+    RESPONSE_CACHE_ENABLED: bool = os.getenv("RESPONSE_CACHE_ENABLED", "0") == "1"
+    RESPONSE_CACHE_MAX_ENTRIES: int = int(os.getenv("RESPONSE_CACHE_MAX_ENTRIES", "2000"))
+    RESPONSE_CACHE_TTL_SECONDS: int = int(os.getenv("RESPONSE_CACHE_TTL_SECONDS", "21600"))
+    RESPONSE_CACHE_VARIANTS: int = int(os.getenv("RESPONSE_CACHE_VARIANTS", "3"))
+    RESPONSE_CACHE_MAX_TURNS: int = int(os.getenv("RESPONSE_CACHE_MAX_TURNS", "1"))
+    RESPONSE_CACHE_MAX_CHARS: int = int(os.getenv("RESPONSE_CACHE_MAX_CHARS", "120"))
+    
+    # Пул готовых сонных историй: глубина на язык, срок свежести, сколько разных людей получат одну историю
+    STORY_POOL_DEPTH: int = int(os.getenv("STORY_POOL_DEPTH", "5"))
+    STORY_POOL_MAX_AGE_HOURS: float = float(os.getenv("STORY_POOL_MAX_AGE_HOURS", "24"))
+    STORY_POOL_MAX_SERVES: int = int(os.getenv("STORY_POOL_MAX_SERVES", "20"))
+    STORY_POOL_REFILL_SECONDS: float = float(os.getenv("STORY_POOL_REFILL_SECONDS", "60"))
+    
+    # Голосовые: проверяются до скачивания, файл идёт из Telegram в Whisper потоком кусками по VOICE_CHUNK_BYTES
+    VOICE_MAX_SECONDS: int = int(os.getenv("VOICE_MAX_SECONDS", "300"))
+    VOICE_MAX_BYTES: int = int(os.getenv("VOICE_MAX_BYTES", str(10 * 1024 * 1024)))
+    VOICE_CHUNK_BYTES: int = int(os.getenv("VOICE_CHUNK_BYTES", "65536"))
+    VOICE_TIMEOUT_SECONDS: int = int(os.getenv("VOICE_TIMEOUT_SECONDS", "60"))
+    # Кэш распознанных голосовых по file_unique_id: пересланное голосовое не скачивается и не распознаётся заново
+    TRANSCRIPTION_CACHE_MAX_ENTRIES: int = int(os.getenv("TRANSCRIPTION_CACHE_MAX_ENTRIES", "20000"))
+    # 1 — распознавать на языке пользователя, 0 — всегда автоопределение Whisper
+    VOICE_LANGUAGE_HINT: bool = os.getenv("VOICE_LANGUAGE_HINT", "1") == "1"
     
     # Ночное время (теперь не используется, но оставлено для совместимости)
     NIGHT_START: time = time(22, 0)
@@ -19,10 +102,22 @@ class Config:
     
     # Лимиты
     FREE_MESSAGES_PER_NIGHT: int = 3
+    FREE_STORIES_PER_DAY: int = 1
+    FREE_CONFESSIONS_PER_DAY: int = 1
     PREMIUM_PRICE_STARS: int = 150
     SESSION_PRICE_STARS: int = 50
     SESSION_DURATION_MINUTES: int = 40
     
+    # Антифлуд (token bucket): запросов в минуту и размер всплеска
+    RATE_MESSAGES_PER_MINUTE: float = float(os.getenv("RATE_MESSAGES_PER_MINUTE", "20"))
+    RATE_MESSAGES_BURST: int = int(os.getenv("RATE_MESSAGES_BURST", "5"))
+    RATE_STORIES_PER_MINUTE: float = float(os.getenv("RATE_STORIES_PER_MINUTE", "2"))
+    RATE_STORIES_BURST: int = int(os.getenv("RATE_STORIES_BURST", "2"))
+    RATE_CALLBACKS_PER_MINUTE: float = float(os.getenv("RATE_CALLBACKS_PER_MINUTE", "60"))
+    RATE_CALLBACKS_BURST: int = int(os.getenv("RATE_CALLBACKS_BURST", "10"))
+    RATE_LIMIT_MAX_BUCKETS: int = int(os.getenv("RATE_LIMIT_MAX_BUCKETS", "50000"))
+    RATE_LIMIT_IDLE_SECONDS: int = int(os.getenv("RATE_LIMIT_IDLE_SECONDS", "600"))
+    
     # Рефералы
     REFERRAL_BONUS_MESSAGES: int = 5
     REFERRAL_BONUS_PREMIUM_DAYS: int = 3
@@ -0,0 +1,50 @@
+from functools import lru_cache
+from typing import Dict, List
+
+# Служебные токены роли и разделителей на каждое сообщение
+MESSAGE_OVERHEAD_TOKENS = 4
+
+@lru_cache(maxsize=8192)
+def estimate_tokens(text: str) -> int:
+    """Оценка без токенизатора: ~4 байта UTF-8 на токен (кириллица — 2 байта на букву, поэтому дороже латиницы)"""
+    return (len(text.encode("utf-8")) + 3) // 4
+
+class ContextBuilder:
+    """Окно истории под бюджет входных токенов: от новых реплик к старым, слишком длинные реплики обрезаются"""
+
+    def __init__(self, budget_tokens: int = 1500, max_turn_tokens: int = 400, max_messages: int = 20):
+        self.budget_tokens = budget_tokens
+        self.max_turn_tokens = max_turn_tokens
+        self.max_messages = max_messages
+
+    def message_tokens(self, message: Dict) -> int:
+        # Счёт кэшируется по тексту: одна и та же реплика пересчитывается на каждом ходе диалога
+        return estimate_tokens(message["content"]) + MESSAGE_OVERHEAD_TOKENS
+
+    def truncate(self, message: Dict, max_tokens: int) -> Dict:
+        """Копия реплики, укороченная до max_tokens; начало сохраняется — в нём обычно суть"""
+        text = message["content"]
+        tokens = estimate_tokens(text)
+        if tokens <= max_tokens:
+            return message
+        # Один токен оставляем под многоточие
+        chars = max(1, len(text) * (max_tokens - 1) // tokens)
+        return {"role": message["role"], "content": text[:chars].rstrip() + "…"}
+
+    def build(self, system: Dict, messages: List[Dict]) -> List[Dict]:
+        """Системный промпт + самые свежие реплики, суммарно не больше budget_tokens"""
+        remaining = self.budget_tokens - self.message_tokens(system)
+        window = []
+        for message in reversed(messages[-self.max_messages:]):
+            message = self.truncate(message, self.max_turn_tokens)
+            tokens = self.message_tokens(message)
+            if tokens > remaining:
+                if not window:
+                    # Последняя реплика пользователя попадает в запрос всегда — хотя бы обрезанной
+                    message = self.truncate(message, max(1, remaining - MESSAGE_OVERHEAD_TOKENS))
+                    window.append(message)
+                break
+            window.append(message)
+            remaining -= tokens
+        window.reverse()
+        return [system] + window
\ No newline at end of file
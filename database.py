@@ -1,349 +1,888 @@
 import sqlite3
 import json
+import os
+import asyncio
+import atexit
+import functools
+import heapq
+import itertools
+import queue
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
-from typing import Optional, Dict, List, Tuple
+from typing import Callable, Iterator, Optional, Dict, List, Tuple
+from config import config
+from archive import archiver
+from migrations import migrate, shard_paths
+from storage import QUOTA_LIMITS, MemoryStorage, Storage, premium_active, trial_active
+
+def _utc_timestamp() -> str:
+    # Тот же формат, что у CURRENT_TIMESTAMP, но время фиксируется в момент события
+    return time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime())
+
+def _utc_day(days_ago: int = 0) -> str:
+    """Дата (UTC) N дней назад — ключ дневных предагрегатов"""
+    return time.strftime("%Y-%m-%d", time.gmtime(time.time() - days_ago * 86400))
+
+# Весь SQL Database — константами модуля: migrations.check_query_plans проверяет планы именно этих строк
+
+# Даты хранятся как секунды Unix (*_ts, migrations шаг 5)
+USER_COLUMNS = (
+    "user_id", "username", "language", "premium_until_ts", "is_premium", "created_at_ts",
+    "last_active_ts", "total_messages", "referrer_id", "referral_count", "bonus_messages",
+    "is_blocked", "trial_until_ts", "trial_used"
+)
+
+# Пользователи
+INSERT_USER_SQL = """INSERT INTO users (user_id, username, language, referrer_id, trial_until_ts, created_at_ts, last_active_ts)
+                     VALUES (?, ?, ?, ?, ?, ?, ?)"""
+GET_USER_SQL = f"SELECT {', '.join(USER_COLUMNS)} FROM users WHERE user_id = ?"
+SET_LANGUAGE_SQL = "UPDATE users SET language = ? WHERE user_id = ?"
+BLOCK_USER_SQL = "UPDATE users SET is_blocked = ? WHERE user_id = ?"
+USER_BLOCKED_SQL = "SELECT is_blocked FROM users WHERE user_id = ?"
+BLOCKLIST_SQL = "SELECT user_id FROM users WHERE is_blocked = 1"
+UPDATE_ACTIVITY_SQL = "UPDATE users SET last_active_ts = ?, total_messages = total_messages + ? WHERE user_id = ?"
+ADD_BONUS_MESSAGES_SQL = "UPDATE users SET bonus_messages = bonus_messages + ? WHERE user_id = ?"
+END_TRIAL_SQL = "UPDATE users SET trial_used = 1 WHERE user_id = ?"
+ADD_PREMIUM_SQL = """UPDATE users SET premium_until_ts = MAX(COALESCE(premium_until_ts, 0), ?) + ?, is_premium = 1
+                     WHERE user_id = ? RETURNING premium_until_ts"""
+REMOVE_PREMIUM_SQL = "UPDATE users SET is_premium = 0, premium_until_ts = NULL WHERE user_id = ?"
+USER_CHANGES_SQL = "SELECT id, user_id FROM user_changes WHERE id > ? ORDER BY id"
+LAST_USER_CHANGE_SQL = "SELECT COALESCE(MAX(id), 0) FROM user_changes"
+
+# Квоты
+_CONSUME_QUOTA_SQL = """INSERT INTO quotas (user_id, action, day, used) VALUES (?, ?, ?, 1)
+                        ON CONFLICT (user_id, action) DO UPDATE SET
+                            used = CASE WHEN day = excluded.day THEN used + 1 ELSE 1 END,
+                            day = excluded.day
+                        WHERE day != excluded.day OR used < {limit}
+                        RETURNING used"""
+CONSUME_QUOTA_SQL = _CONSUME_QUOTA_SQL.format(limit="?")
+# Бонусные сообщения (рефералы, админ) расширяют дневной лимит сообщений
+CONSUME_MESSAGE_QUOTA_SQL = _CONSUME_QUOTA_SQL.format(
+    limit="? + COALESCE((SELECT bonus_messages FROM users WHERE user_id = excluded.user_id), 0)"
+)
+REFUND_QUOTA_SQL = "UPDATE quotas SET used = MAX(used - 1, 0) WHERE user_id = ? AND action = ?"
+QUOTA_LEFT_SQL = """SELECT CASE WHEN q.day = ? THEN q.used ELSE 0 END, COALESCE(u.bonus_messages, 0)
+                    FROM users u LEFT JOIN quotas q ON q.user_id = u.user_id AND q.action = ?
+                    WHERE u.user_id = ?"""
+
+# Сессии и диалоги
+START_SESSION_SQL = "INSERT INTO sessions (user_id, is_confessional, end_time) VALUES (?, ?, ?)"
+ACTIVE_SESSION_SQL = "SELECT id, is_confessional FROM sessions WHERE user_id = ? AND is_active = 1 ORDER BY id DESC LIMIT 1"
+END_SESSION_SQL = "UPDATE sessions SET is_active = 0 WHERE id = ? AND user_id = ?"
+INSERT_MESSAGE_SQL = ("INSERT INTO conversations (user_id, session_id, content, is_user, is_confessional, timestamp) "
+                      "VALUES (?, ?, ?, ?, ?, ?)")
+INSERT_EVENT_SQL = "INSERT INTO analytics_events (user_id, event_type, event_data, timestamp) VALUES (?, ?, ?, ?)"
+
+# Рефералы (нулевой шард)
+INSERT_REFERRAL_SQL = "INSERT INTO referrals (referrer_id, referred_id) VALUES (?, ?)"
+CONVERT_REFERRAL_SQL = """UPDATE referrals SET status = 'converted', converted_at = ?
+                          WHERE referred_id = ? AND status = 'pending' RETURNING referrer_id"""
+CREDIT_REFERRER_SQL = "UPDATE users SET referral_count = referral_count + 1, bonus_messages = bonus_messages + 5 WHERE user_id = ?"
+REFERRAL_STATS_SQL = "SELECT COUNT(*), SUM(CASE WHEN status = 'converted' THEN 1 ELSE 0 END) FROM referrals WHERE referrer_id = ?"
+
+# Статистика — только предагрегаты (migrations, шаги 3 и 9)
+NEW_USERS_SQL = "SELECT SUM(new_users) FROM daily_user_rollup WHERE day >= ?"
+COHORT_PREMIUM_SQL = "SELECT SUM(new_users), SUM(premium) FROM daily_user_rollup WHERE day >= ?"
+MESSAGES_SENT_SQL = "SELECT SUM(count) FROM daily_event_rollup WHERE event_type = 'message_sent' AND day >= ?"
+HOURLY_MESSAGES_SQL = "SELECT SUM(messages) FROM hourly_activity_rollup WHERE day >= ?"
+HOURLY_ACTIVITY_SQL = "SELECT hour, SUM(messages) FROM hourly_activity_rollup WHERE day >= ? GROUP BY hour"
+ACTIVE_PREMIUM_SQL = "SELECT SUM(users) FROM premium_rollup WHERE until_hour >= ?"
+LANGUAGES_SQL = "SELECT language, users FROM language_rollup"
+REFERRALS_SINCE_SQL = "SELECT COUNT(*), SUM(CASE WHEN status = 'converted' THEN 1 ELSE 0 END) FROM referrals WHERE created_at > ?"
+
+# Последние диалоги без текста: основная БД и подключённый архив (схема arc)
+_CONVERSATION_SUMMARY_SQL = """
+    SELECT c.id, c.timestamp, LENGTH(c.content), u.language
+    FROM {schema}.conversations c
+    JOIN main.users u ON c.user_id = u.user_id
+    ORDER BY c.timestamp DESC
+    LIMIT ?
+"""
+CONVERSATION_SUMMARY_SQL = _CONVERSATION_SUMMARY_SQL.format(schema="main")
+ARCHIVE_CONVERSATION_SUMMARY_SQL = _CONVERSATION_SUMMARY_SQL.format(schema="arc")
+ATTACH_ARCHIVE_SQL = "ATTACH DATABASE ? AS arc"
+DETACH_ARCHIVE_SQL = "DETACH DATABASE arc"
+
+# Keyset-страницы: параметры — (ключ..., фильтры..., LIMIT)
+ITER_INACTIVE_USERS_SQL = ("SELECT user_id, username, language, last_active_ts FROM users "
+                           "WHERE (last_active_ts, user_id) > (?, ?) AND is_blocked = 0 AND last_active_ts < ? "
+                           "ORDER BY last_active_ts, user_id LIMIT ?")
+ITER_USERS_SQL = "SELECT user_id, username, language FROM users WHERE user_id > ? AND is_blocked = 0 ORDER BY user_id LIMIT ?"
+ITER_ALL_USERS_SQL = "SELECT user_id, username, language FROM users WHERE user_id > ? ORDER BY user_id LIMIT ?"
+_REFERRAL_COLUMNS = "SELECT id, referrer_id, referred_id, status, created_at, converted_at FROM referrals "
+ITER_REFERRALS_SQL = _REFERRAL_COLUMNS + "WHERE id > ? ORDER BY id LIMIT ?"
+ITER_REFERRER_REFERRALS_SQL = _REFERRAL_COLUMNS + "WHERE id > ? AND referrer_id = ? ORDER BY id LIMIT ?"
+_CONVERSATION_COLUMNS = "SELECT id, user_id, session_id, content, is_user, is_confessional, timestamp FROM conversations "
+ITER_CONVERSATIONS_SQL = _CONVERSATION_COLUMNS + "WHERE id > ? ORDER BY id LIMIT ?"
+ITER_USER_CONVERSATIONS_SQL = _CONVERSATION_COLUMNS + "WHERE id > ? AND user_id = ? ORDER BY id LIMIT ?"
+ITER_SESSION_CONVERSATIONS_SQL = _CONVERSATION_COLUMNS + "WHERE id > ? AND session_id = ? ORDER BY id LIMIT ?"
+ITER_USER_SESSION_CONVERSATIONS_SQL = (_CONVERSATION_COLUMNS +
+                                       "WHERE id > ? AND user_id = ? AND session_id = ? ORDER BY id LIMIT ?")
+
+# Кэш распознавания голосовых и журнал админа (нулевой шард)
+GET_TRANSCRIPTION_SQL = "SELECT text FROM transcriptions WHERE file_unique_id = ? AND language = ?"
+SAVE_TRANSCRIPTION_SQL = """INSERT INTO transcriptions (file_unique_id, language, text, created_at_ts, last_used_ts)
+                            VALUES (?, ?, ?, ?, ?)
+                            ON CONFLICT (file_unique_id, language) DO UPDATE SET text = excluded.text, last_used_ts = excluded.last_used_ts"""
+TOUCH_TRANSCRIPTION_SQL = "UPDATE transcriptions SET last_used_ts = ? WHERE file_unique_id = ? AND language = ?"
+# Оставляем N самых свежих — проход по индексу last_used_ts
+EVICT_TRANSCRIPTIONS_SQL = """DELETE FROM transcriptions WHERE last_used_ts <
+                              (SELECT last_used_ts FROM transcriptions ORDER BY last_used_ts DESC LIMIT 1 OFFSET ?)"""
+INSERT_ADMIN_ACTION_SQL = "INSERT INTO admin_actions (admin_id, action_type, target_user_id, details) VALUES (?, ?, ?, ?)"
+
+class ConnectionManager:
+    """Долгоживущие соединения SQLite — по одному на поток, с WAL и настроенными PRAGMA"""
+    
+    def __init__(self, db_path: str, cache_size_kb: int = 16384, mmap_size_mb: int = 128,
+                 cached_statements: int = 256, busy_timeout_ms: int = 5000):
+        self.db_path = db_path
+        self.cache_size_kb = cache_size_kb
+        self.mmap_size_mb = mmap_size_mb
+        self.cached_statements = cached_statements
+        self.busy_timeout_ms = busy_timeout_ms
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._conns: List[sqlite3.Connection] = []
+    
+    def get(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(
+                self.db_path,
+                timeout=self.busy_timeout_ms / 1000,
+                cached_statements=self.cached_statements,
+                check_same_thread=False  # закрываем из любого потока в close_all()
+            )
+            self._configure(conn)
+            self._local.conn = conn
+            with self._lock:
+                self._conns.append(conn)
+        return conn
+    
+    def _configure(self, conn: sqlite3.Connection):
+        if self.db_path != ":memory:":
+            conn.execute("PRAGMA journal_mode = WAL")
+        conn.execute("PRAGMA synchronous = NORMAL")
+        conn.execute(f"PRAGMA cache_size = -{int(self.cache_size_kb)}")
+        conn.execute(f"PRAGMA mmap_size = {int(self.mmap_size_mb) * 1024 * 1024}")
+        conn.execute("PRAGMA temp_store = MEMORY")
+        conn.execute(f"PRAGMA busy_timeout = {int(self.busy_timeout_ms)}")
+    
+    def close_all(self):
+        with self._lock:
+            conns, self._conns = self._conns, []
+        for conn in conns:
+            try:
+                conn.close()
+            except sqlite3.Error:
+                pass
+        self._local = threading.local()
+
+class UserCache:
+    """Ограниченный LRU-кэш строк users с TTL; писатели обновляют или сбрасывают записи"""
+    
+    def __init__(self, max_size: int = 10000, ttl_seconds: float = 300):
+        self.max_size = max_size
+        self.ttl_seconds = ttl_seconds
+        self._data: "OrderedDict[int, Tuple[float, Dict]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._version = 0
+        self.hits = 0
+        self.misses = 0
+    
+    @property
+    def version(self) -> int:
+        return self._version
+    
+    def get(self, user_id: int) -> Optional[Dict]:
+        with self._lock:
+            entry = self._data.get(user_id)
+            if entry is None or entry[0] < time.monotonic():
+                if entry is not None:
+                    del self._data[user_id]
+                self.misses += 1
+                return None
+            self._data.move_to_end(user_id)
+            self.hits += 1
+            return dict(entry[1])
+    
+    def put(self, user_id: int, user: Dict, version: int):
+        with self._lock:
+            # Строку прочитали до записи другого потока — не кладём устаревшие данные
+            if version != self._version or self.max_size <= 0:
+                return
+            self._data[user_id] = (time.monotonic() + self.ttl_seconds, dict(user))
+            self._data.move_to_end(user_id)
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+    
+    def update(self, user_id: int, mutate: Callable[[Dict], None]):
+        with self._lock:
+            self._version += 1
+            entry = self._data.get(user_id)
+            if entry is not None:
+                mutate(entry[1])
+    
+    def invalidate(self, user_id: int):
+        with self._lock:
+            self._version += 1
+            self._data.pop(user_id, None)
+    
+    def clear(self):
+        with self._lock:
+            self._version += 1
+            self._data.clear()
+    
+    def stats(self) -> Dict:
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "size": len(self._data),
+                "max_size": self.max_size,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": f"{(self.hits/total*100):.1f}%" if total else "0%"
+            }
+
+class WriteBehindQueue:
+    """Копит мелкие записи и фиксирует их пачкой: раз в interval_ms или по max_batch строк"""
+    
+    _STOP = object()
+    
+    def __init__(self, flush: Callable[[List[Tuple[str, tuple]]], None], interval_ms: int = 200,
+                 max_batch: int = 500, max_pending: int = 10000, name: str = "db-write-behind"):
+        self._flush = flush
+        self.interval = interval_ms / 1000
+        self.max_batch = max_batch
+        # Ограниченная очередь: при переполнении put() ждёт — это и есть backpressure
+        self._queue: "queue.Queue" = queue.Queue(maxsize=max_pending)
+        self._closed = False
+        self.dropped = 0
+        self._thread = threading.Thread(target=self._run, name=name, daemon=True)
+        self._thread.start()
+    
+    def put(self, kind: str, params: tuple):
+        if self._closed:
+            # После close() пулы соединений уже закрыты — не открываем БД заново, а теряем запись громко
+            self.dropped += 1
+            print(f"Write-behind is closed, dropped {kind} write ({self.dropped} total)")
+            return
+        self._queue.put((kind, params))
+    
+    def pending(self) -> int:
+        return self._queue.qsize()
+    
+    def flush(self):
+        """Ждёт, пока всё поставленное в очередь будет записано"""
+        if not self._closed:
+            self._queue.join()
+    
+    def close(self):
+        if self._closed:
+            return
+        self._closed = True
+        self._queue.put(self._STOP)
+        self._thread.join()
+    
+    def _run(self):
+        stop = False
+        while not stop:
+            item = self._queue.get()
+            if item is self._STOP:
+                self._queue.task_done()
+                break
+            batch = [item]
+            deadline = time.monotonic() + self.interval
+            while len(batch) < self.max_batch:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    item = self._queue.get(timeout=remaining)
+                except queue.Empty:
+                    break
+                if item is self._STOP:
+                    stop = True
+                    self._queue.task_done()
+                    break
+                batch.append(item)
+            try:
+                self._flush(batch)
+            except Exception as e:
+                print(f"Write-behind flush error ({len(batch)} rows): {e}")
+            finally:
+                for _ in batch:
+                    self._queue.task_done()
 
 class Database:
-    def __init__(self, db_path: str = "night_whisper.db"):
+    """SQLite-реализация storage.Storage"""
+    
+    # Дневные лимиты бесплатной версии по действиям (quotas)
+    QUOTA_LIMITS = QUOTA_LIMITS
+    
+    USER_COLUMNS = USER_COLUMNS
+    
+    def __init__(self, db_path: str = "night_whisper.db", shards: int = 1):
         self.db_path = db_path
+        # users, sessions, conversations, quotas и analytics_events лежат в шарде user_id;
+        # referrals и admin_actions — общие, в нулевом шарде (он же db_path)
+        self.shard_paths = shard_paths(db_path, shards)
+        self.shards = len(self.shard_paths)
+        self._cache = UserCache(config.USER_CACHE_SIZE, config.USER_CACHE_TTL_SECONDS)
+        self._pools = [
+            ConnectionManager(
+                path,
+                cache_size_kb=config.DB_CACHE_SIZE_KB,
+                mmap_size_mb=config.DB_MMAP_SIZE_MB,
+                cached_statements=config.DB_CACHED_STATEMENTS,
+                busy_timeout_ms=config.DB_BUSY_TIMEOUT_MS
+            )
+            for path in self.shard_paths
+        ]
         self._init_db()
+        self._blocked = self._load_blocklist()
+        # Последний увиденный id журнала user_changes по шардам — всё, что было до старта, кэш и так не видел
+        self._change_ids = [
+            conn.execute(LAST_USER_CHANGE_SQL).fetchone()[0] for conn in self._shard_conns()
+        ]
+        self._sync_lock = threading.Lock()
+        self._next_sync = time.monotonic() + config.USER_CHANGES_SYNC_SECONDS
+        # Своя очередь и свой поток записи на каждый шард — у каждого файла свой writer lock
+        self._write_behind = [
+            WriteBehindQueue(
+                functools.partial(self._flush_writes, shard),
+                interval_ms=config.WRITE_BEHIND_INTERVAL_MS,
+                max_batch=config.WRITE_BEHIND_MAX_BATCH,
+                max_pending=config.WRITE_BEHIND_MAX_PENDING,
+                name=f"db-write-behind-{shard}"
+            )
+            for shard in range(self.shards)
+        ]
+        for queue_ in self._write_behind:
+            atexit.register(queue_.close)
+    
+    def shard_for(self, user_id: int) -> int:
+        return user_id % self.shards
     
-    def _get_conn(self):
-        return sqlite3.connect(self.db_path)
+    def _get_conn(self, user_id: Optional[int] = None):
+        # Соединение переиспользуется; `with conn:` только фиксирует транзакцию.
+        # Без user_id — нулевой шард с общими таблицами.
+        shard = 0 if user_id is None else self.shard_for(user_id)
+        return self._pools[shard].get()
+    
+    def _shard_conns(self) -> List[sqlite3.Connection]:
+        return [pool.get() for pool in self._pools]
+    
+    def close(self):
+        for queue_ in self._write_behind:
+            queue_.close()
+        for pool in self._pools:
+            pool.close_all()
+    
+    def flush(self):
+        for queue_ in self._write_behind:
+            queue_.flush()
+    
+    def _queue_write(self, user_id: int, kind: str, params: tuple):
+        self._write_behind[self.shard_for(user_id)].put(kind, params)
+    
+    def _flush_writes(self, shard: int, batch: List[Tuple[str, tuple]]):
+        """Одна транзакция на пачку: executemany по каждому виду записи"""
+        messages = [params for kind, params in batch if kind == "message"]
+        events = [params for kind, params in batch if kind == "event"]
+        # Отметки использования кэша распознавания: последняя по ключу
+        transcriptions_used = {(params[1], params[2]): params[0] for kind, params in batch if kind == "transcription_used"}
+        activity: Dict[int, List] = {}
+        for kind, params in batch:
+            if kind == "active":
+                user_id, last_active = params
+                entry = activity.setdefault(user_id, [last_active, 0])
+                entry[0] = last_active
+                entry[1] += 1
+        
+        with self._pools[shard].get() as conn:
+            if messages:
+                conn.executemany(INSERT_MESSAGE_SQL, messages)
+            if events:
+                conn.executemany(INSERT_EVENT_SQL, events)
+            if transcriptions_used:
+                conn.executemany(
+                    TOUCH_TRANSCRIPTION_SQL,
+                    [(used, file_unique_id, language) for (file_unique_id, language), used in transcriptions_used.items()]
+                )
+            if activity:
+                conn.executemany(
+                    UPDATE_ACTIVITY_SQL,
+                    [(last_active, count, user_id) for user_id, (last_active, count) in activity.items()]
+                )
+    
+    def cache_stats(self) -> Dict:
+        return self._cache.stats()
     
     def _init_db(self):
-        with self._get_conn() as conn:
-            conn.executescript("""
-                CREATE TABLE IF NOT EXISTS users (
-                    user_id INTEGER PRIMARY KEY,
-                    username TEXT,
-                    language TEXT DEFAULT 'en',
-                    premium_until TIMESTAMP,
-                    is_premium BOOLEAN DEFAULT 0,
-                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                    night_messages_count INTEGER DEFAULT 0,
-                    last_night_date TEXT,
-                    last_active TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                    total_messages INTEGER DEFAULT 0,
-                    referrer_id INTEGER,
-                    referral_count INTEGER DEFAULT 0,
-                    bonus_messages INTEGER DEFAULT 0,
-                    is_blocked BOOLEAN DEFAULT 0,
-                    trial_until TIMESTAMP,
-                    trial_used BOOLEAN DEFAULT 0
-                );
-                
-                CREATE TABLE IF NOT EXISTS sessions (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    user_id INTEGER,
-                    start_time TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                    end_time TIMESTAMP,
-                    is_active BOOLEAN DEFAULT 1,
-                    is_confessional BOOLEAN DEFAULT 0
-                );
-                
-                CREATE TABLE IF NOT EXISTS conversations (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    user_id INTEGER,
-                    session_id INTEGER,
-                    content TEXT,
-                    is_user BOOLEAN,
-                    timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                    is_confessional BOOLEAN DEFAULT 0
-                );
-                
-                CREATE TABLE IF NOT EXISTS analytics_events (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    user_id INTEGER,
-                    event_type TEXT,
-                    event_data TEXT,
-                    timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-                );
-                
-                CREATE TABLE IF NOT EXISTS referrals (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    referrer_id INTEGER,
-                    referred_id INTEGER,
-                    status TEXT DEFAULT 'pending',
-                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                    converted_at TIMESTAMP,
-                    bonus_given BOOLEAN DEFAULT 0
-                );
-                
-                CREATE TABLE IF NOT EXISTS retention_messages (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    user_id INTEGER,
-                    message_type TEXT,
-                    sent_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                    opened BOOLEAN DEFAULT 0
-                );
-                
-                CREATE TABLE IF NOT EXISTS admin_actions (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    admin_id INTEGER,
-                    action_type TEXT,
-                    target_user_id INTEGER,
-                    details TEXT,
-                    timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-                );
-                
-                CREATE INDEX IF NOT EXISTS idx_users_active ON users(last_active);
-                CREATE INDEX IF NOT EXISTS idx_analytics_time ON analytics_events(timestamp);
-                CREATE INDEX IF NOT EXISTS idx_referrals_ref ON referrals(referrer_id);
-            """)
+        # Схема и индексы живут в migrations.py (таблица schema_version) — одинаковые во всех шардах
+        for path in self.shard_paths:
+            migrate(path)
     
     def add_user(self, user_id: int, username: str, lang: str = "en", referrer_id: int = None):
-        with self._get_conn() as conn:
+        with self._get_conn(user_id) as conn:
             try:
-                trial_end = (datetime.now() + timedelta(days=3)).isoformat()
-                conn.execute(
-                    """INSERT INTO users (user_id, username, language, referrer_id, trial_until) 
-                       VALUES (?, ?, ?, ?, ?)""",
-                    (user_id, username, lang, referrer_id, trial_end)
-                )
-                
-                if referrer_id and referrer_id != user_id:
-                    conn.execute(
-                        "INSERT INTO referrals (referrer_id, referred_id) VALUES (?, ?)",
-                        (referrer_id, user_id)
-                    )
-                return True
+                now = int(time.time())
+                trial_end = now + 3 * 86400
+                conn.execute(INSERT_USER_SQL, (user_id, username, lang, referrer_id, trial_end, now, now))
             except sqlite3.IntegrityError:
                 return False
+        
+        if referrer_id and referrer_id != user_id:
+            with self._get_conn() as conn:
+                conn.execute(INSERT_REFERRAL_SQL, (referrer_id, user_id))
+        self._cache.invalidate(user_id)
+        return True
+    
+    def _sync_changes(self):
+        """Сбрасывает кэш и обновляет блок-лист по журналу user_changes: так видны записи других процессов"""
+        if time.monotonic() < self._next_sync or not self._sync_lock.acquire(blocking=False):
+            return
+        try:
+            self._next_sync = time.monotonic() + config.USER_CHANGES_SYNC_SECONDS
+            for shard, conn in enumerate(self._shard_conns()):
+                last = self._change_ids[shard]
+                rows = conn.execute(USER_CHANGES_SQL, (last,)).fetchall()
+                if not rows:
+                    continue
+                self._change_ids[shard] = rows[-1][0]
+                if rows[0][0] > last + 1:
+                    # Журнал успели обрезать — что именно менялось, неизвестно
+                    self._cache.clear()
+                    self._blocked = self._load_blocklist()
+                    return
+                for user_id in {user_id for _, user_id in rows}:
+                    self._cache.invalidate(user_id)
+                    row = conn.execute(USER_BLOCKED_SQL, (user_id,)).fetchone()
+                    if row and row[0]:
+                        self._blocked.add(user_id)
+                    else:
+                        self._blocked.discard(user_id)
+        finally:
+            self._sync_lock.release()
     
     def get_user(self, user_id: int) -> Optional[Dict]:
-        with self._get_conn() as conn:
+        # Вызывается на каждом апдейте (UserContextLoader) — здесь же раз в несколько секунд читаем журнал
+        self._sync_changes()
+        user = self._cache.get(user_id)
+        if user is not None:
+            return user
+        version = self._cache.version
+        with self._get_conn(user_id) as conn:
             c = conn.cursor()
-            c.execute("SELECT * FROM users WHERE user_id = ?", (user_id,))
+            c.execute(GET_USER_SQL, (user_id,))
             row = c.fetchone()
             if row:
-                return {
-                    "user_id": row[0], "username": row[1], "language": row[2],
-                    "premium_until": row[3], "is_premium": row[4], "created_at": row[5],
-                    "night_messages_count": row[6], "last_night_date": row[7],
-                    "last_active": row[8], "total_messages": row[9], "referrer_id": row[10],
-                    "referral_count": row[11], "bonus_messages": row[12], "is_blocked": row[13],
-                    "trial_until": row[14], "trial_used": row[15]
-                }
+                user = dict(zip(self.USER_COLUMNS, row))
+                self._cache.put(user_id, user, version)
+                return dict(user)
             return None
     
     def set_language(self, user_id: int, lang: str):
-        with self._get_conn() as conn:
-            conn.execute("UPDATE users SET language = ? WHERE user_id = ?", (lang, user_id))
+        with self._get_conn(user_id) as conn:
+            conn.execute(SET_LANGUAGE_SQL, (lang, user_id))
+        self._cache.update(user_id, lambda u: u.update(language=lang))
     
     def get_language(self, user_id: int) -> str:
         user = self.get_user(user_id)
         return user.get("language", "en") if user else "en"
     
     def update_last_active(self, user_id: int):
-        with self._get_conn() as conn:
-            conn.execute(
-                "UPDATE users SET last_active = ?, total_messages = total_messages + 1 WHERE user_id = ?",
-                (datetime.now().isoformat(), user_id)
-            )
+        now = int(time.time())
+        self._queue_write(user_id, "active", (user_id, now))
+        self._cache.update(user_id, lambda u: u.update(last_active_ts=now, total_messages=(u["total_messages"] or 0) + 1))
     
     def block_user(self, user_id: int, blocked: bool = True):
-        with self._get_conn() as conn:
-            conn.execute("UPDATE users SET is_blocked = ? WHERE user_id = ?", (blocked, user_id))
+        with self._get_conn(user_id) as conn:
+            conn.execute(BLOCK_USER_SQL, (blocked, user_id))
+        if blocked:
+            self._blocked.add(user_id)
+        else:
+            self._blocked.discard(user_id)
+        self._cache.update(user_id, lambda u: u.update(is_blocked=int(blocked)))
+    
+    def _load_blocklist(self) -> set:
+        blocked = set()
+        for conn in self._shard_conns():
+            with conn:
+                blocked.update(row[0] for row in conn.execute(BLOCKLIST_SQL))
+        return blocked
     
     def is_blocked(self, user_id: int) -> bool:
-        user = self.get_user(user_id)
-        return user.get("is_blocked", False) if user else False
+        # Только проверка по множеству в памяти, без обращения к БД; блокировки из других процессов
+        # подхватывает _sync_changes
+        return user_id in self._blocked
     
-    def check_and_reset_night_counter(self, user_id: int) -> int:
+    def consume_quota(self, user_id: int, action: str) -> bool:
+        """Проверка, дневной сброс и списание одним UPDATE ... RETURNING. False — лимит исчерпан."""
         today = datetime.now().strftime("%Y-%m-%d")
-        with self._get_conn() as conn:
-            c = conn.cursor()
-            c.execute("SELECT last_night_date, night_messages_count, bonus_messages FROM users WHERE user_id = ?", (user_id,))
-            row = c.fetchone()
-            if not row:
-                return 0
-            
-            last_date, count, bonus = row[0], row[1], row[2] or 0
-            
-            if last_date != today:
-                conn.execute(
-                    "UPDATE users SET night_messages_count = 0, last_night_date = ? WHERE user_id = ?",
-                    (today, user_id)
-                )
-                return 0
-            
-            return count - bonus
+        with self._get_conn(user_id) as conn:
+            row = conn.execute(
+                CONSUME_MESSAGE_QUOTA_SQL if action == "message" else CONSUME_QUOTA_SQL,
+                (user_id, action, today, self.QUOTA_LIMITS[action])
+            ).fetchone()
+            return row is not None
     
-    def increment_night_counter(self, user_id: int):
-        with self._get_conn() as conn:
-            conn.execute(
-                "UPDATE users SET night_messages_count = night_messages_count + 1 WHERE user_id = ?",
-                (user_id,)
-            )
+    def refund_quota(self, user_id: int, action: str):
+        """Возвращает списанную единицу, если действие не удалось (например, ошибка генерации)"""
+        with self._get_conn(user_id) as conn:
+            conn.execute(REFUND_QUOTA_SQL, (user_id, action))
+    
+    def quota_left(self, user_id: int, action: str) -> int:
+        today = datetime.now().strftime("%Y-%m-%d")
+        with self._get_conn(user_id) as conn:
+            row = conn.execute(QUOTA_LEFT_SQL, (today, action, user_id)).fetchone()
+        used, bonus = (row[0] or 0, row[1]) if row else (0, 0)
+        limit = self.QUOTA_LIMITS[action] + (bonus if action == "message" else 0)
+        return max(limit - used, 0)
     
     def add_bonus_messages(self, user_id: int, count: int):
-        with self._get_conn() as conn:
-            conn.execute(
-                "UPDATE users SET bonus_messages = bonus_messages + ? WHERE user_id = ?",
-                (count, user_id)
-            )
+        with self._get_conn(user_id) as conn:
+            conn.execute(ADD_BONUS_MESSAGES_SQL, (count, user_id))
+        self._cache.update(user_id, lambda u: u.update(bonus_messages=(u["bonus_messages"] or 0) + count))
+    
+    premium_active = staticmethod(premium_active)
+    trial_active = staticmethod(trial_active)
     
     def is_premium(self, user_id: int) -> bool:
-        user = self.get_user(user_id)
-        if not user or not user.get("is_premium"):
-            return False
-        if user.get("premium_until"):
-            return datetime.fromisoformat(user["premium_until"]) > datetime.now()
-        return False
+        return self.premium_active(self.get_user(user_id))
     
     def is_trial_active(self, user_id: int) -> bool:
-        user = self.get_user(user_id)
-        if not user or user.get("trial_used"):
-            return False
-        if user.get("trial_until"):
-            return datetime.fromisoformat(user["trial_until"]) > datetime.now()
-        return False
+        return self.trial_active(self.get_user(user_id))
     
     def end_trial(self, user_id: int):
-        with self._get_conn() as conn:
-            conn.execute("UPDATE users SET trial_used = 1 WHERE user_id = ?", (user_id,))
+        with self._get_conn(user_id) as conn:
+            conn.execute(END_TRIAL_SQL, (user_id,))
+        self._cache.update(user_id, lambda u: u.update(trial_used=1))
     
     def add_premium(self, user_id: int, days: int = 30):
-        now = datetime.now()
-        user = self.get_user(user_id)
-        if user and user.get("premium_until") and datetime.fromisoformat(user["premium_until"]) > now:
-            new_date = datetime.fromisoformat(user["premium_until"]) + timedelta(days=days)
-        else:
-            new_date = now + timedelta(days=days)
-        with self._get_conn() as conn:
-            conn.execute(
-                "UPDATE users SET premium_until = ?, is_premium = 1 WHERE user_id = ?",
-                (new_date.isoformat(), user_id)
-            )
+        # Продление от текущего срока, если он ещё не истёк — одним UPDATE, без чтения строки
+        with self._get_conn(user_id) as conn:
+            row = conn.execute(ADD_PREMIUM_SQL, (int(time.time()), days * 86400, user_id)).fetchone()
+        if row:
+            self._cache.update(user_id, lambda u: u.update(premium_until_ts=row[0], is_premium=1))
     
     def remove_premium(self, user_id: int):
-        with self._get_conn() as conn:
-            conn.execute(
-                "UPDATE users SET is_premium = 0, premium_until = NULL WHERE user_id = ?",
-                (user_id,)
-            )
+        with self._get_conn(user_id) as conn:
+            conn.execute(REMOVE_PREMIUM_SQL, (user_id,))
+        self._cache.update(user_id, lambda u: u.update(is_premium=0, premium_until_ts=None))
     
     def start_session(self, user_id: int, is_confessional: bool = False) -> int:
-        with self._get_conn() as conn:
+        with self._get_conn(user_id) as conn:
             c = conn.cursor()
             end = datetime.now() + timedelta(minutes=40)
-            c.execute(
-                "INSERT INTO sessions (user_id, is_confessional, end_time) VALUES (?, ?, ?)",
-                (user_id, is_confessional, end)
-            )
+            c.execute(START_SESSION_SQL, (user_id, is_confessional, end))
             return c.lastrowid
     
     def get_active_session(self, user_id: int) -> Optional[Dict]:
-        with self._get_conn() as conn:
+        with self._get_conn(user_id) as conn:
             c = conn.cursor()
-            c.execute(
-                "SELECT * FROM sessions WHERE user_id = ? AND is_active = 1 ORDER BY id DESC LIMIT 1",
-                (user_id,)
-            )
+            c.execute(ACTIVE_SESSION_SQL, (user_id,))
             row = c.fetchone()
             if row:
-                return {"id": row[0], "is_confessional": row[5]}
+                return {"id": row[0], "is_confessional": row[1]}
             return None
     
-    def end_session(self, session_id: int):
-        with self._get_conn() as conn:
-            conn.execute("UPDATE sessions SET is_active = 0 WHERE id = ?", (session_id,))
+    def end_session(self, user_id: int, session_id: int):
+        # id сессий уникальны только внутри шарда — шард выбирается по user_id
+        with self._get_conn(user_id) as conn:
+            conn.execute(END_SESSION_SQL, (session_id, user_id))
     
     def add_message(self, user_id: int, session_id: int, content: str, is_user: bool, is_confessional: bool = False):
         if is_confessional:
             return
-        with self._get_conn() as conn:
-            conn.execute(
-                "INSERT INTO conversations (user_id, session_id, content, is_user, is_confessional) VALUES (?, ?, ?, ?, ?)",
-                (user_id, session_id, content, is_user, is_confessional)
-            )
+        self._queue_write(user_id, "message", (user_id, session_id, content, is_user, is_confessional, _utc_timestamp()))
     
     def get_referral_link(self, user_id: int) -> str:
         return f"https://t.me/night_whisper_ai_bot?start=ref{user_id}"
     
     def process_referral_conversion(self, user_id: int):
+        # referrals — в нулевом шарде, реферер — в своём: конверсия фиксируется атомарно одним UPDATE ... RETURNING,
+        # и только выигравший её вызов начисляет бонус
         with self._get_conn() as conn:
-            c = conn.cursor()
-            c.execute("SELECT referrer_id FROM referrals WHERE referred_id = ? AND status = 'pending'", (user_id,))
-            row = c.fetchone()
-            if row:
-                referrer_id = row[0]
-                c.execute(
-                    "UPDATE referrals SET status = 'converted', converted_at = ? WHERE referred_id = ?",
-                    (datetime.now().isoformat(), user_id)
-                )
-                c.execute(
-                    "UPDATE users SET referral_count = referral_count + 1, bonus_messages = bonus_messages + 5 WHERE user_id = ?",
-                    (referrer_id,)
-                )
-                return referrer_id
+            row = conn.execute(CONVERT_REFERRAL_SQL, (datetime.now().isoformat(), user_id)).fetchone()
+        if not row:
             return None
+        referrer_id = row[0]
+        with self._get_conn(referrer_id) as conn:
+            conn.execute(CREDIT_REFERRER_SQL, (referrer_id,))
+        self._cache.invalidate(referrer_id)
+        return referrer_id
     
     def get_referral_stats(self, user_id: int) -> Dict:
         with self._get_conn() as conn:
             c = conn.cursor()
-            c.execute(
-                "SELECT COUNT(*), SUM(CASE WHEN status = 'converted' THEN 1 ELSE 0 END) FROM referrals WHERE referrer_id = ?",
-                (user_id,)
-            )
+            c.execute(REFERRAL_STATS_SQL, (user_id,))
             total, converted = c.fetchone()
             return {"total": total or 0, "converted": converted or 0}
     
     def log_event(self, user_id: int, event_type: str, data: str = None):
-        with self._get_conn() as conn:
-            conn.execute(
-                "INSERT INTO analytics_events (user_id, event_type, event_data) VALUES (?, ?, ?)",
-                (user_id, event_type, data)
-            )
+        self._queue_write(user_id, "event", (user_id, event_type, data, _utc_timestamp()))
     
     def get_stats(self, days: int = 7) -> Dict:
+        now = int(time.time())
+        # referrals.created_at пишется CURRENT_TIMESTAMP — сравниваем в том же формате (UTC)
+        since = time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime(now - days * 86400))
+        since_day = _utc_day(days)
+        new_users = messages = total = premium = 0
+        langs: Dict[str, int] = {}
+        
+        # Пользовательские агрегаты считаются в каждом шарде и складываются
+        for conn in self._shard_conns():
+            with conn:
+                c = conn.cursor()
+                # Новые пользователи и сообщения — из дневных предагрегатов (migrations, шаг 3)
+                c.execute(NEW_USERS_SQL, (since_day,))
+                new_users += c.fetchone()[0] or 0
+                
+                c.execute(MESSAGES_SENT_SQL, (since_day,))
+                messages += c.fetchone()[0] or 0
+                
+                # Итоги по users — из rollup-таблиц (migrations, шаг 9); Premium — с точностью до часа окончания
+                c.execute(ACTIVE_PREMIUM_SQL, (now // 3600,))
+                premium += c.fetchone()[0] or 0
+                
+                c.execute(LANGUAGES_SQL)
+                for lang, count in c.fetchall():
+                    total += count
+                    if count:
+                        langs[lang] = langs.get(lang, 0) + count
+        
         with self._get_conn() as conn:
             c = conn.cursor()
-            since = (datetime.now() - timedelta(days=days)).isoformat()
-            
-            c.execute("SELECT COUNT(*) FROM users WHERE created_at > ?", (since,))
-            new_users = c.fetchone()[0]
-            
-            c.execute("SELECT COUNT(*) FROM analytics_events WHERE event_type = 'message_sent' AND timestamp > ?", (since,))
-            messages = c.fetchone()[0]
-            
-            c.execute("SELECT COUNT(*), SUM(CASE WHEN is_premium THEN 1 ELSE 0 END) FROM users")
-            total, premium = c.fetchone()
-            
-            c.execute("SELECT language, COUNT(*) FROM users GROUP BY language")
-            langs = dict(c.fetchall())
-            
-            c.execute("SELECT COUNT(*), SUM(CASE WHEN status = 'converted' THEN 1 ELSE 0 END) FROM referrals WHERE created_at > ?", (since,))
+            c.execute(REFERRALS_SINCE_SQL, (since,))
             refs_total, refs_conv = c.fetchone()
+        
+        return {
+            "period_days": days,
+            "new_users": new_users,
+            "total_messages": messages,
+            "total_users": total,
+            "premium_users": premium,
+            "languages": langs,
+            "referrals_total": refs_total or 0,
+            "referrals_converted": refs_conv or 0,
+            "conversion_rate": f"{(refs_conv/refs_total*100):.1f}%" if refs_total else "0%"
+        }
+    
+    def get_analytics_stats(self, days: int = 7) -> Dict:
+        """Статистика для analytics: когортная конверсия и активность по часам (по всем шардам)"""
+        day_since = _utc_day(days)
+        new_users = messages = premium = 0
+        languages: Dict[str, int] = {}
+        hourly_activity: Dict[int, int] = {}
+        
+        for conn in self._shard_conns():
+            with conn:
+                c = conn.cursor()
+                
+                # Новые пользователи и сколько из них с Premium (дневной предагрегат по когортам)
+                c.execute(COHORT_PREMIUM_SQL, (day_since,))
+                shard_new, shard_premium = c.fetchone()
+                new_users += shard_new or 0
+                premium += shard_premium or 0
+                
+                # Всего сообщений (почасовой предагрегат)
+                c.execute(HOURLY_MESSAGES_SQL, (day_since,))
+                messages += c.fetchone()[0] or 0
+                
+                # По языкам
+                c.execute(LANGUAGES_SQL)
+                for lang, count in c.fetchall():
+                    if count:
+                        languages[lang] = languages.get(lang, 0) + count
+                
+                # Распределение по часам (когда активность)
+                c.execute(HOURLY_ACTIVITY_SQL, (day_since,))
+                for hour, count in c.fetchall():
+                    hourly_activity[int(hour)] = hourly_activity.get(int(hour), 0) + count
+        
+        return {
+            "period_days": days,
+            "new_users": new_users,
+            "total_messages": messages,
+            "premium_conversion": f"{(premium/new_users*100):.1f}%" if new_users else "0%",
+            "languages": languages,
+            "hourly_activity": hourly_activity,
+            "avg_messages_per_user": round(messages/new_users, 1) if new_users else 0
+        }
+    
+    def get_conversation_summary(self, limit: int = 50, include_archive: bool = False) -> List[Dict]:
+        """Последние диалоги для анализа (без персональных данных); при include_archive добирает из архивов"""
+        rows = []
+        for shard, conn in enumerate(self._shard_conns()):
+            shard_rows = conn.execute(CONVERSATION_SUMMARY_SQL, (limit,)).fetchall()
             
-            return {
-                "period_days": days,
-                "new_users": new_users,
-                "total_messages": messages,
-                "total_users": total,
-                "premium_users": premium or 0,
-                "languages": langs,
-                "referrals_total": refs_total or 0,
-                "referrals_converted": refs_conv or 0,
-                "conversion_rate": f"{(refs_conv/refs_total*100):.1f}%" if refs_total else "0%"
-            }
+            # Архивы старше основной БД — идём от самого свежего месяца
+            months = reversed(archiver.archive_months()) if include_archive else []
+            for month in months:
+                if len(shard_rows) >= limit:
+                    break
+                path = archiver.archive_path(month, shard)
+                if not os.path.exists(path):
+                    continue
+                conn.execute(ATTACH_ARCHIVE_SQL, (path,))
+                try:
+                    shard_rows.extend(conn.execute(ARCHIVE_CONVERSATION_SUMMARY_SQL, (limit - len(shard_rows),)).fetchall())
+                finally:
+                    conn.execute(DETACH_ARCHIVE_SQL)
+            rows.extend(shard_rows)
+        
+        # Самые свежие по всем шардам
+        rows = heapq.nlargest(limit, rows, key=lambda r: r[1] or "")
+        return [{"id": r[0], "time": r[1], "length": r[2], "lang": r[3]} for r in rows]
     
     def get_inactive_users(self, days: int) -> List[Tuple]:
+        return list(self.iter_inactive_users(days))
+    
+    def _keyset(self, shard: int, query: str, params: tuple, start: tuple, key: Callable[[tuple], tuple],
+                batch_size: int) -> Iterator[tuple]:
+        """Страницы `WHERE (ключ) > (?) AND ... LIMIT ?`; соединение берётся на страницу, а не держится между ними"""
+        last = start
+        while True:
+            with self._pools[shard].get() as conn:
+                rows = conn.execute(query, (*last, *params, batch_size)).fetchall()
+            yield from rows
+            if len(rows) < batch_size:
+                return
+            last = key(rows[-1])
+    
+    def _merged_keyset(self, query: str, params: tuple, start: tuple, key: Callable[[tuple], tuple],
+                       batch_size: int) -> Iterator[tuple]:
+        """Тот же keyset по всем шардам, слитый в общий порядок ключа"""
+        if self.shards == 1:
+            return self._keyset(0, query, params, start, key, batch_size)
+        return heapq.merge(
+            *(self._keyset(shard, query, params, start, key, batch_size) for shard in range(self.shards)),
+            key=key
+        )
+    
+    def iter_inactive_users(self, days: int, batch_size: int = 1000) -> Iterator[Tuple]:
+        """(user_id, username, language, last_active_ts) незаблокированных, неактивных дольше days — от давних к свежим"""
+        since = int(time.time()) - days * 86400
+        return self._merged_keyset(
+            ITER_INACTIVE_USERS_SQL,
+            (since,), (-1, -1), lambda row: (row[3], row[0]), batch_size
+        )
+    
+    def iter_users(self, include_blocked: bool = False, batch_size: int = 1000) -> Iterator[Tuple]:
+        """(user_id, username, language) по возрастанию user_id"""
+        return self._merged_keyset(
+            ITER_ALL_USERS_SQL if include_blocked else ITER_USERS_SQL,
+            (), (-1,), lambda row: (row[0],), batch_size
+        )
+    
+    def iter_referrals(self, referrer_id: Optional[int] = None, batch_size: int = 1000) -> Iterator[Tuple]:
+        """(id, referrer_id, referred_id, status, created_at, converted_at) по возрастанию id"""
+        if referrer_id is None:
+            query, params = ITER_REFERRALS_SQL, ()
+        else:
+            query, params = ITER_REFERRER_REFERRALS_SQL, (referrer_id,)
+        return self._keyset(
+            0,
+            query,
+            params, (-1,), lambda row: (row[0],), batch_size
+        )
+    
+    def iter_conversations(self, user_id: Optional[int] = None, session_id: Optional[int] = None,
+                           batch_size: int = 1000) -> Iterator[Tuple]:
+        """(id, user_id, session_id, content, is_user, is_confessional, timestamp) по возрастанию id внутри шарда"""
+        query = {
+            (False, False): ITER_CONVERSATIONS_SQL,
+            (True, False): ITER_USER_CONVERSATIONS_SQL,
+            (False, True): ITER_SESSION_CONVERSATIONS_SQL,
+            (True, True): ITER_USER_SESSION_CONVERSATIONS_SQL,
+        }[user_id is not None, session_id is not None]
+        params = tuple(value for value in (user_id, session_id) if value is not None)
+        # id диалогов уникальны только в шарде: без user_id шарды идут друг за другом
+        shards = [self.shard_for(user_id)] if user_id is not None else range(self.shards)
+        return itertools.chain.from_iterable(
+            self._keyset(shard, query, params, (-1,), lambda row: (row[0],), batch_size) for shard in shards
+        )
+    
+    def get_transcription(self, file_unique_id: str, language: str) -> Optional[str]:
+        """Ранее распознанный текст голосового; отметка использования пишется отложенно"""
+        row = self._get_conn().execute(GET_TRANSCRIPTION_SQL, (file_unique_id, language)).fetchone()
+        if not row:
+            return None
+        self._write_behind[0].put("transcription_used", (int(time.time()), file_unique_id, language))
+        return row[0]
+    
+    def save_transcription(self, file_unique_id: str, language: str, text: str):
+        now = int(time.time())
         with self._get_conn() as conn:
-            c = conn.cursor()
-            since = (datetime.now() - timedelta(days=days)).isoformat()
-            c.execute(
-                "SELECT user_id, username, language, last_active FROM users WHERE last_active < ? AND is_blocked = 0",
-                (since,)
-            )
-            return c.fetchall()
+            conn.execute(SAVE_TRANSCRIPTION_SQL, (file_unique_id, language, text, now, now))
+            # Оставляем TRANSCRIPTION_CACHE_MAX_ENTRIES самых свежих
+            conn.execute(EVICT_TRANSCRIPTIONS_SQL, (config.TRANSCRIPTION_CACHE_MAX_ENTRIES - 1,))
     
     def log_admin_action(self, admin_id: int, action_type: str, target_user_id: int, details: str):
         with self._get_conn() as conn:
-            conn.execute(
-                "INSERT INTO admin_actions (admin_id, action_type, target_user_id, details) VALUES (?, ?, ?, ?)",
-                (admin_id, action_type, target_user_id, details)
-            )
+            conn.execute(INSERT_ADMIN_ACTION_SQL, (admin_id, action_type, target_user_id, details))
+
+class AsyncDatabase:
+    """Асинхронный фасад над Database: чтения идут в пул читателей, записи — в поток-писатель шарда пользователя"""
+    
+    WRITE_METHODS = frozenset({
+        "add_user", "set_language", "update_last_active", "block_user",
+        "consume_quota", "refund_quota", "add_bonus_messages",
+        "end_trial", "add_premium", "remove_premium", "start_session", "end_session",
+        "add_message", "process_referral_conversion", "log_event", "log_admin_action", "save_transcription",
+    })
+    # Методы, пишущие в общие таблицы нулевого шарда (add_user с реферером и конверсия — ещё и в шард пользователя),
+    # всегда идут через писатель нулевого шарда: общие таблицы пишет один поток, а редкая запись в чужой шард
+    # дожидается его блокировки по busy_timeout
+    GLOBAL_WRITE_METHODS = frozenset({
+        "add_user", "process_referral_conversion", "log_admin_action", "save_transcription",
+    })
+    
+    def __init__(self, database: Storage, reader_threads: int = 4):
+        self._db = database
+        self._readers = ThreadPoolExecutor(max_workers=reader_threads, thread_name_prefix="db-reader")
+        self._writers = [
+            ThreadPoolExecutor(max_workers=1, thread_name_prefix=f"db-writer-{shard}")
+            for shard in range(database.shards)
+        ]
+    
+    def _executor(self, name: str, args: tuple, kwargs: Dict) -> ThreadPoolExecutor:
+        if name not in self.WRITE_METHODS:
+            return self._readers
+        if name in self.GLOBAL_WRITE_METHODS:
+            return self._writers[0]
+        # Все записывающие методы принимают user_id первым аргументом
+        user_id = args[0] if args else kwargs["user_id"]
+        return self._writers[self._db.shard_for(user_id)]
+    
+    def __getattr__(self, name: str):
+        attr = getattr(self._db, name)
+        if not callable(attr):
+            return attr
+        
+        async def call(*args, **kwargs):
+            loop = asyncio.get_running_loop()
+            executor = self._executor(name, args, kwargs)
+            return await loop.run_in_executor(executor, functools.partial(attr, *args, **kwargs))
+        
+        call.__name__ = name
+        return call
+    
+    def shutdown(self):
+        for writer in self._writers:
+            writer.shutdown(wait=True)
+        self._readers.shutdown(wait=True)
+        self._db.close()
 
-db = Database()
\ No newline at end of file
+# STORAGE_BACKEND=memory — без диска, чтобы мерить логику бота отдельно от стоимости хранения
+if config.STORAGE_BACKEND == "memory":
+    db: Storage = MemoryStorage()
+else:
+    db = Database(config.DB_PATH, shards=config.DB_SHARDS)
+adb = AsyncDatabase(db, reader_threads=config.DB_READER_THREADS)
\ No newline at end of file
@@ -0,0 +1,194 @@
+import argparse
+import calendar
+import csv
+import heapq
+import json
+import os
+import sqlite3
+import sys
+import time
+from typing import Dict, IO, Iterator, List, Optional, Sequence
+
+from archive import archiver
+from config import config
+from migrations import shard_paths
+
+class Exporter:
+    """Потоковая выгрузка таблиц в NDJSON/CSV: keyset-пачки с read-only соединения, память не растёт с объёмом"""
+
+    FORMATS = ("ndjson", "csv")
+
+    # Колонки выгрузки; текст диалогов — только по явному запросу
+    COLUMNS = {
+        "conversations": ("a.id", "a.user_id", "a.session_id", "a.is_user", "a.is_confessional",
+                          "a.timestamp", "LENGTH(a.content) AS length", "u.language"),
+        "analytics_events": ("a.id", "a.user_id", "a.event_type", "a.event_data", "a.timestamp", "u.language"),
+        "users": ("u.user_id", "u.language", "u.is_premium", "u.premium_until_ts", "u.trial_until_ts",
+                  "u.trial_used", "u.created_at_ts", "u.last_active_ts", "u.total_messages", "u.referrer_id",
+                  "u.referral_count", "u.bonus_messages", "u.is_blocked"),
+    }
+
+    def __init__(self, db_path: str = "night_whisper.db", batch_size: int = 2000, shards: int = 1):
+        self.db_path = db_path
+        self.shard_paths = shard_paths(db_path, shards)
+        self.batch_size = batch_size
+
+    def _connect(self, path: str) -> sqlite3.Connection:
+        # mode=ro: выгрузка никогда не берёт блокировку записи, а в WAL и не мешает боту писать
+        conn = sqlite3.connect(f"file:{path}?mode=ro", uri=True)
+        conn.row_factory = sqlite3.Row
+        return conn
+
+    def columns(self, table: str, include_content: bool = False) -> List[str]:
+        if table not in self.COLUMNS:
+            raise ValueError(f"Unknown export table: {table}")
+        columns = list(self.COLUMNS[table])
+        if include_content and table == "conversations":
+            columns.append("a.content")
+        return columns
+
+    @staticmethod
+    def _language_filter(languages: Optional[Sequence[str]]):
+        if not languages:
+            return "", []
+        return f" AND u.language IN ({','.join('?' * len(languages))})", list(languages)
+
+    def _fetch(self, conn: sqlite3.Connection, query: str, params: List) -> List[Dict]:
+        # Пачка читается целиком, и курсор сразу закрывается — снимок чтения живёт миллисекунды
+        return [dict(row) for row in conn.execute(query, params).fetchall()]
+
+    def _iter_users(self, conn: sqlite3.Connection, columns: List[str], since: Optional[str],
+                    until: Optional[str], languages: Optional[Sequence[str]]) -> Iterator[Dict]:
+        where, params = "", []
+        # Унарный плюс — чтобы планировщик шёл по первичному ключу, а не сортировал диапазон индекса
+        if since:
+            where += " AND +u.created_at_ts >= ?"
+            params.append(calendar.timegm(time.strptime(since, "%Y-%m-%d")))
+        if until:
+            where += " AND +u.created_at_ts < ?"
+            params.append(calendar.timegm(time.strptime(until, "%Y-%m-%d")))
+        lang_where, lang_params = self._language_filter(languages)
+        query = f"""
+            SELECT {', '.join(columns)} FROM users u
+            WHERE u.user_id > ?{where}{lang_where}
+            ORDER BY u.user_id LIMIT ?
+        """
+
+        last_id = -1
+        while True:
+            rows = self._fetch(conn, query, [last_id, *params, *lang_params, self.batch_size])
+            yield from rows
+            if len(rows) < self.batch_size:
+                return
+            last_id = rows[-1]["user_id"]
+
+    def _iter_timeline(self, conn: sqlite3.Connection, schema: str, table: str, columns: List[str],
+                       since: Optional[str], until: Optional[str],
+                       languages: Optional[Sequence[str]]) -> Iterator[Dict]:
+        where, params = "", []
+        if until:
+            where += " AND a.timestamp < ?"
+            params.append(until)
+        lang_where, lang_params = self._language_filter(languages)
+        # Ключ (timestamp, id) совпадает с порядком индекса по timestamp — без временной сортировки
+        query = f"""
+            SELECT {', '.join(columns)} FROM {schema}.{table} a
+            {'JOIN' if languages else 'LEFT JOIN'} main.users u ON u.user_id = a.user_id
+            WHERE (a.timestamp, a.id) > (?, ?){where}{lang_where}
+            ORDER BY a.timestamp, a.id LIMIT ?
+        """
+
+        last_key = (since or "", -1)
+        while True:
+            rows = self._fetch(conn, query, [*last_key, *params, *lang_params, self.batch_size])
+            yield from rows
+            if len(rows) < self.batch_size:
+                return
+            last_key = (rows[-1]["timestamp"], rows[-1]["id"])
+
+    def iter_rows(self, table: str, since: Optional[str] = None, until: Optional[str] = None,
+                  languages: Optional[Sequence[str]] = None, include_archive: bool = False,
+                  include_content: bool = False) -> Iterator[Dict]:
+        """Строки таблицы за период [since, until) (даты YYYY-MM-DD, UTC); для диалогов и событий — по времени"""
+        columns = self.columns(table, include_content)
+        shards = [
+            self._iter_shard(shard, table, columns, since, until, languages, include_archive)
+            for shard in range(len(self.shard_paths))
+        ]
+        if len(shards) == 1:
+            return shards[0]
+        # Каждый шард уже упорядочен по ключу — сливаем без буферизации
+        key = (lambda row: row["user_id"]) if table == "users" else (lambda row: (row["timestamp"], row["id"]))
+        return heapq.merge(*shards, key=key)
+
+    def _iter_shard(self, shard: int, table: str, columns: List[str], since: Optional[str], until: Optional[str],
+                    languages: Optional[Sequence[str]], include_archive: bool) -> Iterator[Dict]:
+        conn = self._connect(self.shard_paths[shard])
+        try:
+            if table == "users":
+                yield from self._iter_users(conn, columns, since, until, languages)
+                return
+
+            months = archiver.archive_months() if include_archive and table in archiver.TABLES else []
+            for month in months:
+                month_start = month.replace("_", "-")
+                if (until and f"{month_start}-01" >= until) or (since and since[:7] > month_start):
+                    continue
+                if not os.path.exists(archiver.archive_path(month, shard)):
+                    continue
+                conn.execute("ATTACH DATABASE ? AS arc", (f"file:{archiver.archive_path(month, shard)}?mode=ro",))
+                try:
+                    exists = conn.execute(
+                        "SELECT 1 FROM arc.sqlite_master WHERE type = 'table' AND name = ?", (table,)
+                    ).fetchone()
+                    if exists:
+                        yield from self._iter_timeline(conn, "arc", table, columns, since, until, languages)
+                finally:
+                    conn.execute("DETACH DATABASE arc")
+            yield from self._iter_timeline(conn, "main", table, columns, since, until, languages)
+        finally:
+            conn.close()
+
+    def export(self, table: str, out: IO[str], fmt: str = "ndjson", **filters) -> int:
+        """Пишет выгрузку в поток построчно и возвращает число строк"""
+        if fmt not in self.FORMATS:
+            raise ValueError(f"Unknown export format: {fmt}")
+        count = 0
+        if fmt == "csv":
+            header = [column.split(" AS ")[-1].split(".")[-1]
+                      for column in self.columns(table, filters.get("include_content", False))]
+            writer = csv.writer(out)
+            writer.writerow(header)
+            for row in self.iter_rows(table, **filters):
+                writer.writerow([row[name] for name in header])
+                count += 1
+        else:
+            for row in self.iter_rows(table, **filters):
+                out.write(json.dumps(row, ensure_ascii=False) + "\n")
+                count += 1
+        return count
+
+exporter = Exporter(config.DB_PATH, config.EXPORT_BATCH_SIZE, config.DB_SHARDS)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Export Night Whisper data as NDJSON or CSV")
+    parser.add_argument("table", choices=sorted(Exporter.COLUMNS))
+    parser.add_argument("--format", choices=Exporter.FORMATS, default="ndjson")
+    parser.add_argument("--since", help="YYYY-MM-DD, inclusive (UTC)")
+    parser.add_argument("--until", help="YYYY-MM-DD, exclusive (UTC)")
+    parser.add_argument("--lang", action="append", dest="languages", help="repeatable language filter")
+    parser.add_argument("--include-archive", action="store_true")
+    parser.add_argument("--with-content", action="store_true", help="include conversation text")
+    parser.add_argument("-o", "--output", help="output file (default: stdout)")
+    args = parser.parse_args()
+
+    out = open(args.output, "w", newline="", encoding="utf-8") if args.output else sys.stdout
+    try:
+        exported = exporter.export(
+            args.table, out, args.format, since=args.since, until=args.until, languages=args.languages,
+            include_archive=args.include_archive, include_content=args.with_content
+        )
+    finally:
+        if args.output:
+            out.close()
+    print(f"Exported {exported} rows", file=sys.stderr)
\ No newline at end of file
@@ -2,7 +2,9 @@ import os
 import asyncio
 import logging
 import threading
+import time
 from datetime import datetime, timedelta
+from typing import AsyncIterator, Awaitable, Callable, Optional, Tuple
 from http.server import HTTPServer, BaseHTTPRequestHandler
 
 from aiogram import Bot, Dispatcher, F
@@ -11,22 +13,28 @@ from aiogram.types import (
     InlineKeyboardButton, PreCheckoutQuery, SuccessfulPayment
 )
 from aiogram.filters import Command
+from aiogram.exceptions import TelegramBadRequest, TelegramRetryAfter
 
 from config import config
-from database import db
+from database import adb
 from ai_service import ai_service
+from story_pool import story_pool
 from referral import referral_system, BOT_USERNAME
 from admin_bot import admin_router
-from utils import is_night_time, get_night_greeting_key
+from archive import archiver
+from middlewares import BlocklistMiddleware, RateLimitMiddleware, UserContext, UserContextLoader, load_user_context
+from utils import is_night_time, get_night_greeting_key, format_date
 
 logging.basicConfig(level=logging.INFO)
 
 bot = Bot(token=config.BOT_TOKEN)
 dp = Dispatcher()
+dp.update.outer_middleware(BlocklistMiddleware())
+dp.update.outer_middleware(RateLimitMiddleware())
+dp.update.outer_middleware(UserContextLoader())
 dp.include_router(admin_router)
 
 user_sessions = {}
-user_limits = {}
 confessional_messages = {}
 
 # ==================== НОВЫЕ ТЕКСТЫ ПРИВЕТСТВИЙ ====================
@@ -153,44 +161,89 @@ def get_main_menu(lang: str, is_premium: bool = False, in_session: bool = False)
     
     return InlineKeyboardMarkup(inline_keyboard=buttons)
 
-def check_and_init_limits(user_id: int):
-    today = datetime.now().strftime("%Y-%m-%d")
-    if user_id not in user_limits or user_limits[user_id].get("date") != today:
-        user_limits[user_id] = {"date": today, "story_used": False, "confessional_count": 0}
-    return user_limits[user_id]
-
-def has_full_access(user_id: int) -> bool:
+def has_full_access(user_ctx: UserContext) -> bool:
     """Полный доступ: Premium или Триал или Разовый сеанс"""
+    user_id = user_ctx.user_id
     return (
-        db.is_premium(user_id) or 
-        db.is_trial_active(user_id) or
-        (user_id in user_sessions and user_sessions[user_id].get("premium_temp"))
+        user_ctx.is_premium or 
+        user_ctx.is_trial_active or
+        bool(user_id in user_sessions and user_sessions[user_id].get("premium_temp"))
     )
 
-def get_access_status(user_id: int) -> str:
-    if db.is_premium(user_id):
+def get_llm_lane(user_ctx: UserContext) -> str:
+    """Полоса планировщика LLM: Premium и разовый сеанс первыми, затем триал, затем бесплатные"""
+    user_id = user_ctx.user_id
+    if user_ctx.is_premium or (user_id in user_sessions and user_sessions[user_id].get("premium_temp")):
+        return "paid"
+    if user_ctx.is_trial_active:
+        return "trial"
+    return "free"
+
+def get_access_status(user_ctx: UserContext) -> str:
+    user_id = user_ctx.user_id
+    if user_ctx.is_premium:
         return "⭐ Premium"
-    elif db.is_trial_active(user_id):
-        trial_end = db.get_user(user_id).get("trial_until", "")[:10]
+    elif user_ctx.is_trial_active:
+        trial_end = format_date(user_ctx.trial_until_ts)
         return f"🎁 Trial until {trial_end}"
     elif user_id in user_sessions and user_sessions[user_id].get("premium_temp"):
         return "💫 Single session"
     return "🆓 Free version"
 
+async def get_trial_message(user_ctx: UserContext, lang: str) -> str:
+    if not user_ctx.trial_until_ts or user_ctx.trial_used:
+        return ""
+    if not user_ctx.is_trial_active:
+        await adb.end_trial(user_ctx.user_id)
+        return get_text("trial_ended", lang) + "\n\n"
+    return f"🎁 Trial until {format_date(user_ctx.trial_until_ts)}\n\n"
+
+async def stream_to_message(
+    chunks: AsyncIterator[str],
+    render: Callable[[str], str],
+    send: Optional[Callable[[str], Awaitable[Message]]] = None,
+    message: Optional[Message] = None
+) -> Tuple[str, Optional[Message]]:
+    """Показывает ответ по мере генерации: первый фрагмент сразу (send или правка message),
+    дальше правки не чаще STREAM_EDIT_INTERVAL_SECONDS — в пределах лимитов Telegram на редактирование"""
+    text = shown = ""
+    next_edit = 0.0
+    
+    async def show(final: bool = False):
+        nonlocal message, shown, next_edit
+        if message is None:
+            message = await send(render(text))
+        else:
+            try:
+                await message.edit_text(render(text))
+            except TelegramRetryAfter as e:
+                if not final:
+                    next_edit = time.monotonic() + e.retry_after
+                    return
+                await asyncio.sleep(e.retry_after)
+                await message.edit_text(render(text))
+            except TelegramBadRequest:
+                # «message is not modified» и подобное — просто ждём следующего фрагмента
+                pass
+        shown = text
+        next_edit = time.monotonic() + config.STREAM_EDIT_INTERVAL_SECONDS
+    
+    async for chunk in chunks:
+        text += chunk
+        if text.strip() and time.monotonic() >= next_edit:
+            await show()
+    if text != shown or message is None:
+        await show(final=True)
+    return text, message
+
 # ==================== КОМАНДЫ ====================
 
 @dp.message(Command("start"))
-async def cmd_start(message: Message):
+async def cmd_start(message: Message, user_ctx: UserContext):
     user_id = message.from_user.id
     
-    if db.is_blocked(user_id):
-        return
-    
-    check_and_init_limits(user_id)
-    
-    user = db.get_user(user_id)
     lang = message.from_user.language_code or "ru"
-    if lang not in ["ru", "en"]:
+    if lang not in config.LANGUAGES:
         lang = "ru"
     
     # Рефералка
@@ -199,26 +252,20 @@ async def cmd_start(message: Message):
         start_param = message.text.split()[1]
         referrer_id = referral_system.parse_referral_start(start_param)
     
-    if not user:
-        db.add_user(user_id, message.from_user.username, lang, referrer_id)
+    if not user_ctx.exists:
+        await adb.add_user(user_id, message.from_user.username, lang, referrer_id)
         if referrer_id and referrer_id != user_id:
-            db.add_bonus_messages(referrer_id, 5)
+            await adb.add_bonus_messages(referrer_id, 5)
             try:
                 await bot.send_message(referrer_id, "🎁 New referral! +5 messages.")
             except:
                 pass
+        user_ctx = await load_user_context(user_id)
         trial_msg = get_text("trial_active", lang) + "\n\n"
     else:
-        lang = user.get("language", lang)
-        db.update_last_active(user_id)
-        
-        trial_msg = ""
-        if user.get("trial_until") and not user.get("trial_used"):
-            if datetime.fromisoformat(user["trial_until"]) < datetime.now():
-                db.end_trial(user_id)
-                trial_msg = get_text("trial_ended", lang) + "\n\n"
-            else:
-                trial_msg = f"🎁 Trial until {user['trial_until'][:10]}\n\n"
+        lang = user_ctx.language
+        await adb.update_last_active(user_id)
+        trial_msg = await get_trial_message(user_ctx, lang)
     
     # ПРОВЕРКА ВРЕМЕНИ ОТКЛЮЧЕНА — РАБОТАЕМ 24/7
     # if not is_night_time():
@@ -227,16 +274,16 @@ async def cmd_start(message: Message):
     
     greeting = get_text(get_night_greeting_key(), lang)
     welcome = get_text("welcome", lang)
-    status = get_access_status(user_id)
+    status = get_access_status(user_ctx)
     
     text = f"{greeting}\n\n{trial_msg}{welcome}\n\n📊 Status: {status}"
     
-    await message.answer(text, reply_markup=get_main_menu(lang, has_full_access(user_id)), parse_mode="Markdown")
+    await message.answer(text, reply_markup=get_main_menu(lang, has_full_access(user_ctx)), parse_mode="Markdown")
 
 @dp.callback_query(F.data == "end_session")
-async def end_session(callback: CallbackQuery):
+async def end_session(callback: CallbackQuery, user_ctx: UserContext):
     user_id = callback.from_user.id
-    lang = db.get_language(user_id)
+    lang = user_ctx.language
     session = user_sessions.get(user_id)
     
     if session and session.get("confessional"):
@@ -254,15 +301,15 @@ async def end_session(callback: CallbackQuery):
         
         await callback.message.edit_text(f"🕯️ Confession ended\n\n{deleted} messages deleted.\nWhat was said stays between us.")
     elif session:
-        db.end_session(session["id"])
+        await adb.end_session(user_id, session["id"])
         user_sessions.pop(user_id, None)
-        await callback.message.edit_text("✅ Conversation ended.", reply_markup=get_main_menu(lang, has_full_access(user_id)))
+        await callback.message.edit_text("✅ Conversation ended.", reply_markup=get_main_menu(lang, has_full_access(user_ctx)))
     else:
-        await callback.message.edit_text("No active conversation.", reply_markup=get_main_menu(lang, has_full_access(user_id)))
+        await callback.message.edit_text("No active conversation.", reply_markup=get_main_menu(lang, has_full_access(user_ctx)))
 
 @dp.callback_query(F.data == "settings")
-async def show_settings(callback: CallbackQuery):
-    lang = db.get_language(callback.from_user.id)
+async def show_settings(callback: CallbackQuery, user_ctx: UserContext):
+    lang = user_ctx.language
     buttons = [
         [InlineKeyboardButton(text="🇷🇺 Русский", callback_data="set_lang_ru")],
         [InlineKeyboardButton(text="🇺🇸 English", callback_data="set_lang_en")],
@@ -270,16 +317,17 @@ async def show_settings(callback: CallbackQuery):
     await callback.message.edit_text(get_text("choose_language", lang), reply_markup=InlineKeyboardMarkup(inline_keyboard=buttons))
 
 @dp.callback_query(F.data.startswith("set_lang_"))
-async def set_language(callback: CallbackQuery):
+async def set_language(callback: CallbackQuery, user_ctx: UserContext):
     new_lang = callback.data.split("_")[-1]
-    db.set_language(callback.from_user.id, new_lang)
-    await callback.message.edit_text(get_text("language_set", new_lang), reply_markup=get_main_menu(new_lang, has_full_access(callback.from_user.id)))
+    await adb.set_language(callback.from_user.id, new_lang)
+    user_ctx.language = new_lang
+    await callback.message.edit_text(get_text("language_set", new_lang), reply_markup=get_main_menu(new_lang, has_full_access(user_ctx)))
 
 @dp.callback_query(F.data == "referral")
-async def show_referral(callback: CallbackQuery):
+async def show_referral(callback: CallbackQuery, user_ctx: UserContext):
     user_id = callback.from_user.id
-    lang = db.get_language(user_id)
-    stats = db.get_referral_stats(user_id)
+    lang = user_ctx.language
+    stats = await adb.get_referral_stats(user_id)
     
     text = referral_system.get_referral_bonus_text(lang)
     text += f"\n\n🔗 Link: {referral_system.get_referral_link(user_id)}"
@@ -288,57 +336,47 @@ async def show_referral(callback: CallbackQuery):
     await callback.message.edit_text(text, reply_markup=referral_system.get_referral_keyboard(lang, user_id))
 
 @dp.callback_query(F.data == "show_referral_stats")
-async def show_referral_stats(callback: CallbackQuery):
+async def show_referral_stats(callback: CallbackQuery, user_ctx: UserContext):
     user_id = callback.from_user.id
-    lang = db.get_language(user_id)
-    stats = db.get_referral_stats(user_id)
+    lang = user_ctx.language
+    stats = await adb.get_referral_stats(user_id)
     
     text = referral_system.get_referral_stats_text(lang, stats, user_id)
     
     await callback.message.edit_text(text, reply_markup=referral_system.get_referral_stats_keyboard(lang, user_id))
 
 @dp.callback_query(F.data == "back_to_referral")
-async def back_to_referral(callback: CallbackQuery):
-    await show_referral(callback)
+async def back_to_referral(callback: CallbackQuery, user_ctx: UserContext):
+    await show_referral(callback, user_ctx)
 
 @dp.callback_query(F.data == "back_to_menu")
-async def back_to_menu(callback: CallbackQuery):
-    user_id = callback.from_user.id
-    lang = db.get_language(user_id)
-    
-    user = db.get_user(user_id)
-    trial_msg = ""
-    if user and user.get("trial_until") and not user.get("trial_used"):
-        if datetime.fromisoformat(user["trial_until"]) < datetime.now():
-            db.end_trial(user_id)
-            trial_msg = get_text("trial_ended", lang) + "\n\n"
-        else:
-            trial_msg = f"🎁 Trial until {user['trial_until'][:10]}\n\n"
+async def back_to_menu(callback: CallbackQuery, user_ctx: UserContext):
+    lang = user_ctx.language
+    trial_msg = await get_trial_message(user_ctx, lang)
     
     greeting = get_text(get_night_greeting_key(), lang)
     welcome = get_text("welcome", lang)
-    status = get_access_status(user_id)
+    status = get_access_status(user_ctx)
     
     text = f"{greeting}\n\n{trial_msg}{welcome}\n\n📊 Status: {status}"
     
-    await callback.message.edit_text(text, reply_markup=get_main_menu(lang, has_full_access(user_id)), parse_mode="Markdown")
+    await callback.message.edit_text(text, reply_markup=get_main_menu(lang, has_full_access(user_ctx)), parse_mode="Markdown")
 
 # ==================== МОНЕТИЗАЦИЯ (TELEGRAM STARS) ====================
 
 @dp.callback_query(F.data == "start_chat")
-async def start_chat(callback: CallbackQuery):
+async def start_chat(callback: CallbackQuery, user_ctx: UserContext):
     user_id = callback.from_user.id
-    lang = db.get_language(user_id)
+    lang = user_ctx.language
     
     # ПРОВЕРКА ЛИМИТА для бесплатных
-    if not has_full_access(user_id):
-        count = db.check_and_reset_night_counter(user_id)
-        if count >= 3:
-            text = f"🚫 {get_text('limit_reached', lang)}\n\nYour status: {get_access_status(user_id)}"
+    if not has_full_access(user_ctx):
+        if await adb.quota_left(user_id, "message") <= 0:
+            text = f"🚫 {get_text('limit_reached', lang)}\n\nYour status: {get_access_status(user_ctx)}"
             await callback.message.edit_text(text, reply_markup=get_main_menu(lang, False))
             return
     
-    session_id = db.start_session(user_id, is_confessional=False)
+    session_id = await adb.start_session(user_id, is_confessional=False)
     user_sessions[user_id] = {
         "id": session_id,
         "confessional": False,
@@ -347,20 +385,19 @@ async def start_chat(callback: CallbackQuery):
         "premium_temp": False
     }
     
-    await callback.message.edit_text(get_text("chat_started", lang), reply_markup=get_main_menu(lang, has_full_access(user_id), in_session=True))
+    await callback.message.edit_text(get_text("chat_started", lang), reply_markup=get_main_menu(lang, has_full_access(user_ctx), in_session=True))
 
 @dp.callback_query(F.data == "confessional")
-async def start_confessional(callback: CallbackQuery):
+async def start_confessional(callback: CallbackQuery, user_ctx: UserContext):
     user_id = callback.from_user.id
-    lang = db.get_language(user_id)
+    lang = user_ctx.language
     
-    # ПРОВЕРКА ЛИМИТА: 1 исповедь за день
-    if not has_full_access(user_id):
-        limits = check_and_init_limits(user_id)
-        if limits["confessional_count"] >= 1:
+    # ПРОВЕРКА ЛИМИТА: 1 исповедь за день (проверка и списание — одним запросом)
+    if not has_full_access(user_ctx):
+        if not await adb.consume_quota(user_id, "confessional"):
             text = (
                 f"🚫 Confession limit reached!\n\n"
-                f"Your status: {get_access_status(user_id)}\n\n"
+                f"Your status: {get_access_status(user_ctx)}\n\n"
                 f"Buy Premium (⭐ 150) or single session (💫 50) for unlimited access."
             )
             await callback.message.edit_text(text, reply_markup=get_main_menu(lang, False))
@@ -376,41 +413,51 @@ async def start_confessional(callback: CallbackQuery):
         "premium_temp": False
     }
     
-    if not has_full_access(user_id):
-        user_limits[user_id]["confessional_count"] += 1
-    
-    await callback.message.edit_text(get_text("confessional_started", lang), reply_markup=get_main_menu(lang, has_full_access(user_id), in_session=True))
+    await callback.message.edit_text(get_text("confessional_started", lang), reply_markup=get_main_menu(lang, has_full_access(user_ctx), in_session=True))
 
 @dp.callback_query(F.data == "sleep_story")
-async def generate_story(callback: CallbackQuery):
+async def generate_story(callback: CallbackQuery, user_ctx: UserContext):
     user_id = callback.from_user.id
-    lang = db.get_language(user_id)
+    lang = user_ctx.language
     
     # ПРОВЕРКА ЛИМИТА: 1 история за день
-    if not has_full_access(user_id):
-        limits = check_and_init_limits(user_id)
-        if limits["story_used"]:
+    free_user = not has_full_access(user_ctx)
+    if free_user:
+        if not await adb.consume_quota(user_id, "story"):
             text = (
                 f"🚫 Story limit reached!\n\n"
-                f"Your status: {get_access_status(user_id)}\n\n"
+                f"Your status: {get_access_status(user_ctx)}\n\n"
                 f"Buy Premium (⭐ 150) or single session (💫 50) for a new story."
             )
             await callback.message.edit_text(text, reply_markup=get_main_menu(lang, False))
             return
     
+    # Готовая история из пула — ответ без ожидания LLM
+    story = story_pool.take(user_id, lang)
+    if story:
+        await callback.message.edit_text(get_text("story_ready", lang, text=story))
+        await adb.log_event(user_id, "story_generated", lang)
+        return
+    
     msg = await callback.message.edit_text(get_text("story_generating", lang))
     
     try:
-        story = await ai_service.generate_sleep_story(lang)
-        await msg.edit_text(get_text("story_ready", lang, text=story))
-        
-        if not has_full_access(user_id):
-            user_limits[user_id]["story_used"] = True
+        if config.STREAM_RESPONSES:
+            await stream_to_message(
+                ai_service.stream_sleep_story(lang),
+                lambda story: get_text("story_ready", lang, text=story),
+                message=msg
+            )
+        else:
+            story = await ai_service.generate_sleep_story(lang)
+            await msg.edit_text(get_text("story_ready", lang, text=story))
         
-        db.log_event(user_id, "story_generated", lang)
+        await adb.log_event(user_id, "story_generated", lang)
         
     except Exception as e:
         print(f"Story error: {e}")
+        if free_user:
+            await adb.refund_quota(user_id, "story")
         await msg.edit_text("❌ Generation error. Please try later.")
 
 # ===== ОПЛАТА TELEGRAM STARS (ИСПРАВЛЕННАЯ) =====
@@ -418,8 +465,6 @@ async def generate_story(callback: CallbackQuery):
 @dp.callback_query(F.data == "buy_premium")
 async def buy_premium(callback: CallbackQuery):
     """Покупка Premium через Telegram Stars"""
-    lang = db.get_language(callback.from_user.id)
-    
     await bot.send_invoice(
         chat_id=callback.from_user.id,
         title="⭐ Night Whisper Premium",
@@ -434,8 +479,6 @@ async def buy_premium(callback: CallbackQuery):
 @dp.callback_query(F.data == "buy_session")
 async def buy_session(callback: CallbackQuery):
     """Покупка разового сеанса через Telegram Stars"""
-    lang = db.get_language(callback.from_user.id)
-    
     await bot.send_invoice(
         chat_id=callback.from_user.id,
         title="💫 Deep Session",
@@ -454,26 +497,26 @@ async def process_pre_checkout(query: PreCheckoutQuery):
     await bot.answer_pre_checkout_query(query.id, ok=True)
 
 @dp.message(F.successful_payment)
-async def successful_payment(message: Message):
+async def successful_payment(message: Message, user_ctx: UserContext):
     """Обработка успешной оплаты"""
     user_id = message.from_user.id
-    lang = db.get_language(user_id)
+    lang = user_ctx.language
     payment = message.successful_payment
     
     if payment.invoice_payload == "premium_1month":
         # Premium на 30 дней
-        db.add_premium(user_id, 30)
-        db.process_referral_conversion(user_id)
+        await adb.add_premium(user_id, 30)
+        await adb.process_referral_conversion(user_id)
         
         await message.answer(
             get_text("premium_activated", lang),
             parse_mode="Markdown"
         )
-        db.log_event(user_id, "purchase_premium", f"150_stars_{payment.telegram_payment_charge_id}")
+        await adb.log_event(user_id, "purchase_premium", f"150_stars_{payment.telegram_payment_charge_id}")
         
     elif payment.invoice_payload == "deep_session":
         # Разовый сеанс
-        session_id = db.start_session(user_id)
+        session_id = await adb.start_session(user_id)
         user_sessions[user_id] = {
             "id": session_id,
             "confessional": False,
@@ -487,21 +530,18 @@ async def successful_payment(message: Message):
             reply_markup=get_main_menu(lang, True, in_session=True),
             parse_mode="Markdown"
         )
-        db.log_event(user_id, "purchase_session", f"50_stars_{payment.telegram_payment_charge_id}")
+        await adb.log_event(user_id, "purchase_session", f"50_stars_{payment.telegram_payment_charge_id}")
 
 # ==================== ОБРАБОТКА СООБЩЕНИЙ ====================
 
 @dp.message(F.voice)
-async def handle_voice(message: Message):
+async def handle_voice(message: Message, user_ctx: UserContext):
     user_id = message.from_user.id
-    
-    if db.is_blocked(user_id):
-        return
+    lang = user_ctx.language
     
     session = user_sessions.get(user_id)
     if not session:
-        lang = db.get_language(user_id)
-        await message.answer("Choose mode in menu:", reply_markup=get_main_menu(lang, has_full_access(user_id)))
+        await message.answer("Choose mode in menu:", reply_markup=get_main_menu(lang, has_full_access(user_ctx)))
         return
     
     if session.get("confessional"):
@@ -509,50 +549,64 @@ async def handle_voice(message: Message):
             confessional_messages[user_id] = []
         confessional_messages[user_id].append(message.message_id)
     
+    # Слишком длинные голосовые отсекаются по метаданным — до квоты и скачивания
+    voice = message.voice
+    if voice.duration > config.VOICE_MAX_SECONDS or (voice.file_size or 0) > config.VOICE_MAX_BYTES:
+        await message.answer(f"🎤 Voice message is too long (max {config.VOICE_MAX_SECONDS // 60} min). Please send a shorter one or type.")
+        return
+    
     # Проверка лимитов
-    if not has_full_access(user_id) and not session.get("confessional"):
-        count = db.check_and_reset_night_counter(user_id)
-        if count >= 3:
-            lang = db.get_language(user_id)
+    # Сообщение списывается здесь, до распознавания; process_message голос повторно не считает
+    if not has_full_access(user_ctx) and not session.get("confessional"):
+        if not await adb.consume_quota(user_id, "message"):
             await message.answer(get_text("limit_reached", lang), reply_markup=get_main_menu(lang, False))
             return
-        db.increment_night_counter(user_id)
     
     await bot.send_chat_action(user_id, "typing")
     
     try:
-        voice_file = await bot.get_file(message.voice.file_id)
-        voice_data = await bot.download_file(voice_file.file_path)
-        transcribed_text = await ai_service.transcribe_voice(voice_data.read())
+        # Пересланное или повторно отправленное голосовое уже распознавалось — ни get_file, ни Whisper
+        language = ai_service.whisper_language(lang) or "auto"
+        transcribed_text = await adb.get_transcription(voice.file_unique_id, language)
+        if transcribed_text is None:
+            started = time.monotonic()
+            voice_file = await bot.get_file(voice.file_id)
+            timings = {"get_file_ms": round((time.monotonic() - started) * 1000)}
+            # Файл не собирается в памяти: куски из Telegram сразу уходят в загрузку к Whisper
+            chunks = bot.session.stream_content(
+                bot.session.api.file_url(bot.token, voice_file.file_path),
+                timeout=config.VOICE_TIMEOUT_SECONDS,
+                chunk_size=config.VOICE_CHUNK_BYTES
+            )
+            transcribed_text = await ai_service.transcribe_voice(chunks, lang=lang, timings=timings)
+            timings["total_ms"] = round((time.monotonic() - started) * 1000)
+            print(f"🎤 Voice {voice.duration}s from {user_id}: {timings}")
+            # Кэшируем только ответ Whisper (есть его время), не заглушки ошибок; текст исповеди на диск не пишем
+            if "whisper_ms" in timings and not session.get("confessional"):
+                await adb.save_transcription(voice.file_unique_id, language, transcribed_text)
         
         if session.get("confessional"):
             await message.reply(f"🎤 Recognized: {transcribed_text[:100]}...")
         
-        await process_message(user_id, transcribed_text, is_voice=True)
+        await process_message(user_ctx, transcribed_text, is_voice=True)
         
     except Exception as e:
         print(f"Voice processing error: {e}")
-        lang = db.get_language(user_id)
         await message.answer("🎤 Could not recognize voice. Try text.")
 
 @dp.message(F.text)
-async def handle_text(message: Message):
-    user_id = message.from_user.id
-    
-    if db.is_blocked(user_id):
-        return
-    
-    await process_message(user_id, message.text, is_voice=False, original_message=message)
+async def handle_text(message: Message, user_ctx: UserContext):
+    await process_message(user_ctx, message.text, is_voice=False, original_message=message)
 
-async def process_message(user_id: int, text: str, is_voice: bool = False, original_message: Message = None):
-    check_and_init_limits(user_id)
-    db.update_last_active(user_id)
+async def process_message(user_ctx: UserContext, text: str, is_voice: bool = False, original_message: Message = None):
+    user_id = user_ctx.user_id
+    lang = user_ctx.language
+    await adb.update_last_active(user_id)
     
     session = user_sessions.get(user_id)
     if not session:
-        lang = db.get_language(user_id)
         msg = original_message or await bot.send_message(user_id, "Choose mode:")
-        await msg.answer("Choose mode in menu:", reply_markup=get_main_menu(lang, has_full_access(user_id)))
+        await msg.answer("Choose mode in menu:", reply_markup=get_main_menu(lang, has_full_access(user_ctx)))
         return
     
     if session.get("confessional") and original_message:
@@ -564,20 +618,17 @@ async def process_message(user_id: int, text: str, is_voice: bool = False, origi
     if session.get("confessional"):
         elapsed = datetime.now() - session["start_time"]
         if elapsed > timedelta(minutes=40):
-            await end_session_manual(user_id)
+            await end_session_manual(user_ctx)
             return
     
     # Проверка лимитов
-    is_premium_session = has_full_access(user_id)
+    is_premium_session = has_full_access(user_ctx)
     
-    if not is_premium_session and not session.get("confessional"):
-        count = db.check_and_reset_night_counter(user_id)
-        if count >= 3:
-            lang = db.get_language(user_id)
+    if not is_premium_session and not session.get("confessional") and not is_voice:
+        if not await adb.consume_quota(user_id, "message"):
             msg = original_message or await bot.send_message(user_id, "Limit")
             await msg.answer(get_text("limit_reached", lang), reply_markup=get_main_menu(lang, False))
             return
-        db.increment_night_counter(user_id)
     
     await bot.send_chat_action(user_id, "typing")
     
@@ -585,40 +636,47 @@ async def process_message(user_id: int, text: str, is_voice: bool = False, origi
     history.append({"role": "user", "content": text})
     
     try:
-        response = await ai_service.get_response(
-            history, 
-            db.get_language(user_id),
-            "confessional" if session.get("confessional") else "normal"
-        )
+        mode = "confessional" if session.get("confessional") else "normal"
+        lane = get_llm_lane(user_ctx)
         
-        if original_message:
-            sent_msg = await original_message.answer(response)
+        if config.STREAM_RESPONSES:
+            send = original_message.answer if original_message else (lambda text: bot.send_message(user_id, text))
+            response, sent_msg = await stream_to_message(
+                ai_service.stream_response(history, lang, mode, lane=lane),
+                lambda text: text,
+                send=send
+            )
         else:
-            sent_msg = await bot.send_message(user_id, response)
+            response = await ai_service.get_response(history, lang, mode, lane=lane)
+            
+            if original_message:
+                sent_msg = await original_message.answer(response)
+            else:
+                sent_msg = await bot.send_message(user_id, response)
         
         if session.get("confessional"):
             confessional_messages[user_id].append(sent_msg.message_id)
         
         history.append({"role": "assistant", "content": response})
-        session["messages"] = history[-10:]
+        # Сколько из этого уйдёт в LLM, решает бюджет токенов в ai_service
+        session["messages"] = history[-config.LLM_HISTORY_MAX_MESSAGES:]
         
         if not session.get("confessional"):
-            db.add_message(user_id, session["id"], text, True)
-            db.add_message(user_id, session["id"], response, False)
+            await adb.add_message(user_id, session["id"], text, True)
+            await adb.add_message(user_id, session["id"], response, False)
         
-        db.log_event(user_id, "message_sent", db.get_language(user_id))
+        await adb.log_event(user_id, "message_sent", lang)
         
     except Exception as e:
         print(f"AI Error: {e}")
-        lang = db.get_language(user_id)
         fallback = "🌙 I'm here. Tell me more about what's bothering you?"
         if original_message:
             await original_message.answer(fallback)
         else:
             await bot.send_message(user_id, fallback)
 
-async def end_session_manual(user_id: int):
-    lang = db.get_language(user_id)
+async def end_session_manual(user_ctx: UserContext):
+    user_id = user_ctx.user_id
     session = user_sessions.get(user_id)
     
     if session and session.get("confessional"):
@@ -655,7 +713,30 @@ def run_web_server():
     print(f"🌐 Web server starting on port {port}")
     server.serve_forever()
 
+async def archive_loop():
+    """Раз в ARCHIVE_INTERVAL_HOURS переносит старые диалоги и события в архив"""
+    while True:
+        try:
+            moved = await asyncio.to_thread(archiver.run)
+            print(f"🗄 Archived: {moved}")
+        except Exception as e:
+            print(f"Archive error: {e}")
+        await asyncio.sleep(config.ARCHIVE_INTERVAL_HOURS * 3600)
+
+async def on_startup():
+    await ai_service.start()
+    asyncio.create_task(archive_loop())
+    asyncio.create_task(story_pool.run())
+
+async def on_shutdown():
+    await ai_service.close()
+    # Дожидаемся записей в потоке-писателе и закрываем соединения
+    await asyncio.to_thread(adb.shutdown)
+
 async def main():
+    dp.startup.register(on_startup)
+    dp.shutdown.register(on_shutdown)
+    
     web_thread = threading.Thread(target=run_web_server, daemon=True)
     web_thread.start()
     
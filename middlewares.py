@@ -0,0 +1,153 @@
+import time
+from array import array
+from dataclasses import dataclass
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple
+
+from aiogram import BaseMiddleware
+from aiogram.types import TelegramObject, Update, User
+
+from config import config
+from database import adb, db, Database
+
+@dataclass
+class UserContext:
+    """Снимок пользователя на время одного апдейта — один SELECT вместо ~8"""
+    user_id: int
+    exists: bool = False
+    language: str = "en"
+    is_premium: bool = False
+    is_trial_active: bool = False
+    trial_until_ts: Optional[int] = None
+    trial_used: bool = False
+
+    @classmethod
+    def from_row(cls, user_id: int, user: Optional[Dict]) -> "UserContext":
+        if not user:
+            return cls(user_id=user_id)
+        return cls(
+            user_id=user_id,
+            exists=True,
+            language=user.get("language") or "en",
+            is_premium=Database.premium_active(user),
+            is_trial_active=Database.trial_active(user),
+            trial_until_ts=user.get("trial_until_ts"),
+            trial_used=bool(user.get("trial_used"))
+        )
+
+class BlocklistMiddleware(BaseMiddleware):
+    """Отбрасывает апдейты заблокированных пользователей до любых хендлеров и запросов к БД"""
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: Dict[str, Any]
+    ) -> Any:
+        user: Optional[User] = data.get("event_from_user")
+        if user and db.is_blocked(user.id):
+            return None
+        return await handler(event, data)
+
+async def load_user_context(user_id: int) -> UserContext:
+    return UserContext.from_row(user_id, await adb.get_user(user_id))
+
+class UserContextLoader(BaseMiddleware):
+    """Загружает UserContext один раз на апдейт и передаёт его в хендлеры как `user_ctx`"""
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: Dict[str, Any]
+    ) -> Any:
+        user: Optional[User] = data.get("event_from_user")
+        if user:
+            data["user_ctx"] = await load_user_context(user.id)
+        return await handler(event, data)
+
+class TokenBucketLimiter:
+    """Token bucket на (user_id, действие) в заранее выделенных массивах: ленивое пополнение, вытеснение простаивающих"""
+
+    def __init__(self, max_buckets: int = 50000, idle_seconds: float = 600):
+        self.max_buckets = max_buckets
+        self.idle_seconds = idle_seconds
+        self._tokens = array("d", bytes(8 * max_buckets))
+        self._updated = array("d", bytes(8 * max_buckets))
+        self._slots: Dict[Tuple[int, str], int] = {}
+        self._free: List[int] = list(range(max_buckets - 1, -1, -1))
+        self.allowed = 0
+        self.rejected = 0
+
+    def _evict_idle(self, now: float):
+        cutoff = now - self.idle_seconds
+        idle = [key for key, slot in self._slots.items() if self._updated[slot] < cutoff]
+        if not idle:
+            # Все активны — освобождаем самые давние по последнему обращению
+            idle = sorted(self._slots, key=lambda key: self._updated[self._slots[key]])[:max(1, self.max_buckets // 10)]
+        for key in idle:
+            self._free.append(self._slots.pop(key))
+
+    def allow(self, user_id: int, action: str, per_minute: float, burst: int) -> bool:
+        now = time.monotonic()
+        key = (user_id, action)
+        slot = self._slots.get(key)
+        if slot is None:
+            if not self._free:
+                self._evict_idle(now)
+            slot = self._free.pop()
+            self._slots[key] = slot
+            tokens = float(burst)
+        else:
+            tokens = min(float(burst), self._tokens[slot] + (now - self._updated[slot]) * per_minute / 60)
+        self._updated[slot] = now
+        if tokens >= 1:
+            self._tokens[slot] = tokens - 1
+            self.allowed += 1
+            return True
+        self._tokens[slot] = tokens
+        self.rejected += 1
+        return False
+
+    def stats(self) -> Dict:
+        return {"buckets": len(self._slots), "allowed": self.allowed, "rejected": self.rejected}
+
+class RateLimitMiddleware(BaseMiddleware):
+    """Отсекает всплески сообщений и колбэков до загрузки пользователя и вызовов LLM"""
+
+    # действие: (в минуту, всплеск)
+    LIMITS = {
+        "message": (config.RATE_MESSAGES_PER_MINUTE, config.RATE_MESSAGES_BURST),
+        "sleep_story": (config.RATE_STORIES_PER_MINUTE, config.RATE_STORIES_BURST),
+        "callback": (config.RATE_CALLBACKS_PER_MINUTE, config.RATE_CALLBACKS_BURST),
+    }
+
+    def __init__(self, limiter: Optional[TokenBucketLimiter] = None):
+        self.limiter = limiter or TokenBucketLimiter(config.RATE_LIMIT_MAX_BUCKETS, config.RATE_LIMIT_IDLE_SECONDS)
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: Dict[str, Any]
+    ) -> Any:
+        user: Optional[User] = data.get("event_from_user")
+        if not user or not isinstance(event, Update):
+            return await handler(event, data)
+
+        if event.message and not event.message.successful_payment:
+            action = "message"
+        elif event.callback_query:
+            action = event.callback_query.data if event.callback_query.data in self.LIMITS else "callback"
+        else:
+            return await handler(event, data)
+
+        per_minute, burst = self.LIMITS[action]
+        if self.limiter.allow(user.id, action, per_minute, burst):
+            return await handler(event, data)
+
+        if event.callback_query:
+            try:
+                await event.callback_query.answer("⏳ Too many requests, please wait a moment.")
+            except Exception:
+                pass
+        return None
@@ -0,0 +1,554 @@
+import ast
+import os
+import re
+import sqlite3
+import sys
+from typing import List, Tuple
+
+# Упорядоченные шаги миграций: (версия, название, SQL). Применённые шаги не меняем — только добавляем новые.
+MIGRATIONS: List[Tuple[int, str, str]] = [
+    (1, "base schema", """
+        CREATE TABLE IF NOT EXISTS users (
+            user_id INTEGER PRIMARY KEY,
+            username TEXT,
+            language TEXT DEFAULT 'en',
+            premium_until TIMESTAMP,
+            is_premium BOOLEAN DEFAULT 0,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            night_messages_count INTEGER DEFAULT 0,
+            last_night_date TEXT,
+            last_active TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            total_messages INTEGER DEFAULT 0,
+            referrer_id INTEGER,
+            referral_count INTEGER DEFAULT 0,
+            bonus_messages INTEGER DEFAULT 0,
+            is_blocked BOOLEAN DEFAULT 0,
+            trial_until TIMESTAMP,
+            trial_used BOOLEAN DEFAULT 0
+        );
+
+        CREATE TABLE IF NOT EXISTS sessions (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER,
+            start_time TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            end_time TIMESTAMP,
+            is_active BOOLEAN DEFAULT 1,
+            is_confessional BOOLEAN DEFAULT 0
+        );
+
+        CREATE TABLE IF NOT EXISTS conversations (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER,
+            session_id INTEGER,
+            content TEXT,
+            is_user BOOLEAN,
+            timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            is_confessional BOOLEAN DEFAULT 0
+        );
+
+        CREATE TABLE IF NOT EXISTS analytics_events (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER,
+            event_type TEXT,
+            event_data TEXT,
+            timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        );
+
+        CREATE TABLE IF NOT EXISTS referrals (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            referrer_id INTEGER,
+            referred_id INTEGER,
+            status TEXT DEFAULT 'pending',
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            converted_at TIMESTAMP,
+            bonus_given BOOLEAN DEFAULT 0
+        );
+
+        CREATE TABLE IF NOT EXISTS retention_messages (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER,
+            message_type TEXT,
+            sent_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            opened BOOLEAN DEFAULT 0
+        );
+
+        CREATE TABLE IF NOT EXISTS admin_actions (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            admin_id INTEGER,
+            action_type TEXT,
+            target_user_id INTEGER,
+            details TEXT,
+            timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        );
+
+        CREATE TABLE IF NOT EXISTS conversation_topics (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            conversation_id INTEGER,
+            topic TEXT,
+            sentiment TEXT,
+            timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        );
+
+        CREATE INDEX IF NOT EXISTS idx_users_active ON users(last_active);
+        CREATE INDEX IF NOT EXISTS idx_analytics_time ON analytics_events(timestamp);
+        CREATE INDEX IF NOT EXISTS idx_referrals_ref ON referrals(referrer_id);
+        CREATE INDEX IF NOT EXISTS idx_events_type ON analytics_events(event_type);
+        CREATE INDEX IF NOT EXISTS idx_events_date ON analytics_events(timestamp);
+    """),
+    (2, "indexes for real query patterns", """
+        -- get_active_session: активная сессия пользователя, последняя по id
+        CREATE INDEX IF NOT EXISTS idx_sessions_user_active ON sessions(user_id) WHERE is_active = 1;
+
+        -- process_referral_conversion: поиск и обновление по referred_id + status (покрывающий)
+        CREATE INDEX IF NOT EXISTS idx_referrals_referred ON referrals(referred_id, status, referrer_id);
+
+        -- get_referral_stats: COUNT/SUM по referrer_id без чтения таблицы
+        CREATE INDEX IF NOT EXISTS idx_referrals_ref_status ON referrals(referrer_id, status);
+        DROP INDEX IF EXISTS idx_referrals_ref;
+
+        -- get_stats: события по типу за период, рефералы за период
+        CREATE INDEX IF NOT EXISTS idx_events_type_time ON analytics_events(event_type, timestamp);
+        DROP INDEX IF EXISTS idx_events_type;
+        DROP INDEX IF EXISTS idx_events_date;
+        CREATE INDEX IF NOT EXISTS idx_referrals_created ON referrals(created_at, status);
+
+        -- get_stats: новые пользователи, premium и языки читаются из индексов
+        CREATE INDEX IF NOT EXISTS idx_users_created ON users(created_at);
+        CREATE INDEX IF NOT EXISTS idx_users_premium ON users(is_premium);
+        CREATE INDEX IF NOT EXISTS idx_users_language ON users(language);
+
+        -- get_inactive_users: частичный покрывающий индекс только по незаблокированным
+        CREATE INDEX IF NOT EXISTS idx_users_inactive ON users(last_active, language, username) WHERE is_blocked = 0;
+
+        -- analytics.get_stats: сообщения за период
+        CREATE INDEX IF NOT EXISTS idx_conversations_time ON conversations(timestamp);
+
+        -- Загрузка блок-листа при старте
+        CREATE INDEX IF NOT EXISTS idx_users_blocked ON users(user_id) WHERE is_blocked = 1;
+    """),
+    (3, "daily rollups for stats", """
+        -- Предагрегаты по дням (UTC, как CURRENT_TIMESTAMP): дашборды читают их вместо COUNT(*) по сырым таблицам
+        CREATE TABLE IF NOT EXISTS daily_event_rollup (
+            day TEXT NOT NULL,
+            event_type TEXT NOT NULL,
+            language TEXT NOT NULL,
+            count INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (day, event_type, language)
+        ) WITHOUT ROWID;
+
+        CREATE TABLE IF NOT EXISTS daily_user_rollup (
+            day TEXT NOT NULL,
+            language TEXT NOT NULL,
+            new_users INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (day, language)
+        ) WITHOUT ROWID;
+
+        CREATE TABLE IF NOT EXISTS hourly_activity_rollup (
+            day TEXT NOT NULL,
+            hour INTEGER NOT NULL,
+            messages INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (day, hour)
+        ) WITHOUT ROWID;
+
+        -- Заполняем по уже накопленным данным
+        INSERT OR REPLACE INTO daily_event_rollup (day, event_type, language, count)
+            SELECT date(e.timestamp), COALESCE(e.event_type, ''), COALESCE(u.language, ''), COUNT(*)
+            FROM analytics_events e LEFT JOIN users u ON u.user_id = e.user_id
+            WHERE e.timestamp IS NOT NULL
+            GROUP BY 1, 2, 3;
+
+        INSERT OR REPLACE INTO daily_user_rollup (day, language, new_users)
+            SELECT date(created_at), COALESCE(language, ''), COUNT(*)
+            FROM users WHERE created_at IS NOT NULL
+            GROUP BY 1, 2;
+
+        INSERT OR REPLACE INTO hourly_activity_rollup (day, hour, messages)
+            SELECT date(timestamp), CAST(strftime('%H', timestamp) AS INTEGER), COUNT(*)
+            FROM conversations WHERE timestamp IS NOT NULL
+            GROUP BY 1, 2;
+
+        -- Конверсия когорты (analytics.get_stats) читается из индекса без обращения к таблице
+        CREATE INDEX IF NOT EXISTS idx_users_created_premium ON users(created_at, is_premium);
+        DROP INDEX IF EXISTS idx_users_created;
+
+        -- Инкрементальное обновление при каждой записи (в т.ч. пачками из write-behind)
+        CREATE TRIGGER IF NOT EXISTS trg_events_rollup AFTER INSERT ON analytics_events
+        WHEN NEW.timestamp IS NOT NULL
+        BEGIN
+            INSERT INTO daily_event_rollup (day, event_type, language, count)
+            VALUES (
+                date(NEW.timestamp),
+                COALESCE(NEW.event_type, ''),
+                COALESCE((SELECT language FROM users WHERE user_id = NEW.user_id), ''),
+                1
+            )
+            ON CONFLICT (day, event_type, language) DO UPDATE SET count = count + 1;
+        END;
+
+        CREATE TRIGGER IF NOT EXISTS trg_users_rollup AFTER INSERT ON users
+        WHEN NEW.created_at IS NOT NULL
+        BEGIN
+            INSERT INTO daily_user_rollup (day, language, new_users)
+            VALUES (date(NEW.created_at), COALESCE(NEW.language, ''), 1)
+            ON CONFLICT (day, language) DO UPDATE SET new_users = new_users + 1;
+        END;
+
+        CREATE TRIGGER IF NOT EXISTS trg_conversations_rollup AFTER INSERT ON conversations
+        WHEN NEW.timestamp IS NOT NULL
+        BEGIN
+            INSERT INTO hourly_activity_rollup (day, hour, messages)
+            VALUES (date(NEW.timestamp), CAST(strftime('%H', NEW.timestamp) AS INTEGER), 1)
+            ON CONFLICT (day, hour) DO UPDATE SET messages = messages + 1;
+        END;
+    """),
+    (4, "unified daily quotas", """
+        -- Счётчики бесплатных действий: message, story, confessional. day — локальная дата последнего списания
+        CREATE TABLE IF NOT EXISTS quotas (
+            user_id INTEGER NOT NULL,
+            action TEXT NOT NULL,
+            day TEXT NOT NULL,
+            used INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (user_id, action)
+        ) WITHOUT ROWID;
+
+        -- Переносим текущие ночные счётчики сообщений из users
+        INSERT OR IGNORE INTO quotas (user_id, action, day, used)
+            SELECT user_id, 'message', last_night_date, COALESCE(night_messages_count, 0)
+            FROM users WHERE last_night_date IS NOT NULL;
+    """),
+    (5, "integer epoch timestamps on users", """
+        -- Секунды Unix (UTC) вместо ISO-строк: сравнения целыми числами, без fromisoformat
+        ALTER TABLE users ADD COLUMN premium_until_ts INTEGER;
+        ALTER TABLE users ADD COLUMN trial_until_ts INTEGER;
+        ALTER TABLE users ADD COLUMN last_active_ts INTEGER;
+        ALTER TABLE users ADD COLUMN created_at_ts INTEGER;
+
+        -- isoformat() писался в локальном времени (с 'T'), CURRENT_TIMESTAMP — в UTC (через пробел)
+        UPDATE users SET
+            premium_until_ts = CAST(CASE WHEN instr(premium_until, 'T') THEN strftime('%s', premium_until, 'utc')
+                                         ELSE strftime('%s', premium_until) END AS INTEGER),
+            trial_until_ts = CAST(CASE WHEN instr(trial_until, 'T') THEN strftime('%s', trial_until, 'utc')
+                                       ELSE strftime('%s', trial_until) END AS INTEGER),
+            last_active_ts = CAST(CASE WHEN instr(last_active, 'T') THEN strftime('%s', last_active, 'utc')
+                                       ELSE strftime('%s', last_active) END AS INTEGER),
+            created_at_ts = CAST(CASE WHEN instr(created_at, 'T') THEN strftime('%s', created_at, 'utc')
+                                      ELSE strftime('%s', created_at) END AS INTEGER);
+
+        DROP INDEX IF EXISTS idx_users_active;
+        DROP INDEX IF EXISTS idx_users_inactive;
+        DROP INDEX IF EXISTS idx_users_premium;
+        DROP INDEX IF EXISTS idx_users_created_premium;
+
+        CREATE INDEX IF NOT EXISTS idx_users_inactive_ts ON users(last_active_ts, language, username) WHERE is_blocked = 0;
+        CREATE INDEX IF NOT EXISTS idx_users_premium_ts ON users(is_premium, premium_until_ts);
+        CREATE INDEX IF NOT EXISTS idx_users_created_ts ON users(created_at_ts, is_premium);
+    """),
+    (6, "keyset pagination indexes", """
+        -- iter_inactive_users: ключ (last_active_ts, user_id) целиком в индексе — страницы без сортировки
+        DROP INDEX IF EXISTS idx_users_inactive_ts;
+        CREATE INDEX IF NOT EXISTS idx_users_inactive_keyset
+            ON users(last_active_ts, user_id, language, username) WHERE is_blocked = 0;
+
+        -- iter_conversations(user_id=...): id внутри user_id идёт по порядку rowid
+        CREATE INDEX IF NOT EXISTS idx_conversations_user ON conversations(user_id);
+    """),
+    (7, "voice transcription cache", """
+        -- Общая таблица (нулевой шард): ключ — file_unique_id Telegram и язык распознавания ('auto' — автоопределение)
+        CREATE TABLE IF NOT EXISTS transcriptions (
+            file_unique_id TEXT NOT NULL,
+            language TEXT NOT NULL,
+            text TEXT NOT NULL,
+            created_at_ts INTEGER NOT NULL,
+            last_used_ts INTEGER NOT NULL,
+            PRIMARY KEY (file_unique_id, language)
+        ) WITHOUT ROWID;
+
+        -- Вытеснение давно не использованных записей сверх лимита
+        CREATE INDEX IF NOT EXISTS idx_transcriptions_last_used ON transcriptions(last_used_ts);
+    """),
+    (8, "cross-process user change log", """
+        -- Журнал изменений users для кэшей других процессов (админ-панель пишет в ту же БД).
+        -- Пишется триггером в той же транзакции, поэтому его не обойдёт ни один писатель
+        CREATE TABLE IF NOT EXISTS user_changes (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            changed_at_ts INTEGER NOT NULL
+        );
+
+        -- last_active_ts и total_messages не журналируются: их пишет горячий путь, а кэш обновляет их сам
+        CREATE TRIGGER IF NOT EXISTS trg_users_changes
+        AFTER UPDATE OF username, language, is_premium, premium_until_ts, trial_until_ts, trial_used,
+                        bonus_messages, referral_count, is_blocked ON users
+        BEGIN
+            INSERT INTO user_changes (user_id, changed_at_ts) VALUES (NEW.user_id, CAST(strftime('%s', 'now') AS INTEGER));
+            -- Храним последние 10000 записей; отставший сильнее процесс сбрасывает кэш целиком
+            DELETE FROM user_changes WHERE id <= last_insert_rowid() - 10000;
+        END;
+    """),
+    (9, "user totals rollups", """
+        -- Итоги по users для дашбордов без COUNT(*) по всей таблице; поддерживаются триггерами ниже
+        CREATE TABLE IF NOT EXISTS language_rollup (
+            language TEXT PRIMARY KEY,
+            users INTEGER NOT NULL DEFAULT 0
+        ) WITHOUT ROWID;
+
+        -- Активный Premium по часу окончания (premium_until_ts / 3600): срок истекает сам, без UPDATE
+        CREATE TABLE IF NOT EXISTS premium_rollup (
+            until_hour INTEGER PRIMARY KEY,
+            users INTEGER NOT NULL DEFAULT 0
+        );
+
+        -- Сколько из когорты дня регистрации сейчас с Premium (конверсия в analytics)
+        ALTER TABLE daily_user_rollup ADD COLUMN premium INTEGER NOT NULL DEFAULT 0;
+
+        -- Заполняем по уже накопленным данным
+        INSERT OR REPLACE INTO language_rollup (language, users)
+            SELECT COALESCE(language, ''), COUNT(*) FROM users GROUP BY 1;
+
+        INSERT OR REPLACE INTO premium_rollup (until_hour, users)
+            SELECT premium_until_ts / 3600, COUNT(*) FROM users
+            WHERE is_premium = 1 AND premium_until_ts IS NOT NULL
+            GROUP BY 1;
+
+        INSERT INTO daily_user_rollup (day, language, new_users, premium)
+            SELECT date(created_at), COALESCE(language, ''), 0, COUNT(*) FROM users
+            WHERE is_premium = 1 AND created_at IS NOT NULL
+            GROUP BY 1, 2
+            ON CONFLICT (day, language) DO UPDATE SET premium = excluded.premium;
+
+        CREATE TRIGGER IF NOT EXISTS trg_users_language_insert AFTER INSERT ON users
+        BEGIN
+            INSERT INTO language_rollup (language, users) VALUES (COALESCE(NEW.language, ''), 1)
+            ON CONFLICT (language) DO UPDATE SET users = users + 1;
+        END;
+
+        CREATE TRIGGER IF NOT EXISTS trg_users_language_update AFTER UPDATE OF language ON users
+        WHEN OLD.language IS NOT NEW.language
+        BEGIN
+            UPDATE language_rollup SET users = users - 1 WHERE language = COALESCE(OLD.language, '');
+            INSERT INTO language_rollup (language, users) VALUES (COALESCE(NEW.language, ''), 1)
+            ON CONFLICT (language) DO UPDATE SET users = users + 1;
+        END;
+
+        -- Выдача, продление и снятие Premium: строка уходит из часа старого срока в час нового
+        CREATE TRIGGER IF NOT EXISTS trg_users_premium_update AFTER UPDATE OF is_premium, premium_until_ts ON users
+        WHEN OLD.is_premium IS NOT NEW.is_premium OR OLD.premium_until_ts IS NOT NEW.premium_until_ts
+        BEGIN
+            UPDATE premium_rollup SET users = users - 1
+            WHERE OLD.is_premium = 1 AND until_hour = OLD.premium_until_ts / 3600;
+            INSERT INTO premium_rollup (until_hour, users)
+                SELECT NEW.premium_until_ts / 3600, 1 WHERE NEW.is_premium = 1 AND NEW.premium_until_ts IS NOT NULL
+            ON CONFLICT (until_hour) DO UPDATE SET users = users + 1;
+
+            INSERT INTO daily_user_rollup (day, language, new_users, premium)
+                SELECT date(NEW.created_at), COALESCE(NEW.language, ''), 0, NEW.is_premium - COALESCE(OLD.is_premium, 0)
+                WHERE NEW.created_at IS NOT NULL AND NEW.is_premium IS NOT OLD.is_premium
+            ON CONFLICT (day, language) DO UPDATE SET premium = premium + excluded.premium;
+        END;
+    """),
+]
+
+def _statements(sql: str) -> List[str]:
+    """Разбивает скрипт на отдельные выражения (с учётом строк и триггеров)"""
+    statements, buffer = [], ""
+    for line in sql.splitlines(keepends=True):
+        buffer += line
+        if sqlite3.complete_statement(buffer):
+            if buffer.strip():
+                statements.append(buffer.strip())
+            buffer = ""
+    if buffer.strip() and not buffer.strip().startswith("--"):
+        statements.append(buffer.strip())
+    return statements
+
+def shard_paths(db_path: str, shards: int = 1) -> List[str]:
+    """Файлы шардов: нулевой — сама db_path (в нём и общие таблицы), остальные — name.shardN.db рядом"""
+    root, ext = os.path.splitext(db_path)
+    return [db_path] + [f"{root}.shard{i}{ext}" for i in range(1, max(shards, 1))]
+
+def current_version(conn: sqlite3.Connection) -> int:
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS schema_version (
+            version INTEGER PRIMARY KEY,
+            name TEXT,
+            applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    """)
+    return conn.execute("SELECT COALESCE(MAX(version), 0) FROM schema_version").fetchone()[0]
+
+def migrate(db_path: str) -> int:
+    """Применяет недостающие миграции, каждую в своей транзакции. Возвращает версию схемы."""
+    conn = sqlite3.connect(db_path, isolation_level=None, timeout=30)
+    try:
+        version = current_version(conn)
+        for step_version, name, sql in MIGRATIONS:
+            if step_version <= version:
+                continue
+            # IMMEDIATE берёт блокировку записи: второй процесс дождётся и увидит версию заново
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                if current_version(conn) >= step_version:
+                    conn.execute("COMMIT")
+                    continue
+                for statement in _statements(sql):
+                    conn.execute(statement)
+                conn.execute("INSERT INTO schema_version (version, name) VALUES (?, ?)", (step_version, name))
+                conn.execute("COMMIT")
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+            version = step_version
+        return version
+    finally:
+        conn.close()
+
+# Проход, ограниченный самим запросом (LIMIT/OFFSET, частичный индекс): (константа, почему). Остальные SCAN — ошибка
+ALLOWED_SCANS = {
+    "BLOCKLIST_SQL": "частичный индекс idx_users_blocked содержит только заблокированных",
+    "CONVERSATION_SUMMARY_SQL": "обход индекса по времени от новых, остановка на LIMIT",
+    "ARCHIVE_CONVERSATION_SUMMARY_SQL": "обход индекса по времени от новых, остановка на LIMIT",
+    "EVICT_TRANSCRIPTIONS_SQL": "обход индекса last_used_ts ограничен OFFSET = размеру кэша",
+}
+
+# Таблицы, размер которых не растёт с числом пользователей: (таблица, почему)
+SMALL_TABLES = {
+    "language_rollup": "по строке на язык",
+}
+
+# Методы Database, которые выполняют SQL из аргументов, а не константу: (метод, почему)
+PASSTHROUGH_METHODS = {
+    "_keyset": "страницы ITER_*_SQL, их планы проверяются",
+}
+
+# SCAN — полный проход по таблице или индексу (в том числе COVERING INDEX); SEARCH — поиск по ключу
+_FULL_SCAN = re.compile(r"^SCAN (?!CONSTANT ROW)(\w+)")
+
+_DATABASE_PY = os.path.join(os.path.dirname(os.path.abspath(__file__)), "database.py")
+
+def checked_queries() -> List[Tuple[str, str, tuple]]:
+    """Запросы Database для проверки планов: (константа database.py, SQL, пример параметров)"""
+    # database сам импортирует migrations, поэтому не на уровне модуля
+    import database as db
+    return [
+        ("LAST_USER_CHANGE_SQL", db.LAST_USER_CHANGE_SQL, ()),
+        ("USER_CHANGES_SQL", db.USER_CHANGES_SQL, (0,)),
+        ("INSERT_USER_SQL", db.INSERT_USER_SQL, (1, "", "en", None, 0, 0, 0)),
+        ("GET_USER_SQL", db.GET_USER_SQL, (1,)),
+        ("SET_LANGUAGE_SQL", db.SET_LANGUAGE_SQL, ("en", 1)),
+        ("BLOCK_USER_SQL", db.BLOCK_USER_SQL, (1, 1)),
+        ("USER_BLOCKED_SQL", db.USER_BLOCKED_SQL, (1,)),
+        ("BLOCKLIST_SQL", db.BLOCKLIST_SQL, ()),
+        ("UPDATE_ACTIVITY_SQL", db.UPDATE_ACTIVITY_SQL, (0, 1, 1)),
+        ("ADD_BONUS_MESSAGES_SQL", db.ADD_BONUS_MESSAGES_SQL, (1, 1)),
+        ("END_TRIAL_SQL", db.END_TRIAL_SQL, (1,)),
+        ("ADD_PREMIUM_SQL", db.ADD_PREMIUM_SQL, (0, 1, 1)),
+        ("REMOVE_PREMIUM_SQL", db.REMOVE_PREMIUM_SQL, (1,)),
+        ("CONSUME_QUOTA_SQL", db.CONSUME_QUOTA_SQL, (1, "story", "", 1)),
+        ("CONSUME_MESSAGE_QUOTA_SQL", db.CONSUME_MESSAGE_QUOTA_SQL, (1, "message", "", 3)),
+        ("REFUND_QUOTA_SQL", db.REFUND_QUOTA_SQL, (1, "message")),
+        ("QUOTA_LEFT_SQL", db.QUOTA_LEFT_SQL, ("", "message", 1)),
+        ("START_SESSION_SQL", db.START_SESSION_SQL, (1, 0, None)),
+        ("ACTIVE_SESSION_SQL", db.ACTIVE_SESSION_SQL, (1,)),
+        ("END_SESSION_SQL", db.END_SESSION_SQL, (1, 1)),
+        ("INSERT_MESSAGE_SQL", db.INSERT_MESSAGE_SQL, (1, 1, "", 1, 0, "")),
+        ("INSERT_EVENT_SQL", db.INSERT_EVENT_SQL, (1, "", None, "")),
+        ("INSERT_REFERRAL_SQL", db.INSERT_REFERRAL_SQL, (1, 2)),
+        ("CONVERT_REFERRAL_SQL", db.CONVERT_REFERRAL_SQL, ("", 1)),
+        ("CREDIT_REFERRER_SQL", db.CREDIT_REFERRER_SQL, (1,)),
+        ("REFERRAL_STATS_SQL", db.REFERRAL_STATS_SQL, (1,)),
+        ("NEW_USERS_SQL", db.NEW_USERS_SQL, ("",)),
+        ("COHORT_PREMIUM_SQL", db.COHORT_PREMIUM_SQL, ("",)),
+        ("MESSAGES_SENT_SQL", db.MESSAGES_SENT_SQL, ("",)),
+        ("HOURLY_MESSAGES_SQL", db.HOURLY_MESSAGES_SQL, ("",)),
+        ("HOURLY_ACTIVITY_SQL", db.HOURLY_ACTIVITY_SQL, ("",)),
+        ("ACTIVE_PREMIUM_SQL", db.ACTIVE_PREMIUM_SQL, (0,)),
+        ("LANGUAGES_SQL", db.LANGUAGES_SQL, ()),
+        ("REFERRALS_SINCE_SQL", db.REFERRALS_SINCE_SQL, ("",)),
+        ("CONVERSATION_SUMMARY_SQL", db.CONVERSATION_SUMMARY_SQL, (1,)),
+        ("ARCHIVE_CONVERSATION_SUMMARY_SQL", db.ARCHIVE_CONVERSATION_SUMMARY_SQL, (1,)),
+        ("ATTACH_ARCHIVE_SQL", db.ATTACH_ARCHIVE_SQL, ("",)),
+        ("DETACH_ARCHIVE_SQL", db.DETACH_ARCHIVE_SQL, ()),
+        ("ITER_INACTIVE_USERS_SQL", db.ITER_INACTIVE_USERS_SQL, (-1, -1, 0, 1)),
+        ("ITER_USERS_SQL", db.ITER_USERS_SQL, (-1, 1)),
+        ("ITER_ALL_USERS_SQL", db.ITER_ALL_USERS_SQL, (-1, 1)),
+        ("ITER_REFERRALS_SQL", db.ITER_REFERRALS_SQL, (-1, 1)),
+        ("ITER_REFERRER_REFERRALS_SQL", db.ITER_REFERRER_REFERRALS_SQL, (-1, 1, 1)),
+        ("ITER_CONVERSATIONS_SQL", db.ITER_CONVERSATIONS_SQL, (-1, 1)),
+        ("ITER_USER_CONVERSATIONS_SQL", db.ITER_USER_CONVERSATIONS_SQL, (-1, 1, 1)),
+        ("ITER_SESSION_CONVERSATIONS_SQL", db.ITER_SESSION_CONVERSATIONS_SQL, (-1, 1, 1)),
+        ("ITER_USER_SESSION_CONVERSATIONS_SQL", db.ITER_USER_SESSION_CONVERSATIONS_SQL, (-1, 1, 1, 1)),
+        ("GET_TRANSCRIPTION_SQL", db.GET_TRANSCRIPTION_SQL, ("", "")),
+        ("SAVE_TRANSCRIPTION_SQL", db.SAVE_TRANSCRIPTION_SQL, ("", "", "", 0, 0)),
+        ("TOUCH_TRANSCRIPTION_SQL", db.TOUCH_TRANSCRIPTION_SQL, (0, "", "")),
+        ("EVICT_TRANSCRIPTIONS_SQL", db.EVICT_TRANSCRIPTIONS_SQL, (1,)),
+        ("INSERT_ADMIN_ACTION_SQL", db.INSERT_ADMIN_ACTION_SQL, (1, "", 1, "")),
+    ]
+
+def find_full_scans(conn: sqlite3.Connection, queries: List[Tuple[str, str, tuple]]) -> List[Tuple[str, str]]:
+    """EXPLAIN QUERY PLAN для queries; возвращает (константа, строка плана) с полным просмотром"""
+    offenders = []
+    for name, sql, params in queries:
+        if name in ALLOWED_SCANS:
+            continue
+        for row in conn.execute(f"EXPLAIN QUERY PLAN {sql}", params):
+            detail = row[-1]
+            match = _FULL_SCAN.match(detail)
+            if match and match.group(1) not in SMALL_TABLES:
+                offenders.append((name, detail))
+    return offenders
+
+def coverage_errors(queries: List[Tuple[str, str, tuple]], path: str = _DATABASE_PY) -> List[str]:
+    """Где SQL database.py уходит мимо проверки: запрос не константой или константа без плана (по исходнику)"""
+    with open(path, encoding="utf-8") as f:
+        tree = ast.parse(f.read())
+    errors = []
+    constants = [
+        target.id for node in tree.body if isinstance(node, ast.Assign)
+        for target in node.targets if isinstance(target, ast.Name) and re.fullmatch(r"[A-Z][A-Z0-9_]*_SQL", target.id)
+    ]
+    checked = {name for name, _, _ in queries}
+    errors += [f"{name} is not in checked_queries()" for name in constants if name not in checked]
+    for node in tree.body:
+        if not (isinstance(node, ast.ClassDef) and node.name == "Database"):
+            continue
+        for method in node.body:
+            if not isinstance(method, ast.FunctionDef) or method.name in PASSTHROUGH_METHODS:
+                continue
+            for call in ast.walk(method):
+                if not (isinstance(call, ast.Call) and isinstance(call.func, ast.Attribute)
+                        and call.func.attr in ("execute", "executemany") and call.args):
+                    continue
+                # Первый аргумент — константа *_SQL или выбор `A_SQL if ... else B_SQL`
+                arg, names = call.args[0], set()
+                while isinstance(arg, ast.IfExp) and isinstance(arg.body, ast.Name):
+                    names.add(arg.body.id)
+                    arg = arg.orelse
+                if not isinstance(arg, ast.Name) or not names | {arg.id} <= set(constants):
+                    errors.append(f"Database.{method.name}:{call.lineno} runs SQL that is not a *_SQL constant")
+    return errors
+
+def check_query_plans(db_path: str):
+    """Падает, если SQL Database прошёл мимо проверки или какой-либо запрос идёт полным просмотром"""
+    queries = checked_queries()
+    errors = coverage_errors(queries)
+    if errors:
+        raise RuntimeError("Unchecked SQL in database.py:\n" + "\n".join(f"  {error}" for error in errors))
+    migrate(db_path)
+    conn = sqlite3.connect(db_path)
+    try:
+        # Архив устроен как основная БД — для плана ARCHIVE_* подключаем её же под именем arc
+        conn.execute("ATTACH DATABASE ? AS arc", (db_path,))
+        offenders = find_full_scans(conn, queries)
+    finally:
+        conn.close()
+    if offenders:
+        details = "\n".join(f"  {name}: {detail}" for name, detail in offenders)
+        raise RuntimeError(f"Full table scans in query plans:\n{details}")
+
+if __name__ == "__main__":
+    path = sys.argv[1] if len(sys.argv) > 1 else "night_whisper.db"
+    shards = int(sys.argv[2]) if len(sys.argv) > 2 else 1
+    for shard_path in shard_paths(path, shards):
+        print(f"{shard_path}: schema version {migrate(shard_path)}")
+        check_query_plans(shard_path)
+    print("Query plans OK")
@@ -0,0 +1,112 @@
+import random
+import time
+from collections import deque
+from email.utils import parsedate_to_datetime
+from typing import Dict, Optional
+
+class UpstreamError(Exception):
+    """Ответ LLM-провайдера с ошибочным статусом"""
+
+    def __init__(self, status: int, retry_after: Optional[float] = None, body: str = ""):
+        super().__init__(f"HTTP {status}: {body[:200]}")
+        self.status = status
+        self.retry_after = retry_after
+
+    @property
+    def retryable(self) -> bool:
+        return self.status == 429 or self.status >= 500
+
+class CircuitOpen(Exception):
+    """Провайдер признан нездоровым — запрос не отправляется, отвечаем запасным текстом сразу"""
+
+def parse_retry_after(value: Optional[str]) -> Optional[float]:
+    """Retry-After в секундах или HTTP-датой; None — заголовка нет или он непонятен"""
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+class RetryPolicy:
+    """Ограниченные повторы: экспоненциальная пауза с полным джиттером, Retry-After провайдера важнее"""
+
+    def __init__(self, attempts: int = 3, base_delay: float = 0.5, max_delay: float = 8):
+        self.attempts = attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+
+    def delay(self, attempt: int, retry_after: Optional[float] = None) -> Optional[float]:
+        """Пауза перед повтором номер attempt+1; None — повторять бессмысленно"""
+        if attempt + 1 >= self.attempts:
+            return None
+        if retry_after is not None:
+            # Ждать дольше, чем готов ждать пользователь, незачем — сразу отдаём запасной ответ
+            return retry_after if retry_after <= self.max_delay else None
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+
+class CircuitBreaker:
+    """closed -> open после N ошибок подряд; через reset_seconds один пробный запрос (half_open) решает, закрываться ли"""
+
+    def __init__(self, failure_threshold: int = 5, reset_seconds: float = 30):
+        self.failure_threshold = failure_threshold
+        self.reset_seconds = reset_seconds
+        self.state = "closed"
+        self.failures = 0
+        self._opened_at = 0.0
+        self._probe_started: Optional[float] = None
+        self.rejected = 0
+
+    def allow(self) -> bool:
+        now = time.monotonic()
+        if self.state == "closed":
+            return True
+        if self.state == "open" and now - self._opened_at >= self.reset_seconds:
+            self.state = "half_open"
+            self._probe_started = None
+        # Зависший или отменённый пробный запрос не блокирует следующую пробу навсегда
+        if self.state == "half_open" and (self._probe_started is None or now - self._probe_started >= self.reset_seconds):
+            self._probe_started = now
+            return True
+        self.rejected += 1
+        return False
+
+    def record_success(self):
+        self.state = "closed"
+        self.failures = 0
+        self._probe_started = None
+
+    def record_failure(self):
+        self.failures += 1
+        if self.state == "half_open" or self.failures >= self.failure_threshold:
+            self.state = "open"
+            self._opened_at = time.monotonic()
+            self._probe_started = None
+
+class LatencyTracker:
+    """Скользящее окно длительностей успешных запросов; p95 — задержка перед дублирующим (hedged) запросом"""
+
+    def __init__(self, window: int = 200, min_samples: int = 20):
+        self._samples = deque(maxlen=window)
+        self.min_samples = min_samples
+
+    def add(self, seconds: float):
+        self._samples.append(seconds)
+
+    def percentile(self, q: float) -> Optional[float]:
+        if len(self._samples) < self.min_samples:
+            return None
+        ordered = sorted(self._samples)
+        return ordered[int(q * (len(ordered) - 1))]
+
+    def stats(self) -> Dict:
+        p50, p95 = self.percentile(0.5), self.percentile(0.95)
+        return {
+            "samples": len(self._samples),
+            "p50_ms": round(p50 * 1000) if p50 is not None else None,
+            "p95_ms": round(p95 * 1000) if p95 is not None else None,
+        }
\ No newline at end of file
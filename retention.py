@@ -1,5 +1,5 @@
-from datetime import datetime, timedelta
-from typing import List, Dict
+import time
+from typing import Dict, Iterator
 from database import db
 
 class RetentionSystem:
@@ -36,25 +36,23 @@ class RetentionSystem:
         }
     }
     
-    def get_inactive_users_for_retention(self) -> List[Dict]:
-        """Получает пользователей для отправки retention-сообщений"""
-        users_to_message = []
+    def get_inactive_users_for_retention(self) -> Iterator[Dict]:
+        """Пользователи для retention-сообщений: один keyset-проход, каждому — сообщение по самому длинному порогу"""
+        thresholds = sorted(self.MESSAGES, reverse=True)
+        now = time.time()
         
-        for days in [1, 3, 7]:
-            inactive = db.get_inactive_users(days)
-            for user_id, username, lang, last_active in inactive:
-                # Проверяем, не отправляли ли уже сегодня
-                if not self._was_message_sent_recently(user_id, days):
-                    msg_data = self.MESSAGES.get(days, {}).get(lang, self.MESSAGES[days]["en"])
-                    users_to_message.append({
-                        "user_id": user_id,
-                        "days": days,
-                        "text": msg_data["text"],
-                        "cta": msg_data["cta"],
-                        "bonus": days >= 3  # Бонус начиная с 3-го дня
-                    })
-        
-        return users_to_message
+        for user_id, username, lang, last_active in db.iter_inactive_users(min(thresholds)):
+            days = next(d for d in thresholds if now - last_active >= d * 86400)
+            # Проверяем, не отправляли ли уже сегодня
+            if not self._was_message_sent_recently(user_id, days):
+                msg_data = self.MESSAGES.get(days, {}).get(lang, self.MESSAGES[days]["en"])
+                yield {
+                    "user_id": user_id,
+                    "days": days,
+                    "text": msg_data["text"],
+                    "cta": msg_data["cta"],
+                    "bonus": days >= 3  # Бонус начиная с 3-го дня
+                }
     
     def _was_message_sent_recently(self, user_id: int, message_type: int) -> bool:
         """Проверял, отправляли ли уже такое сообщение"""
@@ -0,0 +1,376 @@
+import itertools
+import threading
+import time
+from collections import Counter, OrderedDict
+from datetime import datetime, timedelta
+from typing import Dict, Iterator, List, Optional, Protocol, Tuple
+
+from config import config
+
+# Дневные лимиты бесплатной версии по действиям (quotas) — общие для всех бэкендов
+QUOTA_LIMITS = {
+    "message": config.FREE_MESSAGES_PER_NIGHT,
+    "story": config.FREE_STORIES_PER_DAY,
+    "confessional": config.FREE_CONFESSIONS_PER_DAY,
+}
+
+def premium_active(user: Optional[Dict]) -> bool:
+    if not user or not user.get("is_premium"):
+        return False
+    return (user.get("premium_until_ts") or 0) > time.time()
+
+def trial_active(user: Optional[Dict]) -> bool:
+    if not user or user.get("trial_used"):
+        return False
+    return (user.get("trial_until_ts") or 0) > time.time()
+
+class Storage(Protocol):
+    """Всё, что хендлеры, админка, удержание и аналитика берут из хранилища.
+    Реализации: database.Database (SQLite) и MemoryStorage (для замеров логики бота без стоимости хранения)."""
+
+    shards: int
+
+    def shard_for(self, user_id: int) -> int: ...
+    def close(self): ...
+    def flush(self): ...
+    def cache_stats(self) -> Dict: ...
+
+    # Пользователи
+    def add_user(self, user_id: int, username: str, lang: str = "en", referrer_id: int = None) -> bool: ...
+    def get_user(self, user_id: int) -> Optional[Dict]: ...
+    def set_language(self, user_id: int, lang: str): ...
+    def get_language(self, user_id: int) -> str: ...
+    def update_last_active(self, user_id: int): ...
+    def block_user(self, user_id: int, blocked: bool = True): ...
+    def is_blocked(self, user_id: int) -> bool: ...
+
+    # Лимиты и доступ
+    def consume_quota(self, user_id: int, action: str) -> bool: ...
+    def refund_quota(self, user_id: int, action: str): ...
+    def quota_left(self, user_id: int, action: str) -> int: ...
+    def add_bonus_messages(self, user_id: int, count: int): ...
+    def is_premium(self, user_id: int) -> bool: ...
+    def is_trial_active(self, user_id: int) -> bool: ...
+    def end_trial(self, user_id: int): ...
+    def add_premium(self, user_id: int, days: int = 30): ...
+    def remove_premium(self, user_id: int): ...
+
+    # Сессии и диалоги
+    def start_session(self, user_id: int, is_confessional: bool = False) -> int: ...
+    def get_active_session(self, user_id: int) -> Optional[Dict]: ...
+    def end_session(self, user_id: int, session_id: int): ...
+    def add_message(self, user_id: int, session_id: int, content: str, is_user: bool, is_confessional: bool = False): ...
+
+    # Рефералы
+    def get_referral_link(self, user_id: int) -> str: ...
+    def process_referral_conversion(self, user_id: int) -> Optional[int]: ...
+    def get_referral_stats(self, user_id: int) -> Dict: ...
+
+    # События и статистика
+    def log_event(self, user_id: int, event_type: str, data: str = None): ...
+    def get_stats(self, days: int = 7) -> Dict: ...
+    def get_analytics_stats(self, days: int = 7) -> Dict: ...
+    def get_conversation_summary(self, limit: int = 50, include_archive: bool = False) -> List[Dict]: ...
+    def log_admin_action(self, admin_id: int, action_type: str, target_user_id: int, details: str): ...
+
+    # Кэш распознанных голосовых
+    def get_transcription(self, file_unique_id: str, language: str) -> Optional[str]: ...
+    def save_transcription(self, file_unique_id: str, language: str, text: str): ...
+
+    # Списки (keyset-итераторы)
+    def get_inactive_users(self, days: int) -> List[Tuple]: ...
+    def iter_inactive_users(self, days: int, batch_size: int = 1000) -> Iterator[Tuple]: ...
+    def iter_users(self, include_blocked: bool = False, batch_size: int = 1000) -> Iterator[Tuple]: ...
+    def iter_referrals(self, referrer_id: Optional[int] = None, batch_size: int = 1000) -> Iterator[Tuple]: ...
+    def iter_conversations(self, user_id: Optional[int] = None, session_id: Optional[int] = None,
+                           batch_size: int = 1000) -> Iterator[Tuple]: ...
+
+def _utc_timestamp(ts: Optional[float] = None) -> str:
+    # Формат CURRENT_TIMESTAMP, как в SQLite
+    return time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime(ts))
+
+class MemoryStorage:
+    """Хранилище в словарях процесса: та же семантика, что у Database, но без диска и SQL"""
+
+    shards = 1
+    QUOTA_LIMITS = QUOTA_LIMITS
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._users: Dict[int, Dict] = {}
+        self._sessions: Dict[int, Dict] = {}
+        self._conversations: List[Tuple] = []
+        self._events: List[Tuple] = []
+        self._referrals: List[Dict] = []
+        self._quotas: Dict[Tuple[int, str], List] = {}
+        self._admin_actions: List[Tuple] = []
+        self._transcriptions: OrderedDict = OrderedDict()
+        self._ids = itertools.count(1)
+
+    def shard_for(self, user_id: int) -> int:
+        return 0
+
+    def close(self):
+        pass
+
+    def flush(self):
+        pass
+
+    def cache_stats(self) -> Dict:
+        # Кэша нет — все строки и так в памяти
+        return {"size": len(self._users), "max_size": 0, "hits": 0, "misses": 0, "hit_rate": "0%"}
+
+    def add_user(self, user_id: int, username: str, lang: str = "en", referrer_id: int = None) -> bool:
+        now = int(time.time())
+        with self._lock:
+            if user_id in self._users:
+                return False
+            self._users[user_id] = {
+                "user_id": user_id, "username": username, "language": lang, "premium_until_ts": None,
+                "is_premium": 0, "created_at_ts": now, "last_active_ts": now, "total_messages": 0,
+                "referrer_id": referrer_id, "referral_count": 0, "bonus_messages": 0, "is_blocked": 0,
+                "trial_until_ts": now + 3 * 86400, "trial_used": 0
+            }
+            if referrer_id and referrer_id != user_id:
+                self._referrals.append({
+                    "id": next(self._ids), "referrer_id": referrer_id, "referred_id": user_id, "status": "pending",
+                    "created_at": _utc_timestamp(), "converted_at": None
+                })
+            return True
+
+    def get_user(self, user_id: int) -> Optional[Dict]:
+        with self._lock:
+            user = self._users.get(user_id)
+            return dict(user) if user else None
+
+    def _update_user(self, user_id: int, **fields):
+        with self._lock:
+            user = self._users.get(user_id)
+            if user:
+                user.update(fields)
+            return user
+
+    def set_language(self, user_id: int, lang: str):
+        self._update_user(user_id, language=lang)
+
+    def get_language(self, user_id: int) -> str:
+        user = self.get_user(user_id)
+        return user.get("language", "en") if user else "en"
+
+    def update_last_active(self, user_id: int):
+        with self._lock:
+            user = self._users.get(user_id)
+            if user:
+                user["last_active_ts"] = int(time.time())
+                user["total_messages"] += 1
+
+    def block_user(self, user_id: int, blocked: bool = True):
+        self._update_user(user_id, is_blocked=int(blocked))
+
+    def is_blocked(self, user_id: int) -> bool:
+        user = self._users.get(user_id)
+        return bool(user and user["is_blocked"])
+
+    def _quota_limit(self, user_id: int, action: str) -> int:
+        # Бонусные сообщения (рефералы, админ) расширяют дневной лимит сообщений
+        bonus = self._users.get(user_id, {}).get("bonus_messages", 0) if action == "message" else 0
+        return self.QUOTA_LIMITS[action] + bonus
+
+    def consume_quota(self, user_id: int, action: str) -> bool:
+        today = datetime.now().strftime("%Y-%m-%d")
+        with self._lock:
+            quota = self._quotas.setdefault((user_id, action), [today, 0])
+            if quota[0] != today:
+                quota[:] = [today, 0]
+            if quota[1] >= self._quota_limit(user_id, action):
+                return False
+            quota[1] += 1
+            return True
+
+    def refund_quota(self, user_id: int, action: str):
+        with self._lock:
+            quota = self._quotas.get((user_id, action))
+            if quota:
+                quota[1] = max(quota[1] - 1, 0)
+
+    def quota_left(self, user_id: int, action: str) -> int:
+        today = datetime.now().strftime("%Y-%m-%d")
+        with self._lock:
+            day, used = self._quotas.get((user_id, action), (today, 0))
+            return max(self._quota_limit(user_id, action) - (used if day == today else 0), 0)
+
+    def add_bonus_messages(self, user_id: int, count: int):
+        with self._lock:
+            user = self._users.get(user_id)
+            if user:
+                user["bonus_messages"] += count
+
+    def is_premium(self, user_id: int) -> bool:
+        return premium_active(self.get_user(user_id))
+
+    def is_trial_active(self, user_id: int) -> bool:
+        return trial_active(self.get_user(user_id))
+
+    def end_trial(self, user_id: int):
+        self._update_user(user_id, trial_used=1)
+
+    def add_premium(self, user_id: int, days: int = 30):
+        with self._lock:
+            user = self._users.get(user_id)
+            if user:
+                user["premium_until_ts"] = max(user["premium_until_ts"] or 0, int(time.time())) + days * 86400
+                user["is_premium"] = 1
+
+    def remove_premium(self, user_id: int):
+        self._update_user(user_id, is_premium=0, premium_until_ts=None)
+
+    def start_session(self, user_id: int, is_confessional: bool = False) -> int:
+        with self._lock:
+            session_id = next(self._ids)
+            self._sessions[session_id] = {
+                "id": session_id, "user_id": user_id, "is_confessional": int(is_confessional), "is_active": 1,
+                "end_time": datetime.now() + timedelta(minutes=40)
+            }
+            return session_id
+
+    def get_active_session(self, user_id: int) -> Optional[Dict]:
+        with self._lock:
+            for session in reversed(self._sessions.values()):
+                if session["user_id"] == user_id and session["is_active"]:
+                    return {"id": session["id"], "is_confessional": session["is_confessional"]}
+            return None
+
+    def end_session(self, user_id: int, session_id: int):
+        with self._lock:
+            session = self._sessions.get(session_id)
+            if session and session["user_id"] == user_id:
+                session["is_active"] = 0
+
+    def add_message(self, user_id: int, session_id: int, content: str, is_user: bool, is_confessional: bool = False):
+        if is_confessional:
+            return
+        with self._lock:
+            self._conversations.append(
+                (next(self._ids), user_id, session_id, content, is_user, is_confessional, _utc_timestamp())
+            )
+
+    def get_referral_link(self, user_id: int) -> str:
+        return f"https://t.me/night_whisper_ai_bot?start=ref{user_id}"
+
+    def process_referral_conversion(self, user_id: int) -> Optional[int]:
+        with self._lock:
+            for referral in self._referrals:
+                if referral["referred_id"] == user_id and referral["status"] == "pending":
+                    referral["status"] = "converted"
+                    referral["converted_at"] = datetime.now().isoformat()
+                    referrer = self._users.get(referral["referrer_id"])
+                    if referrer:
+                        referrer["referral_count"] += 1
+                        referrer["bonus_messages"] += 5
+                    return referral["referrer_id"]
+            return None
+
+    def get_referral_stats(self, user_id: int) -> Dict:
+        with self._lock:
+            referrals = [r for r in self._referrals if r["referrer_id"] == user_id]
+            return {"total": len(referrals), "converted": sum(r["status"] == "converted" for r in referrals)}
+
+    def log_event(self, user_id: int, event_type: str, data: str = None):
+        with self._lock:
+            self._events.append((next(self._ids), user_id, event_type, data, _utc_timestamp()))
+
+    def get_stats(self, days: int = 7) -> Dict:
+        now = time.time()
+        since = _utc_timestamp(now - days * 86400)
+        with self._lock:
+            users = list(self._users.values())
+            new_users = sum(u["created_at_ts"] >= now - days * 86400 for u in users)
+            messages = sum(e[2] == "message_sent" and e[4] >= since for e in self._events)
+            referrals = [r for r in self._referrals if r["created_at"] > since]
+        refs_conv = sum(r["status"] == "converted" for r in referrals)
+        return {
+            "period_days": days,
+            "new_users": new_users,
+            "total_messages": messages,
+            "total_users": len(users),
+            "premium_users": sum(premium_active(u) for u in users),
+            "languages": dict(Counter(u["language"] for u in users)),
+            "referrals_total": len(referrals),
+            "referrals_converted": refs_conv,
+            "conversion_rate": f"{(refs_conv/len(referrals)*100):.1f}%" if referrals else "0%"
+        }
+
+    def get_analytics_stats(self, days: int = 7) -> Dict:
+        ts_since = int(time.time()) - days * 86400
+        since = _utc_timestamp(ts_since)
+        with self._lock:
+            cohort = [u for u in self._users.values() if u["created_at_ts"] > ts_since]
+            languages = dict(Counter(u["language"] for u in self._users.values()))
+            hours = Counter(int(c[6][11:13]) for c in self._conversations if c[6] >= since)
+        new_users, messages = len(cohort), sum(hours.values())
+        premium = sum(bool(u["is_premium"]) for u in cohort)
+        return {
+            "period_days": days,
+            "new_users": new_users,
+            "total_messages": messages,
+            "premium_conversion": f"{(premium/new_users*100):.1f}%" if new_users else "0%",
+            "languages": languages,
+            "hourly_activity": dict(hours),
+            "avg_messages_per_user": round(messages/new_users, 1) if new_users else 0
+        }
+
+    def get_conversation_summary(self, limit: int = 50, include_archive: bool = False) -> List[Dict]:
+        # Архива у хранилища в памяти нет
+        with self._lock:
+            rows = sorted(
+                (c for c in self._conversations if c[1] in self._users), key=lambda c: c[6], reverse=True
+            )[:limit]
+            return [{"id": c[0], "time": c[6], "length": len(c[3] or ""), "lang": self._users[c[1]]["language"]}
+                    for c in rows]
+
+    def log_admin_action(self, admin_id: int, action_type: str, target_user_id: int, details: str):
+        with self._lock:
+            self._admin_actions.append((next(self._ids), admin_id, action_type, target_user_id, details, _utc_timestamp()))
+
+    def get_transcription(self, file_unique_id: str, language: str) -> Optional[str]:
+        with self._lock:
+            text = self._transcriptions.get((file_unique_id, language))
+            if text is not None:
+                self._transcriptions.move_to_end((file_unique_id, language))
+            return text
+
+    def save_transcription(self, file_unique_id: str, language: str, text: str):
+        with self._lock:
+            self._transcriptions[(file_unique_id, language)] = text
+            self._transcriptions.move_to_end((file_unique_id, language))
+            while len(self._transcriptions) > config.TRANSCRIPTION_CACHE_MAX_ENTRIES:
+                self._transcriptions.popitem(last=False)
+
+    def get_inactive_users(self, days: int) -> List[Tuple]:
+        return list(self.iter_inactive_users(days))
+
+    def iter_inactive_users(self, days: int, batch_size: int = 1000) -> Iterator[Tuple]:
+        since = int(time.time()) - days * 86400
+        with self._lock:
+            rows = [(u["user_id"], u["username"], u["language"], u["last_active_ts"])
+                    for u in self._users.values() if not u["is_blocked"] and u["last_active_ts"] < since]
+        return iter(sorted(rows, key=lambda row: (row[3], row[0])))
+
+    def iter_users(self, include_blocked: bool = False, batch_size: int = 1000) -> Iterator[Tuple]:
+        with self._lock:
+            rows = [(u["user_id"], u["username"], u["language"]) for u in self._users.values()
+                    if include_blocked or not u["is_blocked"]]
+        return iter(sorted(rows))
+
+    def iter_referrals(self, referrer_id: Optional[int] = None, batch_size: int = 1000) -> Iterator[Tuple]:
+        with self._lock:
+            rows = [(r["id"], r["referrer_id"], r["referred_id"], r["status"], r["created_at"], r["converted_at"])
+                    for r in self._referrals if referrer_id is None or r["referrer_id"] == referrer_id]
+        return iter(rows)
+
+    def iter_conversations(self, user_id: Optional[int] = None, session_id: Optional[int] = None,
+                           batch_size: int = 1000) -> Iterator[Tuple]:
+        with self._lock:
+            rows = [c for c in self._conversations
+                    if (user_id is None or c[1] == user_id) and (session_id is None or c[2] == session_id)]
+        return iter(rows)
\ No newline at end of file
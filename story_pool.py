@@ -0,0 +1,110 @@
+import asyncio
+import itertools
+import time
+from typing import Dict, Iterable, List, Optional
+
+from ai_service import ai_service
+from config import config
+
+class StoryPool:
+    """Заранее сгенерированные сонные истории по языкам: кнопка отвечает сразу, генерация — в фоне, когда LLM простаивает"""
+
+    def __init__(self, languages: Iterable[str], depth: int = 5, max_age_hours: float = 24,
+                 max_serves: int = 20, refill_seconds: float = 60):
+        self.depth = depth
+        self.max_age = max_age_hours * 3600
+        self.max_serves = max_serves
+        self.refill_seconds = refill_seconds
+        # Язык -> истории от старых к новым: {"id", "text", "created", "served_to"}
+        self._stories: Dict[str, List[Dict]] = {lang: [] for lang in languages}
+        self._ids = itertools.count(1)
+        self._wakeup: Optional[asyncio.Event] = None
+        self._stats = {"hits": 0, "misses": 0, "generated": 0, "failed": 0, "expired": 0}
+
+    def _pool_lang(self, lang: str) -> str:
+        # Пул держит только выбираемые в боте языки; остальные получают английскую историю
+        return lang if lang in self._stories else "en"
+
+    def _purge(self, lang: str, now: float):
+        stories = self._stories[lang]
+        fresh = [story for story in stories if now - story["created"] < self.max_age]
+        self._stats["expired"] += len(stories) - len(fresh)
+        self._stories[lang] = fresh
+
+    def take(self, user_id: int, lang: str) -> Optional[str]:
+        """Готовая история, которую пользователь ещё не получал; None — пул пуст, генерируем на лету"""
+        lang = self._pool_lang(lang)
+        self._purge(lang, time.time())
+        stories = self._stories[lang]
+        for story in stories:
+            if user_id in story["served_to"]:
+                continue
+            story["served_to"].add(user_id)
+            if len(story["served_to"]) >= self.max_serves:
+                stories.remove(story)
+            self._stats["hits"] += 1
+            if len(stories) < self.depth:
+                self._wake()
+            return story["text"]
+        self._stats["misses"] += 1
+        self._wake()
+        return None
+
+    def add(self, lang: str, text: str):
+        self._stories[self._pool_lang(lang)].append(
+            {"id": next(self._ids), "text": text, "created": time.time(), "served_to": set()}
+        )
+
+    def _wake(self):
+        if self._wakeup:
+            self._wakeup.set()
+
+    async def refill(self) -> int:
+        """Догенерирует истории до заданной глубины, пока у LLM нет живой очереди; возвращает число новых"""
+        added = 0
+        now = time.time()
+        for lang in self._stories:
+            self._purge(lang, now)
+        # Сначала языки, где историй меньше всего
+        for lang in sorted(self._stories, key=lambda lang: len(self._stories[lang])):
+            while len(self._stories[lang]) < self.depth:
+                if not ai_service.scheduler.idle():
+                    return added
+                story = await ai_service.generate_sleep_story(lang, fallback=False)
+                if not story:
+                    # LLM недоступна — не долбим её, ждём следующего цикла
+                    self._stats["failed"] += 1
+                    return added
+                self.add(lang, story)
+                self._stats["generated"] += 1
+                added += 1
+        return added
+
+    async def run(self):
+        """Фоновый цикл: пополнение раз в refill_seconds или сразу, когда пул опустел"""
+        self._wakeup = asyncio.Event()
+        while True:
+            try:
+                await self.refill()
+            except Exception as e:
+                print(f"Story pool error: {e}")
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), self.refill_seconds)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+
+    def stats(self) -> Dict:
+        stats = dict(self._stats)
+        served = stats["hits"] + stats["misses"]
+        stats["hit_rate"] = f"{(stats['hits']/served*100):.1f}%" if served else "0%"
+        stats["ready"] = {lang: len(stories) for lang, stories in self._stories.items()}
+        return stats
+
+story_pool = StoryPool(
+    config.LANGUAGES,
+    depth=config.STORY_POOL_DEPTH,
+    max_age_hours=config.STORY_POOL_MAX_AGE_HOURS,
+    max_serves=config.STORY_POOL_MAX_SERVES,
+    refill_seconds=config.STORY_POOL_REFILL_SECONDS
+)
\ No newline at end of file
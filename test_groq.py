@@ -5,11 +5,12 @@ import requests
 load_dotenv()
 
 key = os.getenv("GROQ_API_KEY")
+base_url = os.getenv("GROQ_BASE_URL", "https://api.groq.com/openai/v1")
 print(f"Key found: {bool(key)}")
 
 if key:
     response = requests.post(
-        "https://api.groq.com/openai/v1/chat/completions",
+        f"{base_url}/chat/completions",
         headers={"Authorization": f"Bearer {key}", "Content-Type": "application/json"},
         json={
             "model": "llama-3.1-8b-instant",
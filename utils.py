@@ -1,4 +1,5 @@
 from datetime import datetime, time
+from typing import Optional
 
 def is_night_time() -> bool:
     """Бот работает 24/7 без ограничений по времени"""
@@ -14,4 +15,8 @@ def get_night_greeting_key() -> str:
     elif 18 <= hour < 22:
         return "evening_greeting"
     else:
-        return "night_greeting"
\ No newline at end of file
+        return "night_greeting"
+
+def format_date(ts: Optional[int]) -> str:
+    """Дата из секунд Unix (колонки *_ts) в виде YYYY-MM-DD"""
+    return datetime.fromtimestamp(ts).strftime("%Y-%m-%d") if ts else ""
\ No newline at end of file